@@ -0,0 +1,180 @@
+"""
+Check the FTP downloader (download/ftp_download.py) against the local stand-in server (bench/ftp_server.py).
+
+Run from the top directory of the project:
+    python -m bench.check_download
+
+A small archive tree of random files is served from a temporary directory, and each check downloads from it:
+    download        every file in the year range arrives whole, including transfers cut partway (resumed with REST),
+                    with MLSD and again with only NLST and SIZE
+    skip            a second run downloads nothing
+    resume          a .part left by an earlier run is finished from where it stopped
+    no_rest         on a server that refuses REST, a .part is fetched again from the start
+    missing         a listed file that gives 550 fails after one try, leaves no .part, and the others arrive
+"""
+
+import argparse
+import os
+from os.path import exists, join
+import shutil
+import tempfile
+
+import download.ftp_download as ftp_download
+from bench.ftp_server import start_server
+
+ROOT = '/pub/data/hourly_precip-3240'
+STATES = ['01', '05', '91']
+FIRST_YEAR = 2003
+LAST_YEAR = 2006
+
+
+def make_tree(server_dir: str) -> dict:
+    """
+    Write a small archive tree: a yearly file per state and year, with files outside the year range and others that
+    the downloader must leave alone.
+    :param server_dir: Directory served as /
+    :return: Dictionary of the file names that should be downloaded to their contents
+    """
+    expected = {}
+    root = join(server_dir, ROOT.strip('/'))
+    for state in STATES:
+        os.makedirs(join(root, state))
+        for year in range(FIRST_YEAR - 1, LAST_YEAR + 2):
+            name = '3240_%s_%d-%d.tar.Z' % (state, year, year)
+            data = os.urandom(150000 + 1000 * (year % 7) + int(state))
+            with open(join(root, state, name), 'wb') as outfile:
+                outfile.write(data)
+            if FIRST_YEAR <= year <= LAST_YEAR:
+                expected[name] = data
+        # A multi-year file, which the downloader skips
+        with open(join(root, state, '3240_%s_1900-2004.tar.Z' % state), 'wb') as outfile:
+            outfile.write(b'x')
+    with open(join(root, 'readme.txt'), 'w') as outfile:
+        outfile.write('not an archive')
+    os.makedirs(join(root, 'docs'))
+    return expected
+
+
+def same_files(dest_dir: str, expected: dict) -> bool:
+    """
+    Check that the download directory holds exactly the expected files.
+    :param dest_dir: Download directory
+    :param expected: Dictionary of file name to contents
+    :return: True if they match
+    """
+    if sorted(os.listdir(dest_dir)) != sorted(expected):
+        return False
+    for name, data in expected.items():
+        with open(join(dest_dir, name), 'rb') as infile:
+            if infile.read() != data:
+                return False
+    return True
+
+
+def download(server, dest_dir: str, n_sessions: int = 3) -> ftp_download.DownloadStats:
+    """
+    Download the year range from the stand-in server (internal use only).
+    :param server: Stand-in server
+    :param dest_dir: Download directory
+    :param n_sessions: FTP sessions
+    :return: DownloadStats
+    """
+    return ftp_download.download_archive(dest_dir, FIRST_YEAR, LAST_YEAR, n_sessions, '127.0.0.1', server.port,
+                                         ROOT, retries=3)
+
+
+def run_checks(work_dir: str) -> list:
+    """
+    Run the checks.
+    :param work_dir: Scratch directory
+    :return: List of (check name, passed, details)
+    """
+    server_dir = join(work_dir, 'server')
+    dest_dir = join(work_dir, 'dest')
+    expected = make_tree(server_dir)
+    names = sorted(expected)
+    results = []
+
+    for label, options in (('download', {}), ('download (NLST)', {'no_mlsd': True})):
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        os.makedirs(dest_dir)
+        cut = {names[0]: 40000, names[-1]: 1000}
+        server = start_server(server_dir, cut=cut, delay=0.001, **options)
+        try:
+            stats = download(server, dest_dir)
+            rest = server.count('REST')
+        finally:
+            server.shutdown()
+        results.append((label, same_files(dest_dir, expected) and not stats.failed and rest >= len(cut),
+                        "%d files, %d failed, %d REST" % (stats.downloaded, len(stats.failed), rest)))
+
+    server = start_server(server_dir)
+    try:
+        stats = download(server, dest_dir)
+        retr = server.count('RETR')
+        results.append(('skip', stats.skipped == len(expected) and retr == 0,
+                        "%d skipped, %d RETR" % (stats.skipped, retr)))
+
+        name = names[1]
+        os.remove(join(dest_dir, name))
+        with open(join(dest_dir, name + '.part'), 'wb') as outfile:
+            outfile.write(expected[name][:5000])
+        stats = download(server, dest_dir)
+        results.append(('resume', same_files(dest_dir, expected) and stats.bytes == len(expected[name]) - 5000,
+                        "%d bytes fetched for %d missing" % (stats.bytes, len(expected[name]) - 5000)))
+    finally:
+        server.shutdown()
+
+    server = start_server(server_dir, no_rest=True)
+    try:
+        os.remove(join(dest_dir, name))
+        with open(join(dest_dir, name + '.part'), 'wb') as outfile:
+            outfile.write(expected[name][:5000])
+        stats = download(server, dest_dir)
+        results.append(('no_rest', same_files(dest_dir, expected) and stats.bytes == len(expected[name]),
+                        "%d bytes fetched for a %d byte file" % (stats.bytes, len(expected[name]))))
+    finally:
+        server.shutdown()
+
+    shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+    missing = '3240_%s_%d-%d.tar.Z' % (STATES[0], LAST_YEAR, LAST_YEAR)
+    gone = expected.pop(missing)
+    os.remove(join(server_dir, ROOT.strip('/'), STATES[0], missing))
+    server = start_server(server_dir, missing={missing: len(gone)}, missing_dir=ROOT.strip('/') + '/' + STATES[0])
+    try:
+        stats = download(server, dest_dir)
+        retr = server.count('RETR')
+    finally:
+        server.shutdown()
+    failed = [remote for remote, error in stats.failed]
+    results.append(('missing', failed == [ROOT + '/' + STATES[0] + '/' + missing] and retr == len(expected) + 1
+                    and not exists(join(dest_dir, missing + '.part')) and same_files(dest_dir, expected),
+                    "failed %s, %d RETR for %d files" % (failed, retr, len(expected) + 1)))
+    return results
+
+
+def main(argv=None):
+    """
+    Run the checks from the command line.
+    :param argv: Arguments (defaults to sys.argv)
+    :return: Exit code (0 if every check passed)
+    """
+    parser = argparse.ArgumentParser(description="Check the FTP downloader against a local stand-in server")
+    parser.add_argument("--work-dir", help="directory for the files (default: a temporary directory)")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="precip_ftp_")
+    try:
+        results = run_checks(work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, passed, details in results:
+        print("%-16s %-4s %s" % (name, 'ok' if passed else 'FAIL', details))
+    return 0 if all(passed for name, passed, details in results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
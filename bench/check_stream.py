@@ -0,0 +1,183 @@
+"""
+Check the streamed archive load (load/stream_load.py) against the local stand-in FTP server (bench/ftp_server.py).
+
+Run from the top directory of the project:
+    python -m bench.check_stream
+
+It builds real .tar.Z archives from synthetic data (bench/synthetic.py), compressed with ncompress (in
+requirements-dev.txt), and serves them from a temporary directory.  The checks:
+    stream          the streamed load, with one transfer cut partway, writes the same rows as archive_load
+                    (import_precip_archive) does for the same archives
+    missing         a listed archive that gives 550 makes the stream raise RuntimeError, after every other archive
+                    is loaded and marked done
+"""
+
+import argparse
+import io
+import os
+from os.path import join
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+
+from bench.ftp_server import start_server
+import bench.synthetic as synthetic
+import load.archive_load as archive_load
+import load.create_tables as create_tables
+import load.stream_load as stream_load
+
+ROOT = '/pub/data/hourly_precip-3240'
+STATES = ['01', '05', '17', '91']
+FIRST_YEAR = 2004
+LAST_YEAR = 2006
+STATIONS_PER_STATE = 4
+# The archive left out of the tree and listed by the server as missing (550 when fetched)
+MISSING = '3240_17_2006-2006.tar.Z'
+
+
+def make_tree(server_dir: str, work_dir: str) -> list:
+    """
+    Write a yearly .tar.Z archive per state and year, each with one member of synthetic lines for the state's stations.
+    :param server_dir: Directory served as /
+    :param work_dir: Scratch directory for the members
+    :return: List of archive filenames written
+    """
+    import ncompress
+
+    fnames = []
+    root = join(server_dir, ROOT.strip('/'))
+    member = join(work_dir, 'member.txt')
+    for state in STATES:
+        os.makedirs(join(root, state))
+        stations = [("%s%04d" % (state, 10 * n + 1), 'HT' if n == 0 else 'HI') for n in range(STATIONS_PER_STATE)]
+        for year in range(FIRST_YEAR, LAST_YEAR + 1):
+            name = '3240_%s_%d-%d.tar.Z' % (state, year, year)
+            if name == MISSING:
+                continue
+            synthetic.generate_year(member, year, stations, seed=int(state))
+            tar_bytes = io.BytesIO()
+            with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
+                tar.add(member, arcname='3240_%s_%d' % (state, year))
+            fname = join(root, state, name)
+            with open(fname, 'wb') as outfile:
+                outfile.write(ncompress.compress(tar_bytes.getvalue()))
+            fnames.append(fname)
+    return fnames
+
+
+def new_db() -> sqlite3.Connection:
+    """
+    Open an in-memory DB with the raw tables.
+    :return: DB connection
+    """
+    conn = sqlite3.connect(':memory:')
+    create_tables.cr_tb_hr(conn)
+    create_tables.cr_tb_dr(conn)
+    return conn
+
+
+def raw_rows(conn: sqlite3.Connection) -> list:
+    """
+    Read back the raw tables in a fixed order.
+    :param conn: DB connection
+    :return: List of the rows of hourly_raw and daily_raw
+    """
+    return [conn.execute("SELECT * FROM %s ORDER BY 1, 2, 3, 4, 5" % table).fetchall()
+            for table in ('hourly_raw', 'daily_raw')]
+
+
+def stream(server, conn: sqlite3.Connection, dest_dir: str, mark_done=None) -> stream_load.StreamStats:
+    """
+    Stream the year range from the stand-in server (internal use only).
+    :param server: Stand-in server
+    :param conn: DB connection
+    :param dest_dir: Download directory
+    :param mark_done: Function (conn, archive name) called after each archive is saved
+    :return: StreamStats
+    """
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.makedirs(dest_dir)
+    return stream_load.stream_load_archives(conn, FIRST_YEAR, LAST_YEAR, dest_dir, keep_archives=False,
+                                            mark_done=mark_done, n_sessions=3, workers=2, queue_size=2,
+                                            host='127.0.0.1', port=server.port, root=ROOT, retries=3)
+
+
+def run_checks(work_dir: str) -> list:
+    """
+    Run the checks.
+    :param work_dir: Scratch directory
+    :return: List of (check name, passed, details)
+    """
+    server_dir = join(work_dir, 'server')
+    dest_dir = join(work_dir, 'dest')
+    fnames = make_tree(server_dir, work_dir)
+    results = []
+
+    ref_conn = new_db()
+    for fname in fnames:
+        archive_load.import_precip_archive(fname, ref_conn)
+    expected = raw_rows(ref_conn)
+    ref_conn.close()
+
+    conn = new_db()
+    server = start_server(server_dir, cut={os.path.basename(fnames[1]): 2000}, delay=0.001)
+    try:
+        stats = stream(server, conn, dest_dir)
+        rest = server.count('REST')
+    finally:
+        server.shutdown()
+    rows = raw_rows(conn)
+    conn.close()
+    results.append(('stream', rows == expected and stats.parse.items == len(fnames) and rest >= 1,
+                    "%d archives, %d hourly and %d daily rows (archive_load: %d and %d), %d REST"
+                    % (stats.parse.items, len(rows[0]), len(rows[1]), len(expected[0]), len(expected[1]), rest)))
+
+    conn = new_db()
+    done = []
+
+    def mark_done(done_conn, name):
+        done.append(name)
+        done_conn.commit()
+
+    server = start_server(server_dir, missing={MISSING: 5000}, missing_dir=ROOT.strip('/') + '/17')
+    error = None
+    try:
+        stream(server, conn, dest_dir, mark_done)
+    except RuntimeError as e:
+        error = e
+    finally:
+        server.shutdown()
+    rows = raw_rows(conn)
+    conn.close()
+    left = [name for name in os.listdir(dest_dir) if name.endswith('.part')]
+    results.append(('missing', error is not None and MISSING in str(error) and len(done) == len(fnames)
+                    and rows == expected and not left,
+                    "raised %r, %d of %d archives loaded" % (str(error) if error else None, len(done), len(fnames))))
+    return results
+
+
+def main(argv=None):
+    """
+    Run the checks from the command line.
+    :param argv: Arguments (defaults to sys.argv)
+    :return: Exit code (0 if every check passed)
+    """
+    parser = argparse.ArgumentParser(description="Check the streamed archive load against a local stand-in server")
+    parser.add_argument("--work-dir", help="directory for the files (default: a temporary directory)")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="precip_stream_")
+    try:
+        results = run_checks(work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    for name, passed, details in results:
+        print("%-8s %-4s %s" % (name, 'ok' if passed else 'FAIL', details))
+    return 0 if all(passed for name, passed, details in results) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
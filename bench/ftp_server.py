@@ -0,0 +1,203 @@
+"""
+Local stand-in FTP server for checking the downloader (download/ftp_download.py) without the network.
+
+It serves a local directory read-only over passive mode, with the commands the downloader uses: USER, PASS, TYPE,
+OPTS, PASV, MLSD, NLST, SIZE, REST, RETR and QUIT.  Options make it behave like the awkward servers the downloader
+has to cope with:
+    no_mlsd     MLSD is refused, so directories are listed with NLST and sizes taken with SIZE
+    no_rest     REST is refused (502), so a partial file has to be fetched again from the start
+    cut         {file name: bytes}: the first transfer of each file stops after that many bytes and drops the
+                control connection as well, as a broken link does
+    missing     {file name: size}: files that are listed in missing_dir (relative to the root, e.g. '01') with that
+                size, but give 550 when fetched
+    delay       seconds to wait after each block sent, so that transfers overlap
+
+The server counts the commands it is sent (log) and the most transfers it had running at once (max_active).
+"""
+
+import os
+from os.path import basename, getsize, isdir, isfile, join
+import socket
+import socketserver
+import threading
+import time
+
+# Bytes sent at a time
+BLOCK_SIZE = 1 << 16
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+    """
+    One control connection
+    """
+
+    def send(self, line: str):
+        """
+        Send a reply line.
+        :param line: Reply with its code
+        :return: None
+        """
+        self.wfile.write((line + '\r\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        """
+        Answer the commands of one session until QUIT or the connection closes.
+        :return: None
+        """
+        server = self.server
+        rest = 0
+        pasv = None
+        self.send('220 Stand-in FTP server')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd, _, arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+            with server.lock:
+                server.log.append(cmd)
+            rel = arg.strip('/')
+            path = join(server.root, rel) if rel else server.root
+            missing_size = server.missing.get(basename(rel)) if rel else None
+
+            if cmd == 'USER':
+                self.send('331 Password required')
+            elif cmd == 'PASS':
+                self.send('230 Logged in')
+            elif cmd in ('TYPE', 'OPTS'):
+                self.send('200 OK')
+            elif cmd == 'QUIT':
+                self.send('221 Goodbye')
+                return
+            elif cmd == 'PASV':
+                pasv = socket.socket()
+                pasv.bind(('127.0.0.1', 0))
+                pasv.listen(1)
+                port = pasv.getsockname()[1]
+                self.send('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port >> 8, port & 255))
+            elif cmd == 'SIZE':
+                if isfile(path) and missing_size is None:
+                    self.send('213 %d' % getsize(path))
+                else:
+                    self.send('550 No such file')
+            elif cmd == 'REST':
+                if server.no_rest:
+                    self.send('502 REST not implemented')
+                    continue
+                rest = int(arg)
+                self.send('350 Restarting at %d' % rest)
+            elif cmd in ('MLSD', 'NLST'):
+                if cmd == 'MLSD' and server.no_mlsd:
+                    self.send('500 Unknown command')
+                    continue
+                if not isdir(path):
+                    self.send('550 No such directory')
+                    continue
+                conn, _ = pasv.accept()
+                self.send('150 Listing')
+                entries = []
+                for name in os.listdir(path):
+                    is_dir = isdir(join(path, name))
+                    entries.append((name, is_dir, None if is_dir else getsize(join(path, name))))
+                entries += [(name, False, size) for name, size in server.missing.items()
+                            if server.missing_dir == rel]
+                for name, is_dir, size in sorted(entries):
+                    if cmd == 'MLSD':
+                        facts = 'type=dir;' if is_dir else 'type=file;size=%d;' % size
+                        conn.sendall(('%s %s\r\n' % (facts, name)).encode())
+                    else:
+                        conn.sendall(('%s/%s\r\n' % (arg.rstrip('/'), name)).encode())
+                conn.close()
+                pasv.close()
+                self.send('226 Listing done')
+            elif cmd == 'RETR':
+                if not isfile(path) or missing_size is not None:
+                    self.send('550 No such file')
+                    continue
+                conn, _ = pasv.accept()
+                self.send('150 Sending')
+                with open(path, 'rb') as infile:
+                    infile.seek(rest)
+                    data = infile.read()
+                rest = 0
+                with server.lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    cut = server.cut.pop(basename(path), None)
+                try:
+                    if cut is not None:
+                        # A broken link: the data and the control connection both drop
+                        conn.sendall(data[:cut])
+                        conn.close()
+                        pasv.close()
+                        return
+                    for start in range(0, len(data), BLOCK_SIZE):
+                        conn.sendall(data[start:start + BLOCK_SIZE])
+                        time.sleep(server.delay)
+                    conn.close()
+                    pasv.close()
+                finally:
+                    with server.lock:
+                        server.active -= 1
+                self.send('226 Transfer complete')
+            else:
+                self.send('502 Command not implemented')
+
+
+class StandInFtpServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded stand-in FTP server (see the module docstring for the options)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root: str, no_mlsd: bool = False, no_rest: bool = False, cut: dict = None,
+                 missing: dict = None, missing_dir: str = '', delay: float = 0.0):
+        """
+        Init StandInFtpServer, on a free port of 127.0.0.1.
+        :param root: Local directory served as /
+        :param no_mlsd: Refuse MLSD
+        :param no_rest: Refuse REST
+        :param cut: Dictionary of file name to the bytes sent before its first transfer drops
+        :param missing: Dictionary of file name to the size listed for a file that gives 550 when fetched
+        :param missing_dir: Directory (relative to root) that lists the missing files
+        :param delay: Seconds to wait after each block sent
+        """
+        super().__init__(('127.0.0.1', 0), FtpHandler)
+        self.root = root
+        self.no_mlsd = no_mlsd
+        self.no_rest = no_rest
+        self.cut = dict(cut or {})
+        self.missing = dict(missing or {})
+        self.missing_dir = missing_dir.strip('/')
+        self.delay = delay
+        self.log = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def count(self, cmd: str) -> int:
+        """
+        Count the times a command was sent.
+        :param cmd: Command (upper case)
+        :return: Count
+        """
+        with self.lock:
+            return self.log.count(cmd)
+
+
+def start_server(root: str, **options) -> StandInFtpServer:
+    """
+    Start a stand-in server in a background thread.  Call shutdown() on it when done.
+    :param root: Local directory served as /
+    :param options: Options of StandInFtpServer
+    :return: StandInFtpServer
+    """
+    server = StandInFtpServer(root, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
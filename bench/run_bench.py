@@ -0,0 +1,318 @@
+"""
+Benchmark suite for the load and calculation steps, run on synthetic data.
+
+Run from the top directory of the project, for example:
+    python -m bench.run_bench --stations 200 --years 2003 2004 --out bench_results.json
+
+Each step runs on its own database in the work directory, in the order of main/load_steps.py, and the
+timings are written as JSON so that runs can be compared.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+from os.path import join
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import main.config as config
+import main.db as db
+import load.create_tables as create_tables
+import load.db_load as db_load
+import load.station_period as station_period
+from load.PrecipBatch import read_precip_batches
+from load.PrecipLine import PrecipLine
+import calc.coverage as coverage
+import fix.error_flag_fix as error_flag_fix
+import readdb.hourly as hourly
+from bench.synthetic import generate_files
+
+SCHEMA_VERSION = 1
+
+
+class BenchResults:
+    """
+    Timings collected during a run
+    """
+
+    def __init__(self, repeat: int = 1):
+        """
+        Init BenchResults.
+        :param repeat: Number of times to run the steps that can be repeated (the best time is kept)
+        """
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name: str, func, *args, rows: int = None, repeatable: bool = False, **kwargs):
+        """
+        Time a function call and record the result.
+        :param name: Step name
+        :param func: Function to time
+        :param args: Arguments for the function
+        :param rows: Number of rows handled, for the rate (if omitted, a numeric return value is used)
+        :param repeatable: The step leaves no state behind, so it may be run self.repeat times
+        :param kwargs: Keyword arguments for the function
+        :return: Return value of the last call
+        """
+        times = []
+        value = None
+        for i in range(self.repeat if repeatable else 1):
+            start = time.perf_counter()
+            value = func(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+        if rows is None and isinstance(value, (int, np.integer)):
+            rows = int(value)
+        seconds = min(times)
+        self.results.append({
+            'name': name,
+            'seconds': round(seconds, 6),
+            'runs': len(times),
+            'rows': rows,
+            'rows_per_sec': round(rows / seconds, 1) if rows and seconds > 0 else None,
+        })
+        print("%-32s %10.3f s" % (name, seconds))
+        return value
+
+
+def parse_lines(fnames: list) -> int:
+    """
+    Parse files line by line with PrecipLine.
+    :param fnames: Filenames
+    :return: Number of hourly readings
+    """
+    count = 0
+    for fname in fnames:
+        with open(fname, "r") as infile:
+            for line in infile:
+                count += len(PrecipLine(line).details)
+    return count
+
+
+def parse_batches(fnames: list) -> int:
+    """
+    Parse files in blocks with PrecipBatch.
+    :param fnames: Filenames
+    :return: Number of hourly readings
+    """
+    count = 0
+    for fname in fnames:
+        for batch in read_precip_batches(fname):
+            count += len(batch.h_line)
+    return count
+
+
+def load_raw(import_func, fnames: list, dbname) -> int:
+    """
+    Create the raw tables in a new database and load files into them.
+    :param import_func: Import function taking a filename and connection
+    :param fnames: Filenames
+    :param dbname: Database filename (replaced if it exists)
+    :return: Number of hourly rows
+    """
+    remove_db(dbname)
+    conn = db.connect(dbname=dbname)
+    create_tables.cr_tb_hr(conn)
+    create_tables.cr_tb_dr(conn)
+    for fname in fnames:
+        import_func(fname, conn)
+    count = conn.execute("SELECT COUNT(1) FROM hourly_raw").fetchone()[0]
+    conn.close()
+    return count
+
+
+def get_station_months(station_months: list) -> int:
+    """
+    Pull hourly data for a list of station-months with get_hourly.
+    :param station_months: List of (station, period)
+    :return: Number of rows returned
+    """
+    count = 0
+    for station, period in station_months:
+        count += len(hourly.get_hourly(station, period))
+    return count
+
+
+def calc_missing_each(df1: pd.DataFrame) -> int:
+    """
+    Run the reference calc_missing on each station-period.
+    :param df1: Hourly data from get_hourly
+    :return: Number of station-periods
+    """
+    count = 0
+    for (station, period), df_period in df1.groupby(['station', 'period']):
+        coverage.calc_missing(df_period, station, period)
+        count += 1
+    return count
+
+
+def remove_db(dbname):
+    """
+    Remove a database file and its WAL files.
+    :param dbname: Database filename
+    :return: None
+    """
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(dbname + suffix):
+            os.remove(dbname + suffix)
+
+
+def environment() -> dict:
+    """
+    Describe the system and versions the benchmark ran with.
+    :return: Dictionary
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'git_commit': commit,
+    }
+
+
+def run_suite(work_dir, n_stations: int = 100, years=(2003,), seed: int = 1, repeat: int = 3,
+              n_queries: int = 200, slow: bool = True) -> dict:
+    """
+    Generate synthetic data and time the load and calculation steps.
+    :param work_dir: Directory for the synthetic files and databases
+    :param n_stations: Number of stations
+    :param years: Years to generate
+    :param seed: Random seed (the same seed and size give the same data)
+    :param repeat: Number of runs for the steps that can be repeated
+    :param n_queries: Number of station-months to pull with get_hourly
+    :param slow: Include the line by line steps (import_precip_file, import_precip_file_df and calc_missing)
+    :return: Dictionary with the run details and results (as written to JSON)
+    """
+    years = [int(year) for year in years]
+    bench = BenchResults(repeat)
+    dbname = join(work_dir, "bench.sqlite")
+    save_dbname = config.sqldbname
+
+    fnames = bench.time('generate', generate_files, work_dir, n_stations, years, seed)
+    file_bytes = sum(os.path.getsize(fname) for fname in fnames)
+
+    # Parsing
+    if slow:
+        bench.time('parse_precip_line', parse_lines, fnames, repeatable=True)
+    bench.time('parse_precip_batch', parse_batches, fnames, repeatable=True)
+
+    # Loading the raw tables
+    if slow:
+        bench.time('import_precip_file', load_raw, db_load.import_precip_file, fnames, dbname)
+        bench.time('import_precip_file_df', load_raw, db_load.import_precip_file_df, fnames, dbname)
+    hour_cnt = bench.time('import_precip_file_np', load_raw, db_load.import_precip_file_np, fnames, dbname)
+
+    # The remaining steps use the shared connections, so point them at the benchmark database
+    db.close_all()
+    config.sqldbname = dbname
+    try:
+        conn = db.get_connection()
+        day_cnt = conn.execute("SELECT COUNT(1) FROM daily_raw").fetchone()[0]
+
+        bench.time('add_indexes_hr_dr', create_tables.add_indexes_hr_dr, conn, rows=hour_cnt)
+
+        create_tables.cr_tb_s_period_d(conn)
+        create_tables.cr_tb_s_period_h(conn)
+        bench.time('load_station_period_d', station_period.load_station_period_d, rows=day_cnt)
+        bench.time('load_station_period_h', station_period.load_station_period_h, rows=hour_cnt)
+
+        bench.time('find_mismatches', error_flag_fix.find_mismatches, conn, rows=hour_cnt)
+
+        start_period = "%d-01" % min(years)
+        end_period = "%d-12" % max(years)
+        df1 = bench.time('get_hourly_all', hourly.get_hourly, '000000', start_period, '999999', end_period,
+                         rows=hour_cnt, repeatable=True)
+        bench.time('calc_missing_all', coverage.calc_missing_all, df1, rows=hour_cnt, repeatable=True)
+        if slow:
+            bench.time('calc_missing', calc_missing_each, df1, rows=hour_cnt)
+        del df1
+
+        create_tables.cr_tb_period_coverage(conn)
+        bench.time('calc_over_range', coverage.calc_over_range, '000000', start_period, '999999', end_period,
+                   rows=hour_cnt)
+
+        querystr = "SELECT DISTINCT station, period FROM hourly_raw ORDER BY station, period"
+        station_months = conn.execute(querystr).fetchall()
+        rnd = np.random.default_rng(seed)
+        picks = rnd.choice(len(station_months), size=min(n_queries, len(station_months)), replace=False)
+        sample = [station_months[i] for i in sorted(picks.tolist())]
+        bench.time('get_hourly_station_month', get_station_months, sample, repeatable=True)
+    finally:
+        db.close_all()
+        config.sqldbname = save_dbname
+
+    return {
+        'schema_version': SCHEMA_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'environment': environment(),
+        'parameters': {
+            'stations': n_stations,
+            'years': years,
+            'seed': seed,
+            'repeat': repeat,
+            'queries': n_queries,
+            'slow': slow,
+        },
+        'data': {
+            'files': len(fnames),
+            'file_bytes': file_bytes,
+            'daily_rows': day_cnt,
+            'hourly_rows': hour_cnt,
+        },
+        'results': bench.results,
+    }
+
+
+def main(argv=None):
+    """
+    Run the benchmark suite from the command line.
+    :param argv: Arguments (defaults to sys.argv)
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description="Time the precipitation load and calculation steps on synthetic data")
+    parser.add_argument("--stations", type=int, default=100, help="number of stations (default 100)")
+    parser.add_argument("--years", type=int, nargs="+", default=[2003], help="years to generate (default 2003)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the repeatable steps (default 3)")
+    parser.add_argument("--queries", type=int, default=200, help="station-months for get_hourly (default 200)")
+    parser.add_argument("--fast", action="store_true", help="skip the line by line steps")
+    parser.add_argument("--work-dir", help="directory for the data (default: a temporary directory)")
+    parser.add_argument("--out", help="JSON output file (default: print to stdout)")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="precip_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        report = run_suite(work_dir, args.stations, args.years, args.seed, args.repeat, args.queries, not args.fast)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as outfile:
+            outfile.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Generate synthetic DSI 3240 hourly precipitation files for benchmarks.
+
+The lines follow the layout in dsi3240.pdf, one line per station-day, and the data has the features the
+later steps look for: short rain events, accumulation periods ('a' ... 'A'), missing periods ('[' ... ']'),
+deleted periods ('{' ... '}'), single hour 'Q'/'q' flags, and an 'A' with 'Q' (an accumulation that can't
+be used).  Periods may run over several days but close within the month, as in the real files.  Days with
+flags get 'I' or 'P' in the daily total, except for a small share left unflagged for error_flag_fix to find.
+"""
+
+import calendar
+from os.path import join
+import random
+
+# Value for an hour with no amount (start of an accumulation, missing or deleted hours)
+MISSING_AMOUNT = 99999
+
+# Relative frequency of each kind of event
+EVENT_WEIGHTS = {
+    'rain': 80,
+    'accum': 6,
+    'missing': 5,
+    'deleted': 1,
+    'flag_q': 8,
+}
+
+
+def make_line(station: str, units: str, year: int, month: int, day: int, readings: list,
+              daily_flag1: str = ' ', daily_flag2: str = ' ') -> str:
+    """
+    Build one DSI 3240 line.
+    :param station: Station id (6 digits, starting with the state code)
+    :param units: Units code (HI or HT)
+    :param year: Year
+    :param month: Month
+    :param day: Day
+    :param readings: List of (read_hour as HHMM integer, amount, flag1, flag2) in hour order
+    :param daily_flag1: Flag 1 for the daily total
+    :param daily_flag2: Flag 2 for the daily total
+    :return: Line without the line break
+    """
+    total = sum(amt for hr, amt, f1, f2 in readings if amt != MISSING_AMOUNT)
+    parts = ["HPD", station, "00HPCP", units, "%04d%02d00%02d" % (year, month, day), "%03d" % (len(readings) + 1)]
+    for hr, amt, f1, f2 in readings:
+        parts.append("%04d%06d%s%s" % (hr, amt, f1, f2))
+    parts.append("2500%06d%s%s" % (total, daily_flag1, daily_flag2))
+    return "".join(parts)
+
+
+def station_month_lines(rnd: random.Random, station: str, units: str, year: int, month: int,
+                        event_gap: float = 40.0, unflagged: float = 0.05) -> list:
+    """
+    Generate the lines for one station-month.
+    :param rnd: Random number generator
+    :param station: Station id
+    :param units: Units code
+    :param year: Year
+    :param month: Month
+    :param event_gap: Mean number of hours between events
+    :param unflagged: Share of days with flags that are not flagged in the daily total
+    :return: List of lines in date order
+    """
+    n_hours = calendar.monthrange(year, month)[1] * 24
+    kinds = list(EVENT_WEIGHTS)
+    weights = list(EVENT_WEIGHTS.values())
+
+    # Readings as (hour index in month, amount, flag1, flag2)
+    readings = []
+    hour = int(rnd.expovariate(1.0 / event_gap))
+    while hour < n_hours:
+        kind = rnd.choices(kinds, weights)[0]
+        if kind == 'rain':
+            length = min(rnd.randint(1, 6), n_hours - hour)
+            for i in range(length):
+                flag2 = 'q' if rnd.random() < 0.01 else ' '
+                readings.append((hour + i, rnd.randint(1, 40), ' ', flag2))
+        elif kind == 'flag_q':
+            length = 1
+            readings.append((hour, rnd.randint(0, 20), ' ', 'Q'))
+        else:
+            length = min(rnd.randint(2, 72), n_hours - hour)
+            if length < 2:
+                break
+            end = hour + length - 1
+            if kind == 'accum':
+                readings.append((hour, MISSING_AMOUNT, 'a', ' '))
+                readings.append((end, rnd.randint(1, 200), 'A', 'Q' if rnd.random() < 0.1 else ' '))
+            elif kind == 'missing':
+                readings.append((hour, MISSING_AMOUNT, '[', ' '))
+                readings.append((end, MISSING_AMOUNT, ']', ' '))
+            else:
+                readings.append((hour, MISSING_AMOUNT, '{', ' '))
+                readings.append((end, MISSING_AMOUNT, '}', ' '))
+        hour += length + 1 + int(rnd.expovariate(1.0 / event_gap))
+
+    # Group by day.  There is always a line for the first day of the month, so give it a zero reading if needed.
+    days = {1: [(100, 0, ' ', ' ')]} if not readings or readings[0][0] >= 24 else {}
+    for idx, amt, f1, f2 in readings:
+        days.setdefault(idx // 24 + 1, []).append(((idx % 24 + 1) * 100, amt, f1, f2))
+
+    lines = []
+    for day, day_readings in sorted(days.items()):
+        flags1 = {r[2] for r in day_readings}
+        flags2 = {r[3] for r in day_readings}
+        daily_flag1 = ' '
+        if flags1 & {'a', 'A'}:
+            daily_flag1 = 'P'
+        elif flags1 & {'[', ']', '{', '}'} or flags2 & {'Q', 'q'}:
+            daily_flag1 = 'I'
+        if daily_flag1 != ' ' and rnd.random() < unflagged:
+            daily_flag1 = ' '
+        lines.append(make_line(station, units, year, month, day, day_readings, daily_flag1))
+
+    return lines
+
+
+def station_ids(rnd: random.Random, n_stations: int) -> list:
+    """
+    Pick distinct station ids spread over the state codes.
+    :param rnd: Random number generator
+    :param n_stations: Number of stations
+    :return: Sorted list of station ids
+    """
+    ids = set()
+    while len(ids) < n_stations:
+        ids.add("%02d%04d" % (rnd.randint(1, 91), rnd.randint(0, 9999)))
+    return sorted(ids)
+
+
+def generate_year(fname, year: int, stations: list, seed: int = 1) -> int:
+    """
+    Write one yearly file with all stations, ordered by station and date like the extracted state-year archives.
+    :param fname: Output filename
+    :param year: Year
+    :param stations: List of (station id, units code)
+    :param seed: Random seed
+    :return: Number of lines written
+    """
+    rnd = random.Random("%d-%d" % (seed, year))
+    n_lines = 0
+    with open(fname, "w", newline="\n") as outfile:
+        for station, units in stations:
+            for month in range(1, 13):
+                lines = station_month_lines(rnd, station, units, year, month)
+                if lines:
+                    outfile.write("\n".join(lines))
+                    outfile.write("\n")
+                    n_lines += len(lines)
+    return n_lines
+
+
+def generate_files(out_dir, n_stations: int = 100, years=(2003,), seed: int = 1) -> list:
+    """
+    Write one synthetic file per year (named like the extracted yearly files, e.g. 2003.txt).
+    About 1 station in 20 has HT units; the rest have HI.
+    :param out_dir: Output directory
+    :param n_stations: Number of stations
+    :param years: Years to generate
+    :param seed: Random seed
+    :return: List of filenames
+    """
+    rnd = random.Random(seed)
+    stations = [(station, 'HT' if rnd.random() < 0.05 else 'HI') for station in station_ids(rnd, n_stations)]
+
+    fnames = []
+    for year in years:
+        fname = join(out_dir, "%d.txt" % year)
+        generate_year(fname, year, stations, seed)
+        fnames.append(fname)
+    return fnames
@@ -1,20 +1,38 @@
 """
 Calculate coverage for station periods
+
+This reads hourly_raw, not the flag summary (load/flag_summary.py).  The missing hours of an accumulation are the
+hours between its start and end flags, which may be on different days, so they need the time of each flag in order;
+the summary only has the count of each flag per station-day and station-period.
 """
 
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+
 from main.config import *
+import main.db as db
+import numpy as np
 import pandas as pd
 import readdb.hourly as hourly
 import sqlite3
 
+# Flags that start and end an accumulation (or missing) period
+ACCUM_START = ['a', '[', '{']
+ACCUM_END = ['A', ']', '}']
+# Approximate memory use of one row of hourly data in a DataFrame, used to size the shards
+HOURLY_ROW_BYTES = 400
+
 
-def calc_over_range(start_station: str, start_period: str, end_station: str = None, end_period: str = None):
+def calc_over_range(start_station: str, start_period: str, end_station: str = None, end_period: str = None,
+                    chunk_rows: int = 500000):
     """
     Perform coverage calculation over a range of station-periods, saving results to SQL table.
+    The hourly data is streamed in chunks of whole station-periods, so memory use does not grow with the range.
     :param start_station:
     :param start_period:
     :param end_station: If omitted, only one station will be used.
     :param end_period: If omitted, only one period will be used.
+    :param chunk_rows: Approximate number of hourly rows held at once
     :return: None
     """
 
@@ -24,27 +42,214 @@ def calc_over_range(start_station: str, start_period: str, end_station: str = No
     if end_period is None:
         end_period = start_period
 
-    # Init
-    period_list = []
+    # Pull data and run calc for all station-periods in each chunk at once
+    results = []
+    for df1 in hourly.iter_hourly(start_station, start_period, end_station, end_period, chunk_rows):
+        results.append(calc_missing_all(df1))
+    if len(results) == 0:
+        return
 
-    # Pull data
-    df1 = hourly.get_hourly(start_station, start_period, end_station, end_period)
+    # Add records to SQL (after the read has finished, since sqlite will not write during it)
+    save_period_list(pd.concat(results, ignore_index=True))
+
+
+def calc_missing_all(df1: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calculate missing hours for every station-period in a DataFrame at once.
+    This gives the same results and messages as running calc_missing on each station-period, but
+    works on arrays.  The accumulation flags are paired by looking at the previous flag event in the
+    same station-period: a start that follows a start is a duplicate, and an end that does not follow
+    a start has no start.  The one difference is an end flag ']' or '}' with no start, which made
+    calc_missing fail; here it is reported as a missing start and counts no hours.
+    :param df1: Hourly data sorted by station, period, read_date and read_hour (as from get_hourly)
+    :return: DataFrame with station, period, missing_hours and units_flag
+    """
+    station = df1['station'].to_numpy()
+    period = df1['period'].to_numpy()
+    read_date = df1['read_date'].to_numpy(dtype=np.int64)
+    read_hour = df1['read_hour'].to_numpy(dtype=np.int64)
+    flag1 = df1['flag1'].to_numpy()
+    flag2 = df1['flag2'].to_numpy()
+    is_start = df1['flag1'].isin(ACCUM_START).to_numpy()
+    is_end = df1['flag1'].isin(ACCUM_END).to_numpy()
+    is_q = df1['flag2'].isin(['Q', 'q']).to_numpy()
+
+    # Number the station-periods
+    new_group = np.ones(len(df1), dtype=bool)
+    new_group[1:] = (station[1:] != station[:-1]) | (period[1:] != period[:-1])
+    group = np.cumsum(new_group) - 1
+    first_rows = np.flatnonzero(new_group)
+    n_groups = len(first_rows)
+
+    # Single missing hours (Q only counts on its own when not at the end of an accumulation)
+    single = ~is_start & ~is_end & is_q
+    missing_hours = np.bincount(group[single], minlength=n_groups)
+
+    # Accumulation start/end events, in order within each station-period
+    events = np.flatnonzero(is_start | is_end)
+    ev_start = is_start[events]
+    ev_group = group[events]
+    ev_index = np.arange(len(events))
+
+    first_event = np.ones(len(events), dtype=bool)
+    first_event[1:] = ev_group[1:] != ev_group[:-1]
+    prev_start = np.zeros(len(events), dtype=bool)
+    prev_start[1:] = ev_start[:-1]
+    open_before = ~first_event & prev_start
+
+    # Print the same messages as calc_missing, in row order
+    for k in np.flatnonzero(ev_start == open_before).tolist():
+        row = events[k]
+        msg = 'Duplicate start in %s %s' if ev_start[k] else 'Missing start in %s %s'
+        print(msg % (station[row], period[row]))
+
+    # Each closing event pairs with the first start of the run of starts just before it
+    run_break = first_event | (ev_start != prev_start)
+    run_first = np.maximum.accumulate(np.where(run_break, ev_index, 0))
+    closing = np.flatnonzero(~ev_start & open_before)
+    ends = events[closing]
+    starts = events[run_first[closing - 1]]
+
+    # 'A' ends an accumulation with nothing missing unless it is also flagged 'Q'
+    counted = (flag1[ends] != 'A') | (flag2[ends] == 'Q')
+    ends = ends[counted]
+    starts = starts[counted]
+    hours = (read_date[ends] - read_date[starts]) * 24 + (read_hour[ends] - read_hour[starts]) // 100 + 1
+    missing_hours += np.bincount(group[ends], weights=hours, minlength=n_groups).astype(np.int64)
+
+    units = np.minimum.reduceat(df1['units'].to_numpy(dtype=object), first_rows) if n_groups > 0 else first_rows
+
+    return pd.DataFrame({
+        'station': station[first_rows],
+        'period': period[first_rows],
+        'missing_hours': missing_hours,
+        'units_flag': np.where(units == 'HI', 1, 2),
+    })
+
+
+def calc_over_range_parallel(start_station: str, start_period: str, end_station: str, end_period: str,
+                             workers: int = None, worker_mb: int = None, save_rows: int = 50000):
+    """
+    Perform coverage calculation over a range of station-periods in a process pool, saving results to SQL table.
+    The range is split into shards of whole station-periods sized so that each worker's DataFrame
+    stays under worker_mb.  Results are saved in batches through one connection.
+    When run as a script on Windows, call this under "if __name__ == '__main__':".
+    :param start_station:
+    :param start_period:
+    :param end_station:
+    :param end_period:
+    :param workers: Number of processes (defaults to coverage_workers in config, then all cores)
+    :param worker_mb: Approximate memory limit per worker in MB (defaults to coverage_worker_mb in config)
+    :param save_rows: Number of result rows to collect before each save
+    :return: None
+    """
+    if workers is None:
+        workers = coverage_workers or os.cpu_count()
+    if worker_mb is None:
+        worker_mb = coverage_worker_mb
+
+    conn: sqlite3.Connection = db.get_connection()
+    shards = plan_shards(start_station, start_period, end_station, end_period,
+                         worker_mb * 1024 * 1024 // HOURLY_ROW_BYTES, conn)
+
+    results = []
+    result_rows = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Only as many shards in flight as there are workers, to keep the memory bound
+        pending = set()
+        shard_iter = iter(shards)
+        for shard in shard_iter:
+            pending.add(pool.submit(calc_shard, *shard))
+            if len(pending) >= workers:
+                break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                df_periods = future.result()
+                if len(df_periods) > 0:
+                    results.append(df_periods)
+                    result_rows += len(df_periods)
+                shard = next(shard_iter, None)
+                if shard is not None:
+                    pending.add(pool.submit(calc_shard, *shard))
+            if result_rows >= save_rows:
+                save_period_list(pd.concat(results, ignore_index=True), conn)
+                results = []
+                result_rows = 0
+
+    if results:
+        save_period_list(pd.concat(results, ignore_index=True), conn)
+
+
+def plan_shards(start_station: str, start_period: str, end_station: str, end_period: str, max_rows: int,
+                conn: sqlite3.Connection) -> list:
+    """
+    Split a station-period range into shards of at most max_rows hourly rows.
+    Consecutive periods are combined while they fit; a period that is too big on its own is
+    split into station ranges.  A station-period is never split.
+    :param start_station:
+    :param start_period:
+    :param end_station:
+    :param end_period:
+    :param max_rows: Row limit per shard
+    :param conn: DB connection
+    :return: List of (start_station, start_period, end_station, end_period)
+    """
+    querystr = '''
+        SELECT period, station, COUNT(1) AS cnt
+        FROM hourly_raw
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        GROUP BY period, station
+        ORDER BY period, station
+    '''
+    df_cnt = pd.read_sql_query(querystr, conn, params=[start_station, end_station, start_period, end_period])
+
+    shards = []
+    # Periods waiting to be combined into one shard
+    open_start = None
+    open_end = None
+    open_rows = 0
+    for period, group in df_cnt.groupby('period', sort=True):
+        period_rows = int(group['cnt'].sum())
+        if open_start is not None and open_rows + period_rows > max_rows:
+            shards.append((start_station, open_start, end_station, open_end))
+            open_start = None
+            open_rows = 0
+        if period_rows <= max_rows:
+            if open_start is None:
+                open_start = period
+            open_end = period
+            open_rows += period_rows
+            continue
+
+        # Split a large period by station
+        stations = group['station'].to_numpy()
+        cum_rows = group['cnt'].cumsum().to_numpy()
+        first = 0
+        while first < len(stations):
+            base = cum_rows[first - 1] if first > 0 else 0
+            last = max(int(np.searchsorted(cum_rows, base + max_rows, side='right')) - 1, first)
+            shards.append((stations[first], period, stations[last], period))
+            first = last + 1
 
-    # Separate by station-period
-    gb1 = df1.groupby(['station', 'period'])
+    if open_start is not None:
+        shards.append((start_station, open_start, end_station, open_end))
 
-    # Run calc for each section, creating record for results
-    for name, group in gb1:
-        # Group init
-        station, period = name
-        missing_hours = calc_missing(group, station, period)
-        units = group['units'].min()
-        unit_flag = 1 if units == 'HI' else 2
+    return shards
 
-        period_list.append([station, period, missing_hours, unit_flag])
 
-    # Add records to SQL
-    save_period_list(period_list)
+def calc_shard(start_station: str, start_period: str, end_station: str, end_period: str) -> pd.DataFrame:
+    """
+    Coverage calculation for one shard (runs in the worker processes).
+    :param start_station:
+    :param start_period:
+    :param end_station:
+    :param end_period:
+    :return: DataFrame from calc_missing_all
+    """
+    df1 = hourly.get_hourly(start_station, start_period, end_station, end_period)
+    return calc_missing_all(df1)
 
 
 def calc_missing(df_period: pd.DataFrame, station: str, period: str) -> int:
@@ -101,10 +306,11 @@ def calc_missing(df_period: pd.DataFrame, station: str, period: str) -> int:
     return missing_hours
 
 
-def save_period_list(list1: list):
+def save_period_list(list1: list, conn: sqlite3.Connection = None):
     """
     Save a period list to SQL (internal use only).
-    :param list1: The list of periods.
+    :param list1: The list of periods (a list of lists or a DataFrame with the same columns).
+    :param conn: DB connection to use (if omitted, the shared connection is used)
     :return: None
     """
     df1 = pd.DataFrame(list1)
@@ -129,11 +335,11 @@ def save_period_list(list1: list):
     df1.loc[df1['coverage'] == 0.0, 'cov_flag'] = 'M'
 
     # Save to SQL
-    conn: sqlite3.Connection = sqlite3.connect(sqldbname)
+    if conn is None:
+        conn = db.get_connection()
     # df1.to_sql('station_period_coverage', conn, if_exists='append', index=False, method='multi', chunksize=1000)
     df1.to_sql('station_period_coverage', conn, if_exists='append', index=False, chunksize=1000)
     conn.commit()
-    conn.close()
 
     # # Test line
     # print(df1)
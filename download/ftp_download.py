@@ -0,0 +1,328 @@
+"""
+Concurrent, resumable download of the yearly files by state from the hourly_precip-3240 FTP archive
+
+The archive is listed once (the state directories, then each of them) rather than probed file by file, and the files
+are downloaded by a pool of threads with one FTP session each:
+    - a file whose local size matches the listing is skipped
+    - a file is written to <name>.part and renamed when it is complete, so an interrupted transfer resumes where it
+      stopped (REST) on the next try or the next run
+    - a session that fails is closed, and the file is tried again on a new one, up to ftp_retries times
+The totals and throughput are printed at the end and returned in DownloadStats.
+
+The host, port and directory default to config.py but can be passed in, to point it at a local FTP server for
+testing.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import ftplib
+import os
+from os.path import basename, exists, getsize, join
+import re
+import threading
+import time
+
+import main.config as config
+
+# Yearly files by state, such as 3240_01_1999-1999.tar.Z
+YEAR_FILE_RE = re.compile(r"^3240_(\d{2})_(\d{4})-(\d{4})\.tar\.Z$")
+STATE_DIR_RE = re.compile(r"^\d{2}$")
+
+BLOCK_SIZE = 1 << 16
+TIMEOUT_SEC = 60
+
+
+class DownloadStats:
+    """
+    Totals for a download run (shared by the threads)
+    """
+
+    def __init__(self):
+        """
+        Init DownloadStats.
+        """
+        self.listed = 0
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.wall_sec = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_bytes(self, nbytes: int):
+        """
+        Count bytes received.
+        :param nbytes: Number of bytes
+        :return: None
+        """
+        with self._lock:
+            self.bytes += nbytes
+
+    def add_file(self, skipped: bool = False):
+        """
+        Count a file that was downloaded or skipped.
+        :param skipped: True if the file was already there
+        :return: None
+        """
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+            else:
+                self.downloaded += 1
+
+    def add_failure(self, remote: str, error: Exception):
+        """
+        Record a file that could not be downloaded.
+        :param remote: Remote path
+        :param error: Last error
+        :return: None
+        """
+        with self._lock:
+            self.failed.append((remote, str(error)))
+
+    def finish(self):
+        """
+        Stop the clock.
+        :return: None
+        """
+        self.wall_sec = time.perf_counter() - self._start
+
+    def mb_per_sec(self) -> float:
+        """
+        Throughput of the transfers.
+        :return: MB per second over the whole run
+        """
+        return self.bytes / 1e6 / self.wall_sec if self.wall_sec else 0.0
+
+    def report(self) -> str:
+        """
+        Summary of the run.
+        :return: Text for printing
+        """
+        return ("Listed %d files: downloaded %d, skipped %d, failed %d.  %.1f MB in %.1f seconds (%.2f MB/s)"
+                % (self.listed, self.downloaded, self.skipped, len(self.failed), self.bytes / 1e6,
+                   self.wall_sec or 0.0, self.mb_per_sec()))
+
+
+class FtpSessions:
+    """
+    One FTP session per thread, opened when the thread first needs it
+    """
+
+    def __init__(self, host: str, port: int, user: str = '', passwd: str = '', timeout: float = TIMEOUT_SEC):
+        """
+        Init FtpSessions.
+        :param host: FTP host
+        :param port: FTP port
+        :param user: User name (anonymous if empty)
+        :param passwd: Password
+        :param timeout: Socket timeout in seconds
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def get(self) -> ftplib.FTP:
+        """
+        Get the session of this thread, opening it if needed.
+        :return: Logged in FTP session in binary mode
+        """
+        ftp = getattr(self._local, 'ftp', None)
+        if ftp is None:
+            ftp = ftplib.FTP(timeout=self.timeout)
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.passwd)
+            # Binary mode, for SIZE and REST
+            ftp.voidcmd('TYPE I')
+            self._local.ftp = ftp
+            with self._lock:
+                self._all.append(ftp)
+        return ftp
+
+    def discard(self):
+        """
+        Close the session of this thread after an error, so that the next get opens a new one.
+        :return: None
+        """
+        ftp = getattr(self._local, 'ftp', None)
+        self._local.ftp = None
+        if ftp is not None:
+            with self._lock:
+                self._all.remove(ftp)
+            ftp.close()
+
+    def close_all(self):
+        """
+        Close all of the sessions.
+        :return: None
+        """
+        with self._lock:
+            for ftp in self._all:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+            self._all = []
+
+
+def list_dir(ftp: ftplib.FTP, path: str) -> list:
+    """
+    List a directory, with MLSD if the server has it or else NLST.
+    :param ftp: FTP session
+    :param path: Directory
+    :return: List of (name, is_dir, size), with None where the listing does not say
+    """
+    try:
+        entries = []
+        for name, facts in ftp.mlsd(path, facts=['type', 'size']):
+            if facts.get('type') in ('cdir', 'pdir'):
+                continue
+            size = int(facts['size']) if 'size' in facts else None
+            entries.append((name, facts.get('type') == 'dir', size))
+        return entries
+    except ftplib.error_perm:
+        return [(basename(name.rstrip('/')), None, None) for name in ftp.nlst(path)]
+
+
+def list_state(sessions: FtpSessions, path: str, first_year: int, last_year: int) -> list:
+    """
+    List the yearly files of one state directory (internal use only).
+    :param sessions: FTP sessions
+    :param path: State directory
+    :param first_year: First year to download
+    :param last_year: Last year to download
+    :return: List of (remote path, size)
+    """
+    ftp = sessions.get()
+    files = []
+    for name, is_dir, size in list_dir(ftp, path):
+        match = YEAR_FILE_RE.match(name)
+        if is_dir or match is None or match.group(2) != match.group(3):
+            continue
+        if first_year <= int(match.group(2)) <= last_year:
+            remote = path + '/' + name
+            if size is None:
+                size = ftp.size(remote)
+            files.append((remote, size))
+    return files
+
+
+def list_archive(sessions: FtpSessions, executor: ThreadPoolExecutor, root: str, first_year: int,
+                 last_year: int) -> list:
+    """
+    List the yearly files in the archive.  The state directories are listed in parallel.
+    :param sessions: FTP sessions
+    :param executor: Thread pool
+    :param root: Archive directory
+    :param first_year: First year to download
+    :param last_year: Last year to download
+    :return: List of (remote path, size), sorted by path
+    """
+    entries = list_dir(sessions.get(), root)
+    states = [root.rstrip('/') + '/' + name for name, is_dir, size in entries
+              if is_dir is not False and STATE_DIR_RE.match(name)]
+    listings = executor.map(lambda path: list_state(sessions, path, first_year, last_year), states)
+    return sorted(remote for listing in listings for remote in listing)
+
+
+def download_file(sessions: FtpSessions, remote: str, size: int, dest_dir: str, retries: int,
+                  stats: DownloadStats):
+    """
+    Download one file, unless it is already there, resuming any earlier partial download.
+    :param sessions: FTP sessions
+    :param remote: Remote path
+    :param size: Remote size (None if unknown)
+    :param dest_dir: Local directory
+    :param retries: Tries before giving up on the file
+    :param stats: Totals to add to
+    :return: Local filename, or None if the download failed
+    """
+    local = join(dest_dir, basename(remote))
+    if exists(local) and (size is None or getsize(local) == size):
+        stats.add_file(skipped=True)
+        return local
+
+    part = local + '.part'
+    error = None
+    for attempt in range(retries):
+        offset = getsize(part) if exists(part) else 0
+        if size is not None and offset > size:
+            offset = 0
+        try:
+            ftp = sessions.get()
+            with open(part, 'ab' if offset else 'wb') as outfile:
+                def write(block):
+                    outfile.write(block)
+                    stats.add_bytes(len(block))
+                ftp.retrbinary("RETR " + remote, write, BLOCK_SIZE, rest=offset or None)
+            if size is not None and getsize(part) != size:
+                raise ftplib.error_temp("Transfer of %s stopped at %d of %d bytes" % (remote, getsize(part), size))
+            os.replace(part, local)
+            stats.add_file()
+            print("Pulled " + basename(remote))
+            return local
+        except ftplib.all_errors as e:
+            error = e
+            sessions.discard()
+            if isinstance(e, ftplib.error_perm):
+                # A server that refuses REST gets the whole file on the next try, but a permanent error without
+                # REST (such as 550 for a missing file) will not go away, so that file is given up
+                if exists(part):
+                    os.remove(part)
+                if not offset:
+                    break
+
+    # Keep a partial file for the next run to resume, but not an empty one
+    if exists(part) and getsize(part) == 0:
+        os.remove(part)
+    stats.add_failure(remote, error)
+    print("Failed %s: %s" % (basename(remote), error))
+    return None
+
+
+def download_archive(dest_dir: str = None, first_year: int = None, last_year: int = None, n_sessions: int = None,
+                     host: str = None, port: int = None, root: str = None, user: str = '', passwd: str = '',
+                     retries: int = None) -> DownloadStats:
+    """
+    Download the yearly files by state that are not already in dest_dir.
+    :param dest_dir: Local directory (default orig_data_dir)
+    :param first_year: First year (default first_year in config.py)
+    :param last_year: Last year (default last_year in config.py; the yearly files end with 2011)
+    :param n_sessions: Number of FTP sessions at once (default ftp_sessions)
+    :param host: FTP host (default ftp_host)
+    :param port: FTP port (default ftp_port)
+    :param root: Archive directory (default ftp_dir)
+    :param user: User name (anonymous if empty)
+    :param passwd: Password
+    :param retries: Tries per file (default ftp_retries)
+    :return: DownloadStats
+    """
+    dest_dir = config.orig_data_dir if dest_dir is None else dest_dir
+    first_year = config.first_year if first_year is None else first_year
+    last_year = config.last_year if last_year is None else last_year
+    n_sessions = config.ftp_sessions if n_sessions is None else n_sessions
+    retries = config.ftp_retries if retries is None else retries
+
+    stats = DownloadStats()
+    sessions = FtpSessions(config.ftp_host if host is None else host, config.ftp_port if port is None else port,
+                           user, passwd)
+    try:
+        with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+            files = list_archive(sessions, executor, config.ftp_dir if root is None else root, first_year,
+                                 last_year)
+            stats.listed = len(files)
+            # Largest first, so that a big file does not start last
+            files.sort(key=lambda file: -(file[1] or 0))
+            list(executor.map(lambda file: download_file(sessions, file[0], file[1], dest_dir, retries, stats),
+                              files))
+    finally:
+        sessions.close_all()
+
+    stats.finish()
+    print(stats.report())
+    return stats
@@ -1,173 +1,174 @@
 """
 Logic to find and fix missing error flags in daily records
+
+A day is missing its error flag when its daily total is not flagged 'I' or 'P', but its hours show one of:
+    F   a missing, deleted or questionable hour ('[', ']', '{', '}', 'Q' or 'q')
+    O   an odd number of accumulation flags ('a' or 'A'), so an accumulation period starts or ends on another day
+    E   an even number of accumulation flags, but the first one is the end of a period ('A')
+A day may have more than one of these.
+
+All three are found in one ordered pass over the station-days: from flag_summary_day (load/flag_summary.py) when it
+is complete, since it was counted during the load, or else from one grouped scan of hourly_raw in key order.
 """
 
 # from main.config import *
+import load.flag_summary as flag_summary
 import sqlite3
 
+MISMATCH_FLAGS = ['F', 'O', 'E']
 
-def find_error_dates(conn: sqlite3.Connection):
-    """
-    Find error dates from raw data.
-    This finds dates based on the daily file and runs several passes on hourly data
-    to find various flags and conditions there.
-    :param conn:
-    :return:
-    """
-
-    curr = conn.cursor()
-
-    # Daily
-    querystr = '''
-        CREATE TABLE error_days_d AS
-        SELECT DISTINCT station, read_date
-        FROM daily_raw dr 
-        WHERE flag1 IN ('I','P')
-    '''
-    curr.execute(querystr)
-
-    querystr = '''
-        CREATE INDEX edd_idx
-        ON error_days_d
-            (station, read_date)
-    '''
-    curr.execute(querystr)
-
-    # Hourly
-
-    # Based on simple flags
-
-    querystr = '''
-        CREATE TABLE error_days_h AS
-        SELECT DISTINCT station, read_date
-        FROM hourly_raw hr 
-        WHERE flag1 IN ('[',']','{','}')
-        OR flag2 IN ('Q','q')
-    '''
-    curr.execute(querystr)
-
-    querystr = '''
-        CREATE INDEX edh_idx
-        ON error_days_h
-            (station, read_date)
-    '''
-    curr.execute(querystr)
-
-    # Based on accumulation flags
-
-    querystr = '''
-        CREATE TABLE error_days_ha AS
-        SELECT station, read_date, COUNT(1) AS count1
-        FROM hourly_raw hr 
-        WHERE flag1 in ('a', 'A')
-        GROUP BY station, read_date 
-    '''
-    curr.execute(querystr)
-
-    querystr = '''
-        CREATE INDEX edha_idx
-        ON error_days_ha
-            (station, read_date)
-    '''
-    curr.execute(querystr)
-
-    conn.commit()
+# Rows that can make a day need a flag.  The partial index hr_error_rows (load/indexes.py) uses the same text for the
+# hours, since SQLite only uses a partial index when the query has its WHERE term.
+DAILY_ERROR_ROWS = "flag1 IN ('I','P')"
+HOURLY_ERROR_ROWS = "flag1 IN ('a','A','[',']','{','}') OR flag2 IN ('Q','q')"
 
 
-def find_mismatches(conn: sqlite3.Connection):
+def day_counts_select(conn: sqlite3.Connection, use_summary: bool = None, periods_table: str = None) -> str:
     """
-    Use the list of days with error to find days that are missing flags.
+    Build the query for the error and accumulation counts of each station-day whose daily total is not flagged
+    (internal use only).
     :param conn: DB Connection
-    :return: None
+    :param use_summary: Read flag_summary_day (default: if it is complete) rather than the raw tables
+    :param periods_table: Table with the station and period of the station-periods to check (default all)
+    :return: SQL text giving station, read_date, n_error, n_accum and first_accum
     """
-
-    curr = conn.cursor()
-
-    # All dates in hourly list based on simple flags
-
-    querystr = '''
-        CREATE TABLE error_days_miss AS
-        SELECT station, read_date, 'F' AS flag
-        FROM error_days_h edh
-        WHERE NOT EXISTS (
-            SELECT 1
-            FROM error_days_d edd
-            WHERE edd.station = edh.station
-            AND edd.read_date = edh.read_date
-        )
-    '''
-    curr.execute(querystr)
-
-    # Accums with an odd number of hours with flags
-    # If all periods stopped and started on the same day, the number would be even.
-
-    querystr = '''
-        INSERT INTO error_days_miss
-        SELECT station, read_date, 'O'
-        FROM error_days_ha edha
+    if use_summary is None:
+        use_summary = flag_summary.flag_summary_complete(conn)
+    periods_where = ''
+    if use_summary:
+        if periods_table is not None:
+            periods_where = '''
+            AND (station, period) IN (
+                SELECT station, period
+                FROM %s
+            )''' % periods_table
+        return '''
+            SELECT station,
+                read_date,
+                n_missing_start + n_missing_end + n_deleted_start + n_deleted_end + n_q_upper + n_q_lower AS n_error,
+                n_accum_start + n_accum_end AS n_accum,
+                first_accum
+            FROM flag_summary_day
+            WHERE COALESCE(daily_flag1, '') NOT IN ('I','P')%s
+        ''' % periods_where
+
+    # Only the flagged hours are grouped, since the others add nothing to the counts.  The first accumulation flag
+    # of the day comes from the smallest of read_hour * 2 (+ 1 for 'a'), which is even when it is an 'A'.
+    if periods_table is not None:
+        periods_where = '''
+            AND (hr.station, hr.period) IN (
+                SELECT station, period
+                FROM %s
+            )''' % periods_table
+    return '''
+        SELECT station,
+            read_date,
+            n_error,
+            n_accum,
+            CASE first_accum %% 2 WHEN 0 THEN 'A' WHEN 1 THEN 'a' END AS first_accum
+        FROM (
+            SELECT hr.station,
+                hr.read_date,
+                SUM(hr.flag1 IN ('[',']','{','}') OR hr.flag2 IN ('Q','q')) AS n_error,
+                SUM(hr.flag1 IN ('a','A')) AS n_accum,
+                MIN(CASE WHEN hr.flag1 IN ('a','A') THEN hr.read_hour * 2 + (hr.flag1 = 'a') END) AS first_accum
+            FROM hourly_raw hr
+            WHERE (%s)%s
+            GROUP BY hr.station, hr.read_date
+        ) hd
         WHERE NOT EXISTS (
             SELECT 1
-            FROM error_days_d edd
-            WHERE edd.station = edha.station
-            AND edd.read_date = edha.read_date
+            FROM daily_raw dr
+            WHERE dr.station = hd.station
+            AND dr.read_date = hd.read_date
+            AND %s
         )
-        AND count1 % 2 = 1
-    '''
-    curr.execute(querystr)
+    ''' % (HOURLY_ERROR_ROWS, periods_where, DAILY_ERROR_ROWS)
 
-    # Accums with an even number of flags, but the first flag is the end of an accum
-    # period.
 
+def find_mismatches(conn: sqlite3.Connection, periods_table: str = None) -> list:
+    """
+    Find the days that are missing their daily error flags.
+    :param conn: DB Connection
+    :param periods_table: Table with the station and period of the station-periods to check (default all)
+    :return: List of (station, read_date, flag), with flag one of MISMATCH_FLAGS
+    """
     querystr = '''
-        INSERT INTO error_days_miss
-        SELECT station, read_date, 'E'
-        FROM error_days_ha edha
-        WHERE NOT EXISTS (
-            SELECT 1
-            FROM error_days_d edd
-            WHERE edd.station = edha.station
-            AND edd.read_date = edha.read_date
-        )
-        AND count1 % 2 = 0
-        AND EXISTS (
-            SELECT 1
-            FROM hourly_raw hr 
-            WHERE hr.station = edha.station
-            AND hr.read_date = edha.read_date
-            AND flag1 = 'A'
-            AND NOT EXISTS (
-                SELECT 1
-                FROM hourly_raw hr2 
-                WHERE hr2.station = edha.station
-                AND hr2.read_date = edha.read_date
-                AND hr2.read_hour < hr.read_hour 
-                AND hr2.flag1 = 'a'
-            )
-        )
-    '''
-    curr.execute(querystr)
-
-    conn.commit()
-
-
-def update_from_mismatches(conn: sqlite3.Connection):
+        SELECT station,
+            read_date,
+            n_error > 0,
+            n_accum %% 2 = 1,
+            n_accum > 0 AND n_accum %% 2 = 0 AND first_accum = 'A'
+        FROM (%s)
+        WHERE n_error > 0
+        OR n_accum > 0
+    ''' % day_counts_select(conn, periods_table=periods_table)
+
+    mismatches = []
+    for station, read_date, *found in conn.execute(querystr):
+        mismatches.extend((station, read_date, flag) for flag, is_found in zip(MISMATCH_FLAGS, found) if is_found)
+    return mismatches
+
+
+def update_from_mismatches(conn: sqlite3.Connection, mismatches: list, commit: bool = True):
     """
     Update daily table based on the mismatches that we have collected.
     We will use 'P' in all cases rather than determining where 'I' would match the standards.
     :param conn: DB Connection
+    :param mismatches: List of (station, read_date, flag), as from find_mismatches
+    :param commit: Commit when done (False leaves the update in the caller's transaction)
     :return: None
     """
 
     curr = conn.cursor()
 
+    curr.execute("DROP TABLE IF EXISTS temp.error_days_miss")
+    cmd = '''
+        CREATE TEMP TABLE error_days_miss (
+            station TEXT,
+            read_date INTEGER,
+            PRIMARY KEY (station, read_date)
+        )
+    '''
+    curr.execute(cmd)
+    curr.executemany("INSERT OR IGNORE INTO temp.error_days_miss VALUES (?,?)",
+                     ((station, read_date) for station, read_date, flag in mismatches))
+
     querystr = '''
         UPDATE daily_raw
         SET flag1 = 'P'
         WHERE (station, read_date) IN (
-            SELECT station, read_date 
-            FROM error_days_miss edm
+            SELECT station, read_date
+            FROM temp.error_days_miss edm
         )
     '''
     curr.execute(querystr)
 
-    conn.commit()
+    # Keep the flag summary (load/flag_summary.py) in step
+    if flag_summary.has_flag_summary(conn):
+        flag_summary.set_daily_flag(conn, 'temp.error_days_miss', 'P')
+
+    curr.execute("DROP TABLE temp.error_days_miss")
+    if commit:
+        conn.commit()
+
+
+def fix_error_flags(conn: sqlite3.Connection, station_periods=None, commit: bool = True) -> list:
+    """
+    Find the days that are missing their daily error flags, and flag them 'P'.
+    :param conn: DB Connection
+    :param station_periods: Collection of (station, period) to check, as after a file is reloaded (default all)
+    :param commit: Commit when done (False leaves the update in the caller's transaction)
+    :return: List of (station, read_date, flag) that were fixed
+    """
+    if station_periods is None:
+        mismatches = find_mismatches(conn)
+    else:
+        curr = conn.cursor()
+        curr.execute("DROP TABLE IF EXISTS temp.error_fix_period")
+        curr.execute("CREATE TEMP TABLE error_fix_period (station TEXT, period TEXT, PRIMARY KEY (station, period))")
+        curr.executemany("INSERT OR IGNORE INTO temp.error_fix_period VALUES (?,?)", station_periods)
+        mismatches = find_mismatches(conn, 'temp.error_fix_period')
+        curr.execute("DROP TABLE temp.error_fix_period")
+    update_from_mismatches(conn, mismatches, commit)
+    return mismatches
@@ -0,0 +1,188 @@
+"""
+Class to parse a block of precipitation file lines with NumPy
+"""
+
+import numpy as np
+
+# Ordinal of 1970-01-01, used to convert numpy day numbers to date.toordinal() values
+EPOCH_ORDINAL = 719163
+# Byte value to single character text, used to decode the flag fields
+CHAR_TABLE = np.array([chr(i) for i in range(256)], dtype=object)
+
+
+class PrecipBatch:
+    """
+    Batch parser for precipitation data.
+    This gives the same values as PrecipLine, but decodes a whole block of lines at once
+    into columnar arrays.  Line level arrays (station, units, etc.) have one entry per
+    day; the hourly arrays have one entry per hourly reading and h_line points back
+    to the line for the reading.
+    """
+
+    def __init__(self, buf: bytes):
+        """
+        Init PrecipBatch.
+        :param buf: Raw input bytes holding complete lines
+        """
+        data = np.frombuffer(buf, dtype=np.uint8)
+
+        # Find line boundaries, dropping blank lines (a trailing carriage return is past the fields)
+        ends = np.flatnonzero(data == 10)
+        if len(data) > 0 and data[-1] != 10:
+            ends = np.append(ends, len(data))
+        starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) > 0 else ends
+        keep = ends - starts > 30
+        starts = starts[keep]
+        self.n_lines = len(starts)
+
+        # Fixed fields
+        head = _columns(data, starts, 30)
+        self.station = _get_str(head[:, 3:9])
+        self.state_code = _get_str(head[:, 3:5])
+        self.units = _get_str(head[:, 15:17])
+        self.read_date = _to_ordinal(_get_int(head[:, 17:21]), _get_int(head[:, 21:23]), _get_int(head[:, 25:27]))
+        self.period = _get_period(head)
+        self.count = _get_int(head[:, 27:30])
+
+        # Hourly amounts
+        hour_counts = self.count - 1
+        self.h_line = np.repeat(np.arange(self.n_lines), hour_counts)
+        first = np.cumsum(hour_counts) - hour_counts
+        slot = np.arange(len(self.h_line)) - np.repeat(first, hour_counts)
+        hours = _columns(data, starts[self.h_line] + slot * 12 + 30, 12)
+        self.read_hour = _get_int(hours[:, 0:4])
+        self.amount = _get_int(hours[:, 4:10])
+        self.flag1 = _get_str(hours[:, 10:11])
+        self.flag2 = _get_str(hours[:, 11:12])
+
+        # Daily total
+        daily = _columns(data, starts + hour_counts * 12 + 30, 12)
+        self.daily_tot = _get_int(daily[:, 4:10])
+        self.daily_flag1 = _get_str(daily[:, 10:11])
+        self.daily_flag2 = _get_str(daily[:, 11:12])
+
+    def hourly_records(self):
+        """
+        Get hourly rows in the column order station, state_code, units, period,
+        read_date, read_hour, amount, flag1, flag2.
+        :return: Iterator of tuples (for executemany)
+        """
+        idx = self.h_line
+        return zip(
+            self.station[idx].tolist(),
+            self.state_code[idx].tolist(),
+            self.units[idx].tolist(),
+            self.period[idx].tolist(),
+            self.read_date[idx].tolist(),
+            self.read_hour.tolist(),
+            self.amount.tolist(),
+            self.flag1.tolist(),
+            self.flag2.tolist()
+        )
+
+    def daily_records(self):
+        """
+        Get daily rows in the column order station, state_code, units, period,
+        read_date, amount, flag1, flag2.
+        :return: Iterator of tuples (for executemany)
+        """
+        return zip(
+            self.station.tolist(),
+            self.state_code.tolist(),
+            self.units.tolist(),
+            self.period.tolist(),
+            self.read_date.tolist(),
+            self.daily_tot.tolist(),
+            self.daily_flag1.tolist(),
+            self.daily_flag2.tolist()
+        )
+
+
+def read_precip_batches(fname, chunk_size: int = 1 << 26):
+    """
+    Read a precipitation file in large chunks cut at line boundaries.
+    :param fname: Filename
+    :param chunk_size: Approximate number of bytes per chunk
+    :return: Generator of PrecipBatch
+    """
+    with open(fname, "rb") as infile:
+        rest = b""
+        while True:
+            block = infile.read(chunk_size)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b"\n") + 1
+            rest = block[cut:]
+            if cut > 0:
+                yield PrecipBatch(block[:cut])
+        if rest.strip():
+            yield PrecipBatch(rest)
+
+
+def _columns(data: np.ndarray, starts: np.ndarray, width: int) -> np.ndarray:
+    """
+    Gather a fixed width block of bytes from every start position (internal use only).
+    :param data: Raw bytes as uint8
+    :param starts: Start position of each block
+    :param width: Block width
+    :return: 2D uint8 array (one row per start)
+    """
+    if len(starts) == 0:
+        return np.empty((0, width), dtype=np.uint8)
+    return np.lib.stride_tricks.sliding_window_view(data, width)[starts]
+
+
+def _get_str(cols: np.ndarray) -> np.ndarray:
+    """
+    Get a fixed width text field as an object array of str (internal use only).
+    The fields repeat heavily (flags, stations, units), so each distinct value is only
+    decoded once.
+    :param cols: 2D uint8 array holding the field
+    :return: Object array of str
+    """
+    width = cols.shape[1]
+    if width == 1:
+        return CHAR_TABLE[cols[:, 0]]
+    values, inverse = np.unique(np.ascontiguousarray(cols).view("S%d" % width).ravel(), return_inverse=True)
+    decoded = np.array([value.decode("ascii").ljust(width) for value in values.tolist()], dtype=object)
+    return decoded[inverse.ravel()]
+
+
+def _get_int(cols: np.ndarray) -> np.ndarray:
+    """
+    Get a fixed width integer field (internal use only).
+    The fields are zero filled, so the digits are combined directly.  The odd row with a sign or
+    blanks is handed to int() so the result always matches PrecipLine.
+    :param cols: 2D uint8 array holding the field
+    :return: Integer array
+    """
+    width = cols.shape[1]
+    digits = cols - 48
+    is_digit = digits < 10
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    values = np.where(is_digit, digits, 0).astype(np.int64) @ powers
+    if not is_digit.all():
+        for i in np.flatnonzero(~is_digit.all(axis=1)).tolist():
+            values[i] = int(cols[i].tobytes())
+    return values
+
+
+def _to_ordinal(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """
+    Convert year, month and day arrays to date.toordinal() values (internal use only).
+    """
+    months = (year - 1970) * 12 + (month - 1)
+    days = months.astype("M8[M]").astype("M8[D]") + (day - 1)
+    return days.astype(np.int64) + EPOCH_ORDINAL
+
+
+def _get_period(head: np.ndarray) -> np.ndarray:
+    """
+    Build the YYYY-MM period text from the date field (internal use only).
+    """
+    cols = np.empty((len(head), 7), dtype=np.uint8)
+    cols[:, :4] = head[:, 17:21]
+    cols[:, 4] = ord("-")
+    cols[:, 5:] = head[:, 21:23]
+    return _get_str(cols)
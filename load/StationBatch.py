@@ -0,0 +1,178 @@
+"""
+Class to parse a block of station history lines with NumPy
+"""
+
+import numpy as np
+
+from load.PrecipBatch import _columns, _to_ordinal
+
+# Fields of the MSHR enhanced file: (column name, start, end, type), with the same slices as StationLine.
+# Types are 'str' (stripped, None if blank), 'float' (None if blank or not a number) and 'date' (YYYYMMDD
+# converted to date.toordinal()).
+STATION_COLUMNS = [
+    ('source_id', 0, 20, 'str'),
+    ('source', 21, 31, 'str'),
+    ('begin_date', 32, 40, 'date'),
+    ('end_date', 41, 49, 'date'),
+    ('station_status', 50, 70, 'str'),
+    ('ncdcstn_id', 71, 91, 'str'),
+    ('coop_id', 197, 217, 'str'),
+    ('ghcnd_id', 239, 259, 'str'),
+    ('name_pr_sh', 361, 391, 'str'),
+    ('name_coop_sh', 493, 523, 'str'),
+    ('nws_climate_div', 726, 736, 'str'),
+    ('state', 778, 788, 'str'),
+    ('county', 789, 839, 'str'),
+    ('nws_st_code', 840, 842, 'str'),
+    ('fips_country_code', 843, 845, 'str'),
+    ('nws_region', 947, 977, 'str'),
+    ('elev_ground', 989, 1029, 'float'),
+    ('elev_barom', 1051, 1091, 'float'),
+    ('lat', 1299, 1319, 'float'),
+    ('lon', 1320, 1340, 'float'),
+    ('relocation', 1352, 1414, 'str'),
+    ('utc_offset', 1415, 1431, 'float'),
+    ('ghcnmlt_id', 1574, 1594, 'str'),
+    ('county_fips_code', 1595, 1600, 'str'),
+    ('igra_id', 1754, 1784, 'str'),
+    ('hpd_id', 1785, 1805, 'str'),
+]
+# Last column used, so the lines can be padded out to it
+LINE_WIDTH = max(end for name, start, end, kind in STATION_COLUMNS)
+
+
+class StationBatch:
+    """
+    Batch parser for station history data.
+    This gives the same values as StationLine (with the dates as ordinals, as import_station_file
+    stores them), but decodes each field of a whole block of lines at once.  The text is read as
+    Latin-1, so each byte is one character and the fixed columns line up.
+    """
+
+    def __init__(self, buf: bytes, coop_ids=None):
+        """
+        Init StationBatch.
+        :param buf: Raw input bytes holding complete lines
+        :param coop_ids: If given, only keep the lines for these COOP ids (any collection of str)
+        """
+        data = np.frombuffer(buf, dtype=np.uint8)
+        if len(data) > 0 and data[-1] != 10:
+            data = np.append(data, np.uint8(10))
+
+        # Find line boundaries, not counting any carriage return
+        ends = np.flatnonzero(data == 10)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        cr = np.zeros(len(ends), dtype=bool)
+        inside = ends > starts
+        cr[inside] = data[ends[inside] - 1] == 13
+        lengths = ends - starts - cr
+
+        # One row per line, out to the last column.  The file is fixed width, so the lines can usually be viewed in
+        # place; otherwise they are copied out, with the bytes past the end of short lines blanked.
+        stride = ends[0] + 1 if len(ends) > 0 else 0
+        if len(ends) > 0 and len(data) == len(ends) * stride and np.all(np.diff(ends) == stride) \
+                and lengths.min() >= LINE_WIDTH:
+            self._rows = data.reshape(len(ends), stride)
+        else:
+            padded = np.concatenate((data, np.full(LINE_WIDTH, 32, dtype=np.uint8)))
+            self._rows = _columns(padded, starts, LINE_WIDTH)
+            short = np.flatnonzero(lengths < LINE_WIDTH)
+            if len(short) > 0:
+                past_end = np.arange(LINE_WIDTH) >= lengths[short, None]
+                self._rows[short] = np.where(past_end, np.uint8(32), self._rows[short])
+
+        # Drop blank lines
+        if (lengths == 0).any():
+            self._rows = self._rows[lengths > 0]
+
+        if coop_ids is not None:
+            coop_id = self._get_field('coop_id', 197, 217, 'str')
+            coop_ids = set(coop_ids)
+            wanted = np.fromiter((value in coop_ids for value in coop_id), dtype=bool, count=len(coop_id))
+            self._rows = self._rows[wanted]
+
+        self.n_lines = len(self._rows)
+        for name, start, end, kind in STATION_COLUMNS:
+            setattr(self, name, self._get_field(name, start, end, kind))
+
+    def records(self):
+        """
+        Get the rows for inserting in station_hist, in the order of STATION_COLUMNS.
+        :return: Iterator of tuples
+        """
+        return zip(*[getattr(self, name).tolist() for name, start, end, kind in STATION_COLUMNS])
+
+    def _get_field(self, name: str, start: int, end: int, kind: str) -> np.ndarray:
+        """
+        Decode one field of every line (internal use only).
+        :param name: Column name (for error messages)
+        :param start: First column
+        :param end: Column after the last
+        :param kind: 'str', 'float' or 'date'
+        :return: Object array (str, float or None) or integer array for dates
+        """
+        width = end - start
+        cols = self._rows[:, start:end]
+
+        if kind == 'date':
+            digits = cols.astype(np.int64) - 48
+            if ((digits < 0) | (digits > 9)).any():
+                bad = np.flatnonzero(((digits < 0) | (digits > 9)).any(axis=1))[0]
+                raise ValueError("Invalid %s: %r" % (name, cols[bad].tobytes().decode("latin-1")))
+            year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+            month = digits[:, 4] * 10 + digits[:, 5]
+            day = digits[:, 6] * 10 + digits[:, 7]
+            return _to_ordinal(year, month, day)
+
+        # Most fields are blank on most lines and many values repeat, so only the distinct filled values are decoded
+        result = np.full(len(cols), None, dtype=object)
+        filled = np.flatnonzero((cols > 32).any(axis=1))
+        if len(filled) > 0 and kind == 'float':
+            # Convert the whole column at once; if any value is not a number, fall back to one value at a time
+            try:
+                result[filled] = np.ascontiguousarray(cols[filled]).view("S%d" % width).ravel().astype(float).tolist()
+                return result
+            except ValueError:
+                pass
+        if len(filled) > 0:
+            values, inverse = np.unique(np.ascontiguousarray(cols[filled]).view("S%d" % width).ravel(),
+                                        return_inverse=True)
+            decoded = [_decode(value.decode("latin-1"), kind) for value in values.tolist()]
+            result[filled] = np.array(decoded + [None], dtype=object)[:-1][inverse.ravel()]
+        return result
+
+
+def _decode(value: str, kind: str):
+    """
+    Convert one field as util/parsetext does (internal use only).
+    :param value: Field text (NumPy drops trailing blanks and nulls)
+    :param kind: 'str' or 'float'
+    :return: str, float or None
+    """
+    work = value.strip()
+    if work == "":
+        return None
+    if kind == 'float':
+        try:
+            return float(work)
+        except ValueError:
+            return None
+    return work
+
+
+def read_station_batches(fname, chunk_size: int = 1 << 26, coop_ids=None):
+    """
+    Read a station history file in large chunks cut at line boundaries.
+    :param fname: Filename
+    :param chunk_size: Approximate number of bytes per chunk
+    :param coop_ids: If given, only keep the lines for these COOP ids
+    :return: Generator of StationBatch
+    """
+    with open(fname, "rb") as infile:
+        while True:
+            block = bytearray(infile.read(chunk_size))
+            if not block:
+                break
+            # Finish the last line
+            block += infile.readline()
+            yield StationBatch(block, coop_ids)
@@ -0,0 +1,103 @@
+"""
+Load raw precipitation data straight from the yearly 3240_SS_YYYY-YYYY.tar.Z archives
+"""
+
+import glob
+import sqlite3
+import tarfile
+
+from main.config import *
+from load.PrecipBatch import PrecipBatch
+import load.db_load as db_load
+import load.parallel_load as parallel_load
+from util.unlzw import open_z
+
+
+def iter_archive_members(fname):
+    """
+    Walk the members of a .tar.Z archive without extracting them to disk.
+    :param fname: Archive filename
+    :return: Generator of (member name, member contents as bytes)
+    """
+    with open_z(fname) as zfile:
+        with tarfile.open(fileobj=zfile, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+
+
+def iter_archive_lines(fname):
+    """
+    Get the contents of each archive member, making sure each one ends with a line break.
+    :param fname: Archive filename
+    :return: Generator of bytes
+    """
+    for name, data in iter_archive_members(fname):
+        if data and not data.endswith(b"\n"):
+            data += b"\n"
+        yield data
+
+
+def read_archive_batches(fname, batch_size: int = 1 << 26):
+    """
+    Read the precipitation lines from all members of an archive as PrecipBatch blocks.
+    Members are joined (as the tar/7-Zip extraction loop did) until a block reaches batch_size bytes.
+    :param fname: Archive filename
+    :param batch_size: Approximate number of bytes per batch
+    :return: Generator of PrecipBatch
+    """
+    parts = []
+    size = 0
+    for data in iter_archive_lines(fname):
+        parts.append(data)
+        size += len(data)
+        if size >= batch_size:
+            yield PrecipBatch(b"".join(parts))
+            parts = []
+            size = 0
+    if parts:
+        yield PrecipBatch(b"".join(parts))
+
+
+def parse_archive(fname) -> PrecipBatch:
+    """
+    Parse a whole archive in one batch (runs in the worker processes).
+    The state-year archives are small enough to hold at once.
+    :param fname: Archive filename
+    :return: Parsed lines
+    """
+    return PrecipBatch(b"".join(iter_archive_lines(fname)))
+
+
+def import_precip_archive(fname, conn: sqlite3.Connection):
+    """
+    Import a single .tar.Z archive of raw precipitation data.
+    :param fname: Archive filename
+    :param conn: DB connection
+    :return: None
+    """
+    for batch in read_archive_batches(fname):
+        db_load.save_precip_batch(batch, conn)
+
+    conn.commit()
+
+
+def import_precip_archives_parallel(fnames: list, conn: sqlite3.Connection, workers: int = None):
+    """
+    Import .tar.Z archives, decompressing and parsing them in a process pool with one SQL writer.
+    The LZW decoder is pure Python, so this is where the extra cores pay off most.
+    :param fnames: Archive filenames
+    :param conn: DB connection
+    :param workers: Number of processes (defaults to load_workers in config, then all cores)
+    :return: Tuple of hourly and daily row counts written
+    """
+    return parallel_load.load_parallel(parse_archive, [(fname,) for fname in fnames], conn, workers)
+
+
+def archive_names(year: str) -> list:
+    """
+    List the downloaded archives for a year in orig_data_dir.
+    :param year: Year
+    :return: List of filenames
+    """
+    return sorted(glob.glob(join(orig_data_dir, "3240_*_" + year + "-" + year + ".tar.Z")))
@@ -0,0 +1,365 @@
+"""
+Compact, integer encoded storage for the raw hourly and daily tables.
+
+The compact tables store every value as a small integer:
+    station_id  the 6 digit COOP station id as an integer (keeps the sort order, and the
+                state code is its first two digits)
+    epoch_hour  read_date * 24 + hour - 1, where hour is the hour ending 1-24 from read_hour (0100-2400),
+                so epoch_hour // 24 is the date again
+    period      yyyymm
+    units       code from units_code (1 = HI, 2 = HT, as in units_flag)
+    flag1/2     the ASCII code of the flag character (32 for blank)
+
+Views named hourly_raw and daily_raw decode the compact tables into the original columns, with
+INSTEAD OF triggers for insert, update and delete, so the existing loaders and queries keep working.
+The view columns are expressions, so a filter on station or period through a view can only use an index
+on the same expression: hc_key and dc_key (add_indexes_hr_dr_compact) index the decoded station and period
+text, and have to be kept in step with the view text.  With them, the range queries and per station-period
+deletes through the views are index searches; whole table aggregations still read every row, as they do
+on the raw tables.  Readers that use the integer keys directly (readdb/hourly.get_hourly_compact) seek the
+primary key by station_id and epoch_hour instead.
+
+hc_key is about as big as hourly_compact itself.  On a 1.4 million hour test file the database was 132 MB with
+the raw tables and their indexes, and 80 MB compact with hc_key and dc_key (64 MB without them).
+"""
+
+import sqlite3
+
+import numpy as np
+
+import load.flag_summary as flag_summary
+from load.PrecipBatch import PrecipBatch, read_precip_batches
+
+# Codes for the units (as in units_flag)
+UNITS_CODES = [(1, 'HI'), (2, 'HT'), (3, 'MM')]
+
+
+def cr_tb_hr_dr_compact(conn: sqlite3.Connection, views: bool = True):
+    """
+    Create the compact hourly and daily tables and the units code table.
+    :param conn: DB Connection
+    :param views: Also create the hourly_raw and daily_raw decoding views
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cmd = '''
+        CREATE TABLE units_code (
+            code INTEGER PRIMARY KEY,
+            units VARCHAR(2) NOT NULL UNIQUE
+        )
+    '''
+    cur.execute(cmd)
+    cur.executemany("INSERT INTO units_code (code, units) VALUES (?,?)", UNITS_CODES)
+
+    cmd = '''
+        CREATE TABLE hourly_compact (
+            station_id INTEGER NOT NULL,
+            epoch_hour INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            amount INTEGER,
+            flag1 INTEGER,
+            flag2 INTEGER,
+            PRIMARY KEY (station_id, epoch_hour)
+        ) WITHOUT ROWID
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TABLE daily_compact (
+            station_id INTEGER NOT NULL,
+            read_date INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            amount INTEGER,
+            flag1 INTEGER,
+            flag2 INTEGER,
+            PRIMARY KEY (station_id, read_date)
+        ) WITHOUT ROWID
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+    if views:
+        cr_vw_hr_dr_compact(conn)
+
+
+def add_indexes_hr_dr_compact(conn: sqlite3.Connection):
+    """
+    Add extra indexes for the compact daily and hourly tables, on the decoded station and period of the views
+    :param conn: DB Connection
+    :return: None
+    """
+
+    cur = conn.cursor()
+
+    # The decoded station and period, as written in the views, for the queries on hourly_raw and daily_raw.
+    # The compact readers filter on the integer keys, which the primary keys already cover.
+    cmd = '''
+        CREATE INDEX hc_key
+        ON hourly_compact (
+            printf('%06d', station_id),
+            printf('%04d-%02d', period / 100, period % 100)
+        )
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE INDEX dc_key
+        ON daily_compact (
+            printf('%06d', station_id),
+            printf('%04d-%02d', period / 100, period % 100),
+            read_date
+        )
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+
+def cr_vw_hr_dr_compact(conn: sqlite3.Connection):
+    """
+    Create the hourly_raw and daily_raw views over the compact tables, with triggers
+    so that inserts, updates and deletes on the views reach the compact tables.
+    The station and period expressions must match hc_key and dc_key (add_indexes_hr_dr_compact).
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cmd = '''
+        CREATE VIEW hourly_raw AS
+        SELECT printf('%06d', h.station_id) AS station,
+            printf('%02d', h.station_id / 10000) AS state_code,
+            u.units AS units,
+            h.epoch_hour / 24 AS read_date,
+            (h.epoch_hour % 24 + 1) * 100 AS read_hour,
+            CAST(h.amount AS REAL) AS amount,
+            char(h.flag1) AS flag1,
+            char(h.flag2) AS flag2,
+            printf('%04d-%02d', h.period / 100, h.period % 100) AS period
+        FROM hourly_compact h
+        JOIN units_code u ON u.code = h.units
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE VIEW daily_raw AS
+        SELECT printf('%06d', d.station_id) AS station,
+            printf('%02d', d.station_id / 10000) AS state_code,
+            u.units AS units,
+            d.read_date AS read_date,
+            CAST(d.amount AS REAL) AS amount,
+            char(d.flag1) AS flag1,
+            char(d.flag2) AS flag2,
+            printf('%04d-%02d', d.period / 100, d.period % 100) AS period
+        FROM daily_compact d
+        JOIN units_code u ON u.code = d.units
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER hourly_raw_ins INSTEAD OF INSERT ON hourly_raw
+        BEGIN
+            INSERT INTO hourly_compact (station_id, epoch_hour, period, units, amount, flag1, flag2)
+            VALUES (
+                CAST(NEW.station AS INTEGER),
+                NEW.read_date * 24 + CAST(NEW.read_hour AS INTEGER) / 100 - 1,
+                CAST(substr(NEW.period, 1, 4) || substr(NEW.period, 6, 2) AS INTEGER),
+                (SELECT code FROM units_code WHERE units = NEW.units),
+                NEW.amount,
+                unicode(NEW.flag1),
+                unicode(NEW.flag2)
+            );
+        END
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER daily_raw_ins INSTEAD OF INSERT ON daily_raw
+        BEGIN
+            INSERT INTO daily_compact (station_id, read_date, period, units, amount, flag1, flag2)
+            VALUES (
+                CAST(NEW.station AS INTEGER),
+                NEW.read_date,
+                CAST(substr(NEW.period, 1, 4) || substr(NEW.period, 6, 2) AS INTEGER),
+                (SELECT code FROM units_code WHERE units = NEW.units),
+                NEW.amount,
+                unicode(NEW.flag1),
+                unicode(NEW.flag2)
+            );
+        END
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER hourly_raw_upd INSTEAD OF UPDATE ON hourly_raw
+        BEGIN
+            UPDATE hourly_compact
+            SET amount = NEW.amount,
+                flag1 = unicode(NEW.flag1),
+                flag2 = unicode(NEW.flag2)
+            WHERE station_id = CAST(OLD.station AS INTEGER)
+            AND epoch_hour = OLD.read_date * 24 + OLD.read_hour / 100 - 1;
+        END
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER daily_raw_upd INSTEAD OF UPDATE ON daily_raw
+        BEGIN
+            UPDATE daily_compact
+            SET amount = NEW.amount,
+                flag1 = unicode(NEW.flag1),
+                flag2 = unicode(NEW.flag2)
+            WHERE station_id = CAST(OLD.station AS INTEGER)
+            AND read_date = OLD.read_date;
+        END
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER hourly_raw_del INSTEAD OF DELETE ON hourly_raw
+        BEGIN
+            DELETE FROM hourly_compact
+            WHERE station_id = CAST(OLD.station AS INTEGER)
+            AND epoch_hour = OLD.read_date * 24 + OLD.read_hour / 100 - 1;
+        END
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TRIGGER daily_raw_del INSTEAD OF DELETE ON daily_raw
+        BEGIN
+            DELETE FROM daily_compact
+            WHERE station_id = CAST(OLD.station AS INTEGER)
+            AND read_date = OLD.read_date;
+        END
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+
+def convert_raw_to_compact(conn: sqlite3.Connection):
+    """
+    Move the data in the hourly_raw and daily_raw tables into the compact tables, then replace the
+    raw tables with the decoding views.  Run VACUUM afterwards to give the space back to the disk.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    # Every row must keep its units, so stop before changing anything if a units value has no code
+    querystr = '''
+        SELECT units FROM hourly_raw
+        UNION
+        SELECT units FROM daily_raw
+    '''
+    unknown = sorted({row[0] for row in cur.execute(querystr)} - {units for code, units in UNITS_CODES})
+    if unknown:
+        raise ValueError("Units not in units_code: %s" % ', '.join(repr(units) for units in unknown))
+
+    cr_tb_hr_dr_compact(conn, views=False)
+
+    # LEFT JOIN, so that a row without a units code fails on NOT NULL rather than being left out
+    cmd = '''
+        INSERT INTO hourly_compact (station_id, epoch_hour, period, units, amount, flag1, flag2)
+        SELECT CAST(station AS INTEGER),
+            read_date * 24 + read_hour / 100 - 1,
+            CAST(substr(period, 1, 4) || substr(period, 6, 2) AS INTEGER),
+            u.code,
+            amount,
+            unicode(flag1),
+            unicode(flag2)
+        FROM hourly_raw hr
+        LEFT JOIN units_code u ON u.units = hr.units
+        ORDER BY station, read_date, read_hour
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        INSERT INTO daily_compact (station_id, read_date, period, units, amount, flag1, flag2)
+        SELECT CAST(station AS INTEGER),
+            read_date,
+            CAST(substr(period, 1, 4) || substr(period, 6, 2) AS INTEGER),
+            u.code,
+            amount,
+            unicode(flag1),
+            unicode(flag2)
+        FROM daily_raw dr
+        LEFT JOIN units_code u ON u.units = dr.units
+        ORDER BY station, read_date
+    '''
+    cur.execute(cmd)
+
+    cur.execute("DROP TABLE hourly_raw")
+    cur.execute("DROP TABLE daily_raw")
+    conn.commit()
+
+    cr_vw_hr_dr_compact(conn)
+    add_indexes_hr_dr_compact(conn)
+
+
+def import_precip_file_compact(fname, conn: sqlite3.Connection):
+    """
+    Import a single raw precipitation data file straight into the compact tables.
+    This encodes whole batches with NumPy, which is much faster than inserting through the views.
+    :param fname: Filename
+    :param conn: DB connection
+    :return: None
+    """
+    for batch in read_precip_batches(fname):
+        save_precip_batch_compact(batch, conn)
+
+    conn.commit()
+
+
+def save_precip_batch_compact(batch: PrecipBatch, conn: sqlite3.Connection):
+    """
+    Encode and insert the hourly and daily rows from a parsed batch (does not commit).
+    If the flag summary tables exist, the batch is added to them too, as db_load.save_precip_batch does.
+    :param batch: Parsed lines
+    :param conn: DB connection
+    :return: None
+    """
+    insert_sql = '''
+        INSERT INTO hourly_compact
+            (station_id, epoch_hour, period, units, amount, flag1, flag2)
+            VALUES (?,?,?,?,?,?,?)
+    '''
+    insert_sql_d = '''
+        INSERT INTO daily_compact
+            (station_id, read_date, period, units, amount, flag1, flag2)
+            VALUES (?,?,?,?,?,?,?)
+    '''
+    cur = conn.cursor()
+    units_map = dict(cur.execute("SELECT units, code FROM units_code").fetchall())
+
+    station_id = batch.station.astype(np.int64)
+    period = np.array([int(p[:4] + p[5:]) for p in batch.period.tolist()], dtype=np.int64)
+    units = np.array([units_map[u] for u in batch.units.tolist()], dtype=np.int64)
+    idx = batch.h_line
+
+    cur.executemany(insert_sql, zip(
+        station_id[idx].tolist(),
+        (batch.read_date[idx] * 24 + batch.read_hour // 100 - 1).tolist(),
+        period[idx].tolist(),
+        units[idx].tolist(),
+        batch.amount.tolist(),
+        [ord(f) for f in batch.flag1.tolist()],
+        [ord(f) for f in batch.flag2.tolist()]
+    ))
+    cur.executemany(insert_sql_d, zip(
+        station_id.tolist(),
+        batch.read_date.tolist(),
+        period.tolist(),
+        units.tolist(),
+        batch.daily_tot.tolist(),
+        [ord(f) for f in batch.daily_flag1.tolist()],
+        [ord(f) for f in batch.daily_flag2.tolist()]
+    ))
+    if flag_summary.has_flag_summary(conn):
+        flag_summary.save_flag_summary(flag_summary.summarize_batch(batch), conn)
@@ -56,6 +56,84 @@ def cr_tb_dr(conn: sqlite3.Connection):
     conn.commit()
 
 
+def cr_tb_hr_dr_stage(conn: sqlite3.Connection):
+    """
+    Create staging tables for a bulk load of the raw hourly and daily tables.
+    These have the same columns but no keys, so rows are simply appended.
+    Any staging tables left from an earlier, interrupted load are dropped first.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cur.execute("DROP TABLE IF EXISTS hourly_stage")
+    cmd = '''
+        CREATE TABLE hourly_stage (
+            station VARCHAR(6) NOT NULL,
+            state_code VARCHAR(2) NOT NULL,
+            units VARCHAR(2) NOT NULL,
+            read_date INTEGER,
+            read_hour INTEGER,
+            amount REAL,
+            flag1 VARCHAR(1),
+            flag2 VARCHAR(1),
+            period VARCHAR(7)
+        )
+    '''
+    cur.execute(cmd)
+
+    cur.execute("DROP TABLE IF EXISTS daily_stage")
+    cmd = '''
+        CREATE TABLE daily_stage (
+            station VARCHAR(6) NOT NULL,
+            state_code VARCHAR(2) NOT NULL,
+            units VARCHAR(2) NOT NULL,
+            read_date INTEGER,
+            amount REAL,
+            flag1 VARCHAR(1),
+            flag2 VARCHAR(1),
+            period VARCHAR(7)
+        )
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+
+def load_hr_dr_from_stage(conn: sqlite3.Connection):
+    """
+    Fill the keyed raw hourly and daily tables from the staging tables, then drop the staging tables.
+    The rows are inserted in key order, so the primary key B-trees are built by appending
+    instead of random inserts.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cmd = '''
+        INSERT INTO hourly_raw
+            (station, state_code, units, read_date, read_hour, amount, flag1, flag2, period)
+        SELECT station, state_code, units, read_date, read_hour, amount, flag1, flag2, period
+        FROM hourly_stage
+        ORDER BY station, read_date, read_hour
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        INSERT INTO daily_raw
+            (station, state_code, units, read_date, amount, flag1, flag2, period)
+        SELECT station, state_code, units, read_date, amount, flag1, flag2, period
+        FROM daily_stage
+        ORDER BY station, read_date
+    '''
+    cur.execute(cmd)
+
+    cur.execute("DROP TABLE hourly_stage")
+    cur.execute("DROP TABLE daily_stage")
+
+    conn.commit()
+
+
 def add_indexes_hr_dr(conn: sqlite3.Connection):
     """
     Add extra indexes for daily and hourly tables
@@ -84,6 +162,43 @@ def add_indexes_hr_dr(conn: sqlite3.Connection):
     conn.commit()
 
 
+def cr_tb_load_manifest(conn: sqlite3.Connection):
+    """
+    Create the load manifest tables.
+    load_manifest has one row per raw file that has been loaded, so that unchanged files
+    can be skipped.  load_manifest_period lists the station-periods found in each file, so
+    that a changed file only replaces its own station-periods.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cmd = '''
+        CREATE TABLE load_manifest (
+            path VARCHAR(260) PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            content_hash VARCHAR(40),
+            hour_cnt INTEGER,
+            day_cnt INTEGER,
+            load_time VARCHAR(19)
+        )
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TABLE load_manifest_period (
+            path VARCHAR(260) NOT NULL,
+            station VARCHAR(6) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            PRIMARY KEY (path, station, period)
+        )
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+
 def cr_tb_date(conn: sqlite3.Connection):
     """
     Create table for date (Integer Day to various values)
@@ -242,13 +357,16 @@ def cr_tb_station_mast(conn: sqlite3.Connection):
     Create the station master table from the latest record for each station
     in the history file.  Since stations are allowed to move only very
     limited distances without getting a new number, this should work for our
-    purposes.
+    purposes.  For attributes as of a given date, see readdb/station_asof.py.
     :param conn: DB Connection
     :return: None
     """
+    # RANK keeps all the rows with the latest begin_date, as the MAX
+    # subquery this replaces did, but does not need the coop_dt index to
+    # avoid a scan of the history for each row.
     cmd = '''
         CREATE TABLE station AS
-        SELECT DISTINCT dr.station,
+        SELECT DISTINCT station,
                         state,
                         nws_st_code,
                         fips_country_code,
@@ -257,14 +375,15 @@ def cr_tb_station_mast(conn: sqlite3.Connection):
                         lon,
                         utc_offset,
                         county_fips_code
-        FROM station_hist sh,
-        (SELECT DISTINCT station FROM daily_raw) dr
-        WHERE dr.station = sh.coop_id
-        AND sh.begin_date = (
-            SELECT MAX(sh1.begin_date)
-            FROM station_hist sh1
-            WHERE sh1.coop_id = sh.coop_id
+        FROM (
+            SELECT dr.station,
+                   sh.*,
+                   RANK() OVER (PARTITION BY sh.coop_id ORDER BY sh.begin_date DESC) AS recent
+            FROM (SELECT DISTINCT station FROM daily_raw) dr
+            JOIN station_hist sh ON sh.coop_id = dr.station
+            WHERE sh.begin_date IS NOT NULL
         )
+        WHERE recent = 1
     '''
     cur = conn.cursor()
     cur.execute(cmd)
@@ -397,6 +516,70 @@ def cr_tb_s_year_h(conn: sqlite3.Connection):
     conn.commit()
 
 
+def cr_tb_pipeline_metrics(conn: sqlite3.Connection):
+    """
+    Create the table of timings for the load pipeline stages (see util/metrics.py).
+    :param conn: DB Connection
+    :return: None
+    """
+    cmd = '''
+        CREATE TABLE pipeline_metrics (
+            run_id VARCHAR(15) NOT NULL,
+            seq INTEGER NOT NULL,
+            stage VARCHAR(60) NOT NULL,
+            start_time VARCHAR(19),
+            status VARCHAR(5),
+            wall_sec REAL,
+            cpu_sec REAL,
+            peak_rss_mb REAL,
+            peak_traced_mb REAL,
+            rows_in INTEGER,
+            rows_out INTEGER,
+            rows_per_sec REAL,
+            PRIMARY KEY (run_id, seq)
+        )
+    '''
+    cur = conn.cursor()
+    cur.execute(cmd)
+    conn.commit()
+
+
+def cr_tb_pipeline_state(conn: sqlite3.Connection):
+    """
+    Create the tables that hold the progress of main/pipeline.py.
+    pipeline_step has the state of each step, and pipeline_item the finished parts (files or years)
+    of the steps that can resume part way through.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+
+    cmd = '''
+        CREATE TABLE pipeline_step (
+            step VARCHAR(40) NOT NULL,
+            status VARCHAR(7) NOT NULL,
+            start_time VARCHAR(19),
+            end_time VARCHAR(19),
+            wall_sec REAL,
+            error TEXT,
+            PRIMARY KEY (step)
+        )
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TABLE pipeline_item (
+            step VARCHAR(40) NOT NULL,
+            item VARCHAR(260) NOT NULL,
+            end_time VARCHAR(19),
+            PRIMARY KEY (step, item)
+        )
+    '''
+    cur.execute(cmd)
+
+    conn.commit()
+
+
 # main (test)
 
 # conn1 = sqlite3.connect(sqldbname)
@@ -0,0 +1,389 @@
+"""
+Summary of the flags and totals for each station-day and station-period, built while the raw files are loaded.
+
+The error flag checks and the station period tables look for the same flags in the raw tables.  These tables count
+them once, as the lines are parsed, so that those steps can read one row per station-day or station-period instead
+of scanning hourly_raw again (coverage needs the hour of each flag, so it still reads hourly_raw):
+    flag_summary_day        one row per line of the files (station-day), with the hourly count and total, the
+                            daily total and flag, the first accumulation flag of the day, and the count of each flag
+    flag_summary_period     the same counts per station-period, with the counts of the daily I and P flags
+
+The batch loaders in db_load (and the line by line loaders) and the compact loader fill these tables whenever they
+exist, and the incremental reload and the error flag fix keep them in step.  flag_summary_state records whether the
+summary covers all of the raw rows: the tables are complete when they are created before any rows are loaded, or
+once convert_raw_to_flag_summary has filled them from the raw tables.  The readers (the station period tables and
+the error flag fix) only use the summary when it is complete, and otherwise read the raw tables.  Anything that
+writes raw rows without going through these loaders must call set_flag_summary_complete(conn, False).
+
+Building the summary is not free: with the summary tables in place, import_precip_file_np takes about 60-90% longer
+on a synthetic year file (bench/synthetic.py, 300 stations, 4.4 MB) than without them.
+"""
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from load.PrecipBatch import PrecipBatch
+
+# Hourly flags counted: (column, field, flag value)
+FLAG_COUNTS = [
+    ('n_accum_start', 'flag1', 'a'),
+    ('n_accum_end', 'flag1', 'A'),
+    ('n_missing_start', 'flag1', '['),
+    ('n_missing_end', 'flag1', ']'),
+    ('n_deleted_start', 'flag1', '{'),
+    ('n_deleted_end', 'flag1', '}'),
+    ('n_comma', 'flag1', ','),
+    ('n_q_upper', 'flag2', 'Q'),
+    ('n_q_lower', 'flag2', 'q'),
+]
+FLAG_COUNT_COLUMNS = [column for column, field, value in FLAG_COUNTS]
+ACCUM_FLAGS = ['a', 'A']
+
+DAY_COLUMNS = ['station', 'period', 'read_date', 'units', 'hour_cnt', 'hour_amount', 'daily_amount', 'daily_flag1',
+               'first_accum'] + FLAG_COUNT_COLUMNS
+PERIOD_COLUMNS = ['station', 'period', 'units_h', 'units_d', 'day_cnt', 'hour_cnt', 'hour_amount', 'daily_amount',
+                  'n_daily_incomplete', 'n_daily_partial'] + FLAG_COUNT_COLUMNS
+
+
+def cr_tb_flag_summary(conn: sqlite3.Connection):
+    """
+    Create the flag_summary_day and flag_summary_period tables
+    :param conn: DB Connection
+    :return: None
+    """
+    counts = ''.join('%s INTEGER NOT NULL,\n            ' % column for column in FLAG_COUNT_COLUMNS)
+    cmd = '''
+        CREATE TABLE flag_summary_day (
+            station VARCHAR(6) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            read_date INTEGER NOT NULL,
+            units VARCHAR(2),
+            hour_cnt INTEGER NOT NULL,
+            hour_amount REAL,
+            daily_amount REAL,
+            daily_flag1 VARCHAR(1),
+            first_accum VARCHAR(1),
+            %sPRIMARY KEY (station, read_date)
+        ) WITHOUT ROWID
+    ''' % counts
+    cur = conn.cursor()
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE INDEX fsd_period
+        ON flag_summary_day (
+            station, period
+        )
+    '''
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE TABLE flag_summary_period (
+            station VARCHAR(6) NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            units_h VARCHAR(2),
+            units_d VARCHAR(2),
+            day_cnt INTEGER NOT NULL,
+            hour_cnt INTEGER NOT NULL,
+            hour_amount REAL,
+            daily_amount REAL,
+            n_daily_incomplete INTEGER NOT NULL,
+            n_daily_partial INTEGER NOT NULL,
+            %sPRIMARY KEY (station, period)
+        ) WITHOUT ROWID
+    ''' % counts
+    cur.execute(cmd)
+    cr_tb_flag_summary_state(conn)
+
+    # Rows already in the raw tables are not in the summary until convert_raw_to_flag_summary adds them
+    tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+    loaded = any(cur.execute("SELECT 1 FROM %s LIMIT 1" % table).fetchone() is not None
+                 for table in ('hourly_raw', 'daily_raw') if table in tables)
+    set_flag_summary_complete(conn, not loaded)
+    conn.commit()
+
+
+def cr_tb_flag_summary_state(conn: sqlite3.Connection):
+    """
+    Create the flag_summary_state table, if it is not there yet (as with summaries made before it was added)
+    :param conn: DB Connection
+    :return: None
+    """
+    cmd = '''
+        CREATE TABLE IF NOT EXISTS flag_summary_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            complete INTEGER NOT NULL
+        )
+    '''
+    conn.execute(cmd)
+
+
+def has_flag_summary(conn: sqlite3.Connection) -> bool:
+    """
+    Check whether the summary tables have been created, so that the writers of raw rows must keep them in step.
+    Readers should check flag_summary_complete instead.
+    :param conn: DB connection
+    :return: True if flag_summary_period exists
+    """
+    querystr = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'flag_summary_period'"
+    return conn.execute(querystr).fetchone() is not None
+
+
+def flag_summary_complete(conn: sqlite3.Connection) -> bool:
+    """
+    Check whether the summary tables exist and cover all of the raw rows, so that they can be read instead.
+    :param conn: DB connection
+    :return: True if the summary is complete
+    """
+    querystr = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'flag_summary_state'"
+    if conn.execute(querystr).fetchone() is None:
+        return False
+    row = conn.execute("SELECT complete FROM flag_summary_state WHERE id = 1").fetchone()
+    return row is not None and row[0] == 1
+
+
+def set_flag_summary_complete(conn: sqlite3.Connection, complete: bool):
+    """
+    Record whether the summary covers all of the raw rows (does not commit).
+    :param conn: DB connection
+    :param complete: True once the summary has every raw row; False after raw rows are written without it
+    :return: None
+    """
+    conn.execute("INSERT OR REPLACE INTO flag_summary_state (id, complete) VALUES (1, ?)", (int(complete),))
+
+
+def summarize_batch(batch: PrecipBatch) -> pd.DataFrame:
+    """
+    Summarize each line of a parsed batch.
+    :param batch: Parsed lines
+    :return: DataFrame with DAY_COLUMNS, one row per line
+    """
+    n_lines = batch.n_lines
+    line = batch.h_line
+
+    # First accumulation flag of each day, in hour order
+    first_accum = np.full(n_lines, None, dtype=object)
+    accum = np.flatnonzero(np.isin(batch.flag1, ACCUM_FLAGS))
+    if len(accum) > 0:
+        accum = accum[np.lexsort((batch.read_hour[accum], line[accum]))]
+        lines, first = np.unique(line[accum], return_index=True)
+        first_accum[lines] = batch.flag1[accum[first]]
+
+    df = pd.DataFrame({
+        'station': batch.station,
+        'period': batch.period,
+        'read_date': batch.read_date,
+        'units': batch.units,
+        'hour_cnt': np.bincount(line, minlength=n_lines),
+        'hour_amount': np.bincount(line, weights=batch.amount, minlength=n_lines),
+        'daily_amount': batch.daily_tot,
+        'daily_flag1': batch.daily_flag1,
+        'first_accum': first_accum,
+    })
+    for column, field, value in FLAG_COUNTS:
+        df[column] = np.bincount(line[getattr(batch, field) == value], minlength=n_lines)
+    return df
+
+
+def summarize_line(station: str, period: str, read_date: int, units: str, details: list, daily_tot,
+                   daily_flag1: str) -> tuple:
+    """
+    Summarize one parsed line (for the line by line loaders).
+    :param station: Station id
+    :param period: Period (YYYY-MM)
+    :param read_date: Date as an ordinal
+    :param units: Units code
+    :param details: List of (read_hour, amount, flag1, flag2), as in PrecipLine.details
+    :param daily_tot: Daily total
+    :param daily_flag1: Flag 1 of the daily total
+    :return: Tuple of the values in DAY_COLUMNS
+    """
+    counts = dict.fromkeys(FLAG_COUNT_COLUMNS, 0)
+    fields = {'flag1': 2, 'flag2': 3}
+    first_accum = None
+    first_hour = None
+    for measure in details:
+        for column, field, value in FLAG_COUNTS:
+            if measure[fields[field]] == value:
+                counts[column] += 1
+        if measure[2] in ACCUM_FLAGS and (first_hour is None or int(measure[0]) < first_hour):
+            first_hour = int(measure[0])
+            first_accum = measure[2]
+
+    return ((station, period, read_date, units, len(details), float(sum(measure[1] for measure in details)),
+             daily_tot, daily_flag1, first_accum) + tuple(counts[column] for column in FLAG_COUNT_COLUMNS))
+
+
+def save_flag_summary(days: pd.DataFrame, conn: sqlite3.Connection):
+    """
+    Insert station-day summaries, and add them to the station-period totals (does not commit).
+    A station-period may be split between batches, so the period rows are added to any that are already there.
+    :param days: DataFrame with DAY_COLUMNS
+    :param conn: DB connection
+    :return: None
+    """
+    insert_sql = '''
+        INSERT INTO flag_summary_day
+            (%s)
+            VALUES (%s)
+    ''' % (', '.join(DAY_COLUMNS), ','.join('?' * len(DAY_COLUMNS)))
+    cur = conn.cursor()
+    cur.executemany(insert_sql, days[DAY_COLUMNS].itertuples(index=False, name=None))
+
+    periods = period_totals(days)
+    sums = ['day_cnt', 'hour_cnt', 'hour_amount', 'daily_amount', 'n_daily_incomplete',
+            'n_daily_partial'] + FLAG_COUNT_COLUMNS
+    upsert_sql = '''
+        INSERT INTO flag_summary_period
+            (%s)
+            VALUES (%s)
+        ON CONFLICT (station, period) DO UPDATE SET
+            units_h = COALESCE(MAX(units_h, excluded.units_h), units_h, excluded.units_h),
+            units_d = COALESCE(MAX(units_d, excluded.units_d), units_d, excluded.units_d),
+            %s
+    ''' % (', '.join(PERIOD_COLUMNS), ','.join('?' * len(PERIOD_COLUMNS)),
+           ',\n            '.join('%s = %s + excluded.%s' % (column, column, column) for column in sums))
+    cur.executemany(upsert_sql, periods[PERIOD_COLUMNS].itertuples(index=False, name=None))
+
+
+def period_totals(days: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add up station-day summaries by station-period (internal use only).
+    :param days: DataFrame with DAY_COLUMNS
+    :return: DataFrame with PERIOD_COLUMNS
+    """
+    # The units are numbered in sorted order, so the largest code is the largest units (as MAX gives in SQL)
+    units_codes, units = pd.factorize(days['units'], sort=True)
+    work = days.assign(
+        units_h=np.where(days['hour_cnt'] > 0, units_codes, -1),
+        units_d=units_codes,
+        day_cnt=1,
+        n_daily_incomplete=(days['daily_flag1'] == 'I').astype(np.int64),
+        n_daily_partial=(days['daily_flag1'] == 'P').astype(np.int64),
+    )
+    sums = ['day_cnt', 'hour_cnt', 'hour_amount', 'daily_amount', 'n_daily_incomplete',
+            'n_daily_partial'] + FLAG_COUNT_COLUMNS
+    agg = {column: 'sum' for column in sums}
+    agg.update(units_h='max', units_d='max')
+    periods = work.groupby(['station', 'period'], sort=False).agg(agg).reset_index().astype(object)
+    names = np.append(np.asarray(units, dtype=object), None)
+    for column in ['units_h', 'units_d']:
+        periods[column] = names[periods[column].to_numpy(dtype=np.int64)]
+    return periods
+
+
+def delete_station_periods(station_periods, conn: sqlite3.Connection):
+    """
+    Remove the summaries for station-periods that are about to be loaded again (does not commit).
+    :param station_periods: Collection of (station, period)
+    :param conn: DB connection
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.executemany("DELETE FROM flag_summary_day WHERE station = ? AND period = ?", station_periods)
+    cur.executemany("DELETE FROM flag_summary_period WHERE station = ? AND period = ?", station_periods)
+
+
+def set_daily_flag(conn: sqlite3.Connection, days_table: str, flag1: str):
+    """
+    Set the daily flag of some station-days, and recount the daily flags of their periods (does not commit).
+    This keeps the summary in step with fixes made to daily_raw.
+    :param conn: DB connection
+    :param days_table: Table (or subquery in parentheses) with the station and read_date of the days to change
+    :param flag1: New daily flag 1
+    :return: None
+    """
+    cur = conn.cursor()
+    cmd = '''
+        UPDATE flag_summary_day
+        SET daily_flag1 = ?
+        WHERE (station, read_date) IN (
+            SELECT station, read_date
+            FROM %s
+        )
+    ''' % days_table
+    cur.execute(cmd, (flag1,))
+
+    cmd = '''
+        UPDATE flag_summary_period
+        SET n_daily_incomplete = (
+                SELECT COUNT(1) FROM flag_summary_day fsd
+                WHERE fsd.station = flag_summary_period.station
+                AND fsd.period = flag_summary_period.period
+                AND fsd.daily_flag1 = 'I'
+            ),
+            n_daily_partial = (
+                SELECT COUNT(1) FROM flag_summary_day fsd
+                WHERE fsd.station = flag_summary_period.station
+                AND fsd.period = flag_summary_period.period
+                AND fsd.daily_flag1 = 'P'
+            )
+        WHERE (station, period) IN (
+            SELECT DISTINCT fsd.station, fsd.period
+            FROM flag_summary_day fsd
+            WHERE (fsd.station, fsd.read_date) IN (
+                SELECT station, read_date
+                FROM %s
+            )
+        )
+    ''' % days_table
+    cur.execute(cmd)
+
+
+def convert_raw_to_flag_summary(conn: sqlite3.Connection):
+    """
+    Fill the summary tables from the hourly_raw and daily_raw tables (replacing any rows in them), and mark the
+    summary complete.
+    :param conn: DB Connection
+    :return: None
+    """
+    cr_tb_flag_summary_state(conn)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM flag_summary_day")
+    cur.execute("DELETE FROM flag_summary_period")
+
+    counts = ''.join(",\n                SUM(CASE WHEN hr.%s = '%s' THEN 1 ELSE 0 END)" % (field, value)
+                     for column, field, value in FLAG_COUNTS)
+    # The first accumulation flag is found in the same pass by taking the lowest hour and flag together
+    cmd = '''
+        INSERT INTO flag_summary_day
+            (%s)
+            SELECT dr.station,
+                dr.period,
+                dr.read_date,
+                dr.units,
+                COUNT(hr.read_hour),
+                COALESCE(SUM(hr.amount), 0),
+                dr.amount,
+                dr.flag1,
+                SUBSTR(MIN(CASE WHEN hr.flag1 IN ('a','A') THEN PRINTF('%%04d', hr.read_hour) || hr.flag1 END), 5)%s
+            FROM daily_raw dr
+            LEFT JOIN hourly_raw hr
+            ON hr.station = dr.station
+            AND hr.read_date = dr.read_date
+            GROUP BY dr.station, dr.read_date
+    ''' % (', '.join(DAY_COLUMNS), counts)
+    cur.execute(cmd)
+
+    sums = ''.join(',\n                SUM(%s)' % column for column in FLAG_COUNT_COLUMNS)
+    cmd = '''
+        INSERT INTO flag_summary_period
+            (%s)
+            SELECT station,
+                period,
+                MAX(CASE WHEN hour_cnt > 0 THEN units END),
+                MAX(units),
+                COUNT(1),
+                SUM(hour_cnt),
+                SUM(hour_amount),
+                SUM(daily_amount),
+                SUM(CASE WHEN daily_flag1 = 'I' THEN 1 ELSE 0 END),
+                SUM(CASE WHEN daily_flag1 = 'P' THEN 1 ELSE 0 END)%s
+            FROM flag_summary_day
+            GROUP BY station, period
+    ''' % (', '.join(PERIOD_COLUMNS), sums)
+    cur.execute(cmd)
+    set_flag_summary_complete(conn, True)
+    conn.commit()
@@ -0,0 +1,191 @@
+"""
+Partial and covering indexes on the raw tables
+
+Besides their keys, the raw tables only have hr_period and dr_period (create_tables.add_indexes_hr_dr), so the hot
+queries either scan every row or look up each row they read from hr_period.  This adds:
+    partial     an index on only the flagged hours, which are a small share of hourly_raw, for the error flag fix
+                (fix/error_flag_fix.py) when it reads the raw tables.  Its check of the daily flags already goes
+                through the key of daily_raw.
+    covering    indexes with all of the columns of get_hourly and get_daily (readdb), in their sort order, so that
+                those, the station period queries (load/station_period.py) and the coverage (calc/coverage.py) read
+                the index in order without looking up rows or sorting.  Each is about as big as its table: on a
+                test database of a few years, hr_cover and dr_cover grew the file from 38 MB to 57 MB.
+
+check_plans runs EXPLAIN QUERY PLAN on the hot queries and reports the indexes they use, and report_plans prints
+the ones that do not use theirs (the pipeline and load_steps.py run it after building the indexes).  Run analyze
+after the indexes are created (and after large loads) so that the query planner has statistics for them.
+"""
+
+import sqlite3
+
+import fix.error_flag_fix as error_flag_fix
+import load.station_period as station_period
+
+# (name, table, columns, WHERE of a partial index, kind)
+INDEXES = [
+    ('hr_error_rows', 'hourly_raw', ['station', 'read_date', 'read_hour', 'flag1', 'flag2'],
+     error_flag_fix.HOURLY_ERROR_ROWS, 'partial'),
+    ('hr_cover', 'hourly_raw', ['station', 'period', 'read_date', 'read_hour', 'state_code', 'units', 'amount',
+                                'flag1', 'flag2'],
+     None, 'covering'),
+    ('dr_cover', 'daily_raw', ['station', 'period', 'read_date', 'state_code', 'units', 'amount', 'flag1', 'flag2'],
+     None, 'covering'),
+]
+INDEX_KINDS = ('partial', 'covering')
+
+# Rows read from the statistics for each index by analyze (see PRAGMA analysis_limit)
+ANALYSIS_LIMIT = 1000
+
+
+def index_names(kinds=INDEX_KINDS) -> list:
+    """
+    Get the names of the indexes.
+    :param kinds: Kinds of index
+    :return: List of index names
+    """
+    return [name for name, table, columns, where, kind in INDEXES if kind in kinds]
+
+
+def index_sql(name: str) -> str:
+    """
+    Build the CREATE INDEX statement for one of the indexes.
+    :param name: Index name (from INDEXES)
+    :return: SQL text
+    """
+    for index_name, table, columns, where, kind in INDEXES:
+        if index_name == name:
+            cmd = '''
+                CREATE INDEX IF NOT EXISTS %s
+                ON %s (
+                    %s
+                )
+            ''' % (name, table, ', '.join(columns))
+            if where is not None:
+                cmd += '''WHERE %s
+            ''' % where
+            return cmd
+    raise ValueError("Unknown index: %s" % name)
+
+
+def create_indexes(conn: sqlite3.Connection, kinds=INDEX_KINDS):
+    """
+    Create the indexes that are not there yet.  Tables that are views (as with the compact schema) are skipped.
+    :param conn: DB Connection
+    :param kinds: Kinds of index to create
+    :return: None
+    """
+    cur = conn.cursor()
+    tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name, table, columns, where, kind in INDEXES:
+        if kind in kinds and table in tables:
+            cur.execute(index_sql(name))
+    conn.commit()
+
+
+def drop_indexes(conn: sqlite3.Connection, kinds=INDEX_KINDS):
+    """
+    Drop the indexes (before a full reload, for example, since they slow down the inserts).
+    :param conn: DB Connection
+    :param kinds: Kinds of index to drop
+    :return: None
+    """
+    cur = conn.cursor()
+    for name in index_names(kinds):
+        cur.execute("DROP INDEX IF EXISTS %s" % name)
+    conn.commit()
+
+
+def analyze(conn: sqlite3.Connection, analysis_limit: int = ANALYSIS_LIMIT):
+    """
+    Gather the statistics that the query planner uses to choose between the indexes.
+    :param conn: DB Connection
+    :param analysis_limit: Rows to read per index (0 reads all of them, which takes minutes on the full tables)
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.execute("PRAGMA analysis_limit = %d" % analysis_limit)
+    cur.execute("ANALYZE")
+    conn.commit()
+
+
+def hot_queries(conn: sqlite3.Connection) -> list:
+    """
+    Get the hot queries on the raw tables, with the index each should use.
+    :param conn: DB Connection
+    :return: List of (name, SQL text, parameters, expected index)
+    """
+    stations = ['000000', '999999']
+    periods = ['1999-01', '2013-12']
+    return [
+        ('error_flags', error_flag_fix.day_counts_select(conn, use_summary=False), [], 'hr_error_rows'),
+        ('station_period_d', station_period.period_select('d'), [], 'dr_cover'),
+        ('station_period_h', station_period.period_select('h'), [], 'hr_cover'),
+        # As in readdb/hourly.get_hourly and readdb/daily.get_daily
+        ('get_hourly', '''
+            SELECT station, state_code, units, read_date, read_hour,
+                amount, flag1, flag2, period
+            FROM hourly_raw
+            WHERE station BETWEEN ? AND ?
+            AND period BETWEEN ? AND ?
+            ORDER BY station, period, read_date, read_hour
+        ''', stations + periods, 'hr_cover'),
+        ('get_daily', '''
+            SELECT station, state_code, units, read_date,
+                amount, flag1, flag2, period
+            FROM daily_raw
+            WHERE station BETWEEN ? AND ?
+            AND period BETWEEN ? AND ?
+            ORDER BY station, period, read_date
+        ''', stations + periods, 'dr_cover'),
+        # As in calc/coverage.plan_shards.  SQLite groups in the order of hr_period (station, period), the smallest
+        # index with both columns, and only sorts the counts (one row per station-period) for the ORDER BY.
+        ('coverage_shards', '''
+            SELECT period, station, COUNT(1) AS cnt
+            FROM hourly_raw
+            WHERE station BETWEEN ? AND ?
+            AND period BETWEEN ? AND ?
+            GROUP BY period, station
+            ORDER BY period, station
+        ''', stations + periods, 'hr_period'),
+    ]
+
+
+def query_plan(conn: sqlite3.Connection, querystr: str, params=()) -> list:
+    """
+    Get the query plan of a statement.
+    :param conn: DB Connection
+    :param querystr: SQL text
+    :param params: Parameters of the statement
+    :return: List of the plan lines (the detail column of EXPLAIN QUERY PLAN)
+    """
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + querystr, params)]
+
+
+def check_plans(conn: sqlite3.Connection) -> list:
+    """
+    Check that the hot queries use their indexes.
+    :param conn: DB Connection
+    :return: List of (name, expected index, True if the plan uses it, plan lines)
+    """
+    results = []
+    for name, querystr, params, index in hot_queries(conn):
+        plan = query_plan(conn, querystr, params)
+        uses_index = any(line.endswith(' ' + index) or (' ' + index + ' ') in line for line in plan)
+        results.append((name, index, uses_index, plan))
+    return results
+
+
+def report_plans(conn: sqlite3.Connection) -> bool:
+    """
+    Check the plans of the hot queries, printing those that do not use their index with their plans.
+    Queries whose index has not been created (as with the compact schema) are skipped.
+    :param conn: DB Connection
+    :return: True if every query checked uses its index
+    """
+    present = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    all_ok = True
+    for name, index, uses_index, plan in check_plans(conn):
+        if index in present and not uses_index:
+            all_ok = False
+            print("Query plan check: %s does not use %s\n    %s" % (name, index, "\n    ".join(plan)))
+    return all_ok
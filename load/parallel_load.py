@@ -0,0 +1,108 @@
+"""
+Load raw precipitation files with several parsing processes and one SQL writer
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+import sqlite3
+
+from main.config import *
+from load.PrecipBatch import PrecipBatch
+import load.db_load as db_load
+
+
+def import_precip_files_parallel(fnames: list, conn: sqlite3.Connection, workers: int = None,
+                                 shard_size: int = 1 << 26):
+    """
+    Import raw precipitation data files, parsing in a process pool.
+    Large files (the yearly files) are split into byte ranges cut at line boundaries, so one
+    big year parses on all cores.  Only this process writes to SQL, since sqlite allows one writer.
+    When run as a script on Windows, call this under "if __name__ == '__main__':".
+    :param fnames: Filenames
+    :param conn: DB connection
+    :param workers: Number of parsing processes (defaults to load_workers in config, then all cores)
+    :param shard_size: Approximate number of bytes per shard
+    :return: Tuple of hourly and daily row counts written
+    """
+    shards = []
+    for fname in fnames:
+        shards += split_file(fname, shard_size)
+
+    return load_parallel(parse_shard, shards, conn, workers)
+
+
+def load_parallel(func, tasks: list, conn: sqlite3.Connection, workers: int = None):
+    """
+    Run a parsing function over a list of tasks in a process pool and save each parsed batch.
+    :param func: Function taking the task's arguments and returning a PrecipBatch (must be importable)
+    :param tasks: List of argument tuples
+    :param conn: DB connection
+    :param workers: Number of parsing processes (defaults to load_workers in config, then all cores)
+    :return: Tuple of hourly and daily row counts written
+    """
+    if workers is None:
+        workers = load_workers or os.cpu_count()
+
+    hour_cnt = 0
+    day_cnt = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded number of tasks in flight so parsed batches do not pile up
+        # in memory while the writer is busy
+        pending = set()
+        task_iter = iter(tasks)
+        for task in task_iter:
+            pending.add(pool.submit(func, *task))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = future.result()
+                db_load.save_precip_batch(batch, conn)
+                hour_cnt += len(batch.h_line)
+                day_cnt += batch.n_lines
+                task = next(task_iter, None)
+                if task is not None:
+                    pending.add(pool.submit(func, *task))
+
+    conn.commit()
+    return hour_cnt, day_cnt
+
+
+def split_file(fname, shard_size: int) -> list:
+    """
+    Split a file into byte ranges that end on line boundaries.
+    :param fname: Filename
+    :param shard_size: Approximate number of bytes per shard
+    :return: List of (fname, start, end)
+    """
+    size = os.path.getsize(fname)
+    shards = []
+    start = 0
+    with open(fname, "rb") as infile:
+        while start < size:
+            end = start + shard_size
+            if end >= size:
+                end = size
+            else:
+                # Move the end forward to the next line break
+                infile.seek(end)
+                infile.readline()
+                end = infile.tell()
+            shards.append((fname, start, end))
+            start = end
+    return shards
+
+
+def parse_shard(fname, start: int, end: int) -> PrecipBatch:
+    """
+    Parse one byte range of a file (runs in the worker processes).
+    :param fname: Filename
+    :param start: Starting byte (at the start of a line)
+    :param end: Ending byte (just past a line break)
+    :return: Parsed lines
+    """
+    with open(fname, "rb") as infile:
+        infile.seek(start)
+        buf = infile.read(end - start)
+    return PrecipBatch(buf)
@@ -0,0 +1,73 @@
+"""
+Export the raw tables to Parquet for fast columnar reads
+"""
+
+import os
+import shutil
+import sqlite3
+
+from main.config import *
+import pandas as pd
+
+
+def export_raw_parquet(conn: sqlite3.Connection, start_year: int = 1999, end_year: int = 2013,
+                       out_dir: str = parquet_data_dir, row_group_size: int = 65536):
+    """
+    Export hourly_raw and daily_raw to Parquet datasets partitioned by year and period.
+    Rows are sorted by station within each period, so the row group statistics let readers
+    skip straight to a station range.  Requires pyarrow.
+    :param conn: DB connection
+    :param start_year: First year to export
+    :param end_year: Last year to export
+    :param out_dir: Base directory for the datasets
+    :param row_group_size: Rows per Parquet row group
+    :return: None
+    """
+    hourly_cols = ['station', 'state_code', 'units', 'read_date', 'read_hour', 'amount', 'flag1', 'flag2', 'period']
+    daily_cols = ['station', 'state_code', 'units', 'read_date', 'amount', 'flag1', 'flag2', 'period']
+
+    for year in range(start_year, end_year + 1):
+        export_table_year('hourly_raw', hourly_cols, ['period', 'station', 'read_date', 'read_hour'], year,
+                          conn, out_dir, row_group_size)
+        export_table_year('daily_raw', daily_cols, ['period', 'station', 'read_date'], year,
+                          conn, out_dir, row_group_size)
+
+
+def export_table_year(table: str, columns: list, sort_cols: list, year: int, conn: sqlite3.Connection,
+                      out_dir: str = parquet_data_dir, row_group_size: int = 65536):
+    """
+    Export one year of a raw table, replacing any earlier export of that year.
+    :param table: Table name
+    :param columns: Columns to export
+    :param sort_cols: Sort order of the rows
+    :param year: Year to export
+    :param conn: DB connection
+    :param out_dir: Base directory for the datasets
+    :param row_group_size: Rows per Parquet row group
+    :return: Number of rows written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    querystr = '''
+        SELECT %s
+        FROM %s
+        WHERE period BETWEEN ? AND ?
+    ''' % (', '.join(columns), table)
+    df = pd.read_sql_query(querystr, conn, params=['%d-01' % year, '%d-12' % year])
+    if len(df) == 0:
+        return 0
+    df = df.sort_values(sort_cols, ignore_index=True)
+    df['year'] = year
+
+    year_dir = join(out_dir, table, 'year=%d' % year)
+    if os.path.isdir(year_dir):
+        shutil.rmtree(year_dir)
+
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        join(out_dir, table),
+        partition_cols=['year', 'period'],
+        row_group_size=row_group_size,
+    )
+    return len(df)
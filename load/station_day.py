@@ -0,0 +1,227 @@
+"""
+Wide storage with one row per station-day, the same shape as the lines in the DSI 3240 files.
+
+The hourly readings of a day are packed into fixed 24 slot blobs, where slot i holds the reading for
+the hour ending at i + 1 (read_hour (i + 1) * 100):
+    amounts     24 little-endian int32 values, EMPTY_AMOUNT where there is no reading
+    flag1/2     24 bytes holding the flag characters, 0 where there is no reading
+"""
+
+import sqlite3
+
+import numpy as np
+
+from load.PrecipBatch import PrecipBatch, read_precip_batches
+
+HOURS = 24
+EMPTY_AMOUNT = np.iinfo(np.int32).min
+AMOUNT_DTYPE = np.dtype('<i4')
+
+
+def cr_tb_station_day(conn: sqlite3.Connection):
+    """
+    Create the station_day table
+    :param conn: DB Connection
+    :return: None
+    """
+    cmd = '''
+        CREATE TABLE station_day (
+            station VARCHAR(6) NOT NULL,
+            state_code VARCHAR(2) NOT NULL,
+            units VARCHAR(2) NOT NULL,
+            read_date INTEGER NOT NULL,
+            period VARCHAR(7) NOT NULL,
+            hour_cnt INTEGER NOT NULL,
+            daily_amount REAL,
+            daily_flag1 VARCHAR(1),
+            daily_flag2 VARCHAR(1),
+            amounts BLOB NOT NULL,
+            flag1 BLOB NOT NULL,
+            flag2 BLOB NOT NULL,
+            PRIMARY KEY (station, read_date)
+        ) WITHOUT ROWID
+    '''
+    cur = conn.cursor()
+    cur.execute(cmd)
+
+    cmd = '''
+        CREATE INDEX sd_period
+        ON station_day (
+            station, period
+        )
+    '''
+    cur.execute(cmd)
+    conn.commit()
+
+
+def pack_hours(n_days: int, day_idx: np.ndarray, read_hour: np.ndarray, amount: np.ndarray,
+               flag1: np.ndarray, flag2: np.ndarray):
+    """
+    Pack hourly readings into the 24 slot arrays.
+    :param n_days: Number of station-days
+    :param day_idx: Station-day of each reading (0 to n_days - 1)
+    :param read_hour: Hour of each reading (HHMM, 0100-2400)
+    :param amount: Amount of each reading
+    :param flag1: Flag 1 of each reading (single characters)
+    :param flag2: Flag 2 of each reading (single characters)
+    :return: Tuple of amount (int32), flag1 and flag2 (uint8) arrays, each of shape (n_days, 24)
+    """
+    slot = np.asarray(read_hour) // 100 - 1
+    if len(slot) and (slot.min() < 0 or slot.max() >= HOURS):
+        raise ValueError("Hour outside 0100-2400: %d" % (read_hour[(slot < 0) | (slot >= HOURS)][0]))
+
+    amounts = np.full((n_days, HOURS), EMPTY_AMOUNT, dtype=AMOUNT_DTYPE)
+    flags1 = np.zeros((n_days, HOURS), dtype=np.uint8)
+    flags2 = np.zeros((n_days, HOURS), dtype=np.uint8)
+
+    amounts[day_idx, slot] = amount
+    flags1[day_idx, slot] = _flag_codes(flag1)
+    flags2[day_idx, slot] = _flag_codes(flag2)
+
+    if np.count_nonzero(flags1) != len(slot):
+        raise ValueError("The same hour appears twice in one station-day")
+
+    return amounts, flags1, flags2
+
+
+def unpack_hours(amounts, flag1, flag2):
+    """
+    Decode the packed hourly blobs of a list of station-days into arrays.
+    :param amounts: Sequence of amount blobs
+    :param flag1: Sequence of flag 1 blobs
+    :param flag2: Sequence of flag 2 blobs
+    :return: Tuple of amount (float, NaN where there is no reading), flag1 and flag2 ('S1', b'' where
+        there is no reading) arrays, each of shape (number of days, 24)
+    """
+    raw = np.frombuffer(b"".join(amounts), dtype=AMOUNT_DTYPE).reshape(-1, HOURS)
+    amount = np.where(raw == EMPTY_AMOUNT, np.nan, raw)
+    flags1 = np.frombuffer(b"".join(flag1), dtype='S1').reshape(-1, HOURS)
+    flags2 = np.frombuffer(b"".join(flag2), dtype='S1').reshape(-1, HOURS)
+    return amount, flags1, flags2
+
+
+def import_precip_file_station_day(fname, conn: sqlite3.Connection):
+    """
+    Import a single raw precipitation data file into the station_day table.
+    :param fname: Filename
+    :param conn: DB connection
+    :return: None
+    """
+    for batch in read_precip_batches(fname):
+        save_precip_batch_station_day(batch, conn)
+
+    conn.commit()
+
+
+def save_precip_batch_station_day(batch: PrecipBatch, conn: sqlite3.Connection):
+    """
+    Insert one station_day row per line of a parsed batch (does not commit).
+    :param batch: Parsed lines
+    :param conn: DB connection
+    :return: None
+    """
+    insert_sql = '''
+        INSERT INTO station_day
+            (station, state_code, units, read_date, period, hour_cnt,
+            daily_amount, daily_flag1, daily_flag2, amounts, flag1, flag2)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+    '''
+    amounts, flags1, flags2 = pack_hours(batch.n_lines, batch.h_line, batch.read_hour, batch.amount,
+                                         batch.flag1, batch.flag2)
+    hour_cnt = np.bincount(batch.h_line, minlength=batch.n_lines)
+
+    cur = conn.cursor()
+    cur.executemany(insert_sql, zip(
+        batch.station.tolist(),
+        batch.state_code.tolist(),
+        batch.units.tolist(),
+        batch.read_date.tolist(),
+        batch.period.tolist(),
+        hour_cnt.tolist(),
+        batch.daily_tot.tolist(),
+        batch.daily_flag1.tolist(),
+        batch.daily_flag2.tolist(),
+        _row_blobs(amounts),
+        _row_blobs(flags1),
+        _row_blobs(flags2)
+    ))
+
+
+def convert_raw_to_station_day(conn: sqlite3.Connection, start_period: str = None, end_period: str = None):
+    """
+    Fill station_day from the hourly_raw and daily_raw tables, one period at a time.
+    :param conn: DB Connection
+    :param start_period: First period to convert (defaults to all)
+    :param end_period: Last period to convert (defaults to start_period, or all)
+    :return: None
+    """
+    cur = conn.cursor()
+    if start_period is None:
+        periods = [row[0] for row in cur.execute("SELECT DISTINCT period FROM daily_raw ORDER BY period")]
+    else:
+        if end_period is None:
+            end_period = start_period
+        querystr = "SELECT DISTINCT period FROM daily_raw WHERE period BETWEEN ? AND ? ORDER BY period"
+        periods = [row[0] for row in cur.execute(querystr, (start_period, end_period))]
+
+    insert_sql = '''
+        INSERT INTO station_day
+            (station, state_code, units, read_date, period, hour_cnt,
+            daily_amount, daily_flag1, daily_flag2, amounts, flag1, flag2)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+    '''
+    for period in periods:
+        querystr = '''
+            SELECT station, state_code, units, read_date, amount, flag1, flag2
+            FROM daily_raw
+            WHERE period = ?
+            ORDER BY station, read_date
+        '''
+        days = cur.execute(querystr, (period,)).fetchall()
+        day_key = {(row[0], row[3]): i for i, row in enumerate(days)}
+
+        querystr = '''
+            SELECT station, read_date, read_hour, amount, flag1, flag2
+            FROM hourly_raw
+            WHERE period = ?
+        '''
+        hours = cur.execute(querystr, (period,)).fetchall()
+        if hours:
+            station, read_date, read_hour, amount, flag1, flag2 = zip(*hours)
+        else:
+            station = read_date = read_hour = amount = flag1 = flag2 = ()
+        day_idx = np.array([day_key[key] for key in zip(station, read_date)], dtype=np.int64)
+
+        amounts, flags1, flags2 = pack_hours(len(days), day_idx, np.array(read_hour, dtype=np.int64),
+                                             np.array(amount, dtype=np.int64), np.array(flag1, dtype=object),
+                                             np.array(flag2, dtype=object))
+        hour_cnt = np.bincount(day_idx, minlength=len(days))
+
+        cur.executemany(insert_sql, (
+            (row[0], row[1], row[2], row[3], period, cnt, row[4], row[5], row[6], a, f1, f2)
+            for row, cnt, a, f1, f2 in zip(days, hour_cnt.tolist(), _row_blobs(amounts), _row_blobs(flags1),
+                                           _row_blobs(flags2))
+        ))
+        conn.commit()
+
+
+def _flag_codes(flags: np.ndarray) -> np.ndarray:
+    """
+    Convert an array of single character flags to their byte codes (internal use only).
+    :param flags: Array of str
+    :return: uint8 array
+    """
+    if len(flags) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.frombuffer("".join(flags.tolist()).encode("latin-1"), dtype=np.uint8)
+
+
+def _row_blobs(arr: np.ndarray) -> list:
+    """
+    Split a 2D array into one bytes object per row (internal use only).
+    :param arr: 2D array
+    :return: List of bytes
+    """
+    buf = arr.tobytes()
+    width = arr.shape[1] * arr.itemsize
+    return [buf[i:i + width] for i in range(0, len(buf), width)]
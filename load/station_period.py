@@ -3,66 +3,205 @@ Load tables for good periods for stations
 """
 
 from main.config import *
+import main.db as db
+import load.flag_summary as flag_summary
 import sqlite3
 
+# The tables built from each raw table, and the flags that keep a station-period out of them.  The summary_* entries
+# give the same test on flag_summary_period (see load/flag_summary.py), which is read instead of the raw table when
+# it is complete.
+#   d: periods with complete daily data (no incomplete or partial days)
+#   h: periods with complete hourly data (no accumulations, missing, deleted or questionable hours)
+PERIOD_TABLES = {
+    'd': {
+        'raw_table': 'daily_raw',
+        'period_table': 'station_period_d',
+        'year_table': 'station_year_d',
+        'bad_flags': "flag1 IN ('I','P')",
+        'summary_amount': 'daily_amount',
+        'summary_units': 'units_d',
+        'summary_ok': 'n_daily_incomplete + n_daily_partial = 0',
+    },
+    'h': {
+        'raw_table': 'hourly_raw',
+        'period_table': 'station_period_h',
+        'year_table': 'station_year_h',
+        'bad_flags': "flag1 IN ('a','A',',','[',']','{','}') OR flag2 IN ('Q','q')",
+        'summary_amount': 'hour_amount',
+        'summary_units': 'units_h',
+        'summary_ok': 'hour_cnt > 0 AND n_accum_start + n_accum_end + n_comma + n_missing_start + n_missing_end '
+                      '+ n_deleted_start + n_deleted_end + n_q_upper + n_q_lower = 0',
+    },
+}
 
-def load_station_period_d():
+
+def load_station_period_d(conn: sqlite3.Connection = None):
     """
     Load table of periods with complete daily data.
+    :param conn: DB connection (if omitted, the shared connection is used)
     :return: None
     """
+    load_station_period('d', conn)
+
+
+def load_station_period_h(conn: sqlite3.Connection = None):
+    """
+    Load table of periods with complete hourly data.
+    :param conn: DB connection (if omitted, the shared connection is used)
+    :return: None
+    """
+    load_station_period('h', conn)
+
+
+def period_select(kind: str, where: str = '') -> str:
+    """
+    Build the grouped query for a station period table (internal use only).
+    The bad flags are counted in the same pass as the totals, so each station-period is read once.
+    :param kind: 'd' or 'h'
+    :param where: Extra FROM/WHERE text to limit the station-periods
+    :return: SQL text
+    """
+    spec = PERIOD_TABLES[kind]
+    return '''
+        SELECT raw.station,
+            raw.period,
+            SUM(raw.amount),
+            CASE WHEN MAX(raw.units) = 'HI' THEN 1 ELSE 2 END AS units_flag
+        FROM %s raw
+        %s
+        GROUP BY raw.station, raw.period
+        HAVING SUM(CASE WHEN %s THEN 1 ELSE 0 END) = 0
+    ''' % (spec['raw_table'], where, spec['bad_flags'])
 
-    querystr = '''
-        INSERT INTO station_period_d
+
+def summary_select(kind: str) -> str:
+    """
+    Build the query for a station period table from flag_summary_period (internal use only).
+    :param kind: 'd' or 'h'
+    :return: SQL text
+    """
+    spec = PERIOD_TABLES[kind]
+    return '''
         SELECT station,
             period,
-            SUM(amount),
-            CASE WHEN MAX(units) = 'HI' THEN 1 ELSE 2 END AS units_flag
-        FROM daily_raw dr
-        WHERE NOT EXISTS (
-            SELECT 1 FROM daily_raw dr2
-            WHERE dr2.station = dr.station
-            AND dr2.period = dr.period
-            AND flag1 IN ('I','P')
-        )
-        GROUP BY station, period
-    '''
-
-    conn: sqlite3.Connection = sqlite3.connect(sqldbname)
+            %s,
+            CASE WHEN %s = 'HI' THEN 1 ELSE 2 END AS units_flag
+        FROM flag_summary_period
+        WHERE %s
+    ''' % (spec['summary_amount'], spec['summary_units'], spec['summary_ok'])
+
+
+def load_station_period(kind: str, conn: sqlite3.Connection = None):
+    """
+    Load a station period table in one pass, from flag_summary_period if it is complete, or else from the raw table.
+    :param kind: 'd' or 'h' (see PERIOD_TABLES)
+    :param conn: DB connection (if omitted, the shared connection is used)
+    :return: None
+    """
+    if conn is None:
+        conn = db.get_connection()
+
+    if flag_summary.flag_summary_complete(conn):
+        select = summary_select(kind)
+    else:
+        select = period_select(kind)
+    querystr = "INSERT INTO %s %s" % (PERIOD_TABLES[kind]['period_table'], select)
+
     curr = conn.cursor()
     curr.execute(querystr)
 
     conn.commit()
-    conn.close()
 
 
-def load_station_period_h():
+def year_select(kind: str, where: str = '') -> str:
     """
-    Load table of periods with complete hourly data.
-    :return: None
+    Build the query rolling a station period table up to years (internal use only).
+    A year is complete when all 12 of its periods are in the period table.
+    :param kind: 'd' or 'h'
+    :param where: Extra WHERE text to limit the station-years
+    :return: SQL text
     """
-    querystr = '''
-        INSERT INTO station_period_h
+    return '''
         SELECT station,
-            period,
+            CAST(SUBSTR(period, 1, 4) AS INTEGER) AS year,
             SUM(amount),
-            CASE WHEN MAX(units) = 'HI' THEN 1 ELSE 2 END AS units_flag
-        FROM hourly_raw hr
-        WHERE NOT EXISTS (
-            SELECT 1 FROM hourly_raw hr2
-            WHERE hr2.station = hr.station
-            AND hr2.period = hr.period
-            AND (
-                flag1 IN ('a','A',',','[',']','{','}')
-                OR flag2 IN ('Q','q')
-            )
-        )
-        GROUP BY station, period
-    '''
-
-    conn: sqlite3.Connection = sqlite3.connect(sqldbname)
+            MAX(units_flag)
+        FROM %s
+        %s
+        GROUP BY station, year
+        HAVING COUNT(1) = 12
+    ''' % (PERIOD_TABLES[kind]['period_table'], where)
+
+
+def load_station_year(kind: str, conn: sqlite3.Connection = None):
+    """
+    Load a station year table (station_year_d or station_year_h) from its station period table.
+    :param kind: 'd' or 'h' (see PERIOD_TABLES)
+    :param conn: DB connection (if omitted, the shared connection is used)
+    :return: None
+    """
+    if conn is None:
+        conn = db.get_connection()
+
+    querystr = "INSERT INTO %s %s" % (PERIOD_TABLES[kind]['year_table'], year_select(kind))
+
     curr = conn.cursor()
     curr.execute(querystr)
 
     conn.commit()
-    conn.close()
+
+
+def refresh_station_periods(station_periods, conn: sqlite3.Connection = None, kinds=('d', 'h')):
+    """
+    Recalculate the station period and station year rows for the given station-periods, after their raw rows
+    have been replaced.  Only the tables that exist are updated.  If the error flag fixes apply to these
+    periods, they should be run again first.
+    :param station_periods: Collection of (station, period)
+    :param conn: DB connection (if omitted, the shared connection is used)
+    :param kinds: Table kinds to refresh (see PERIOD_TABLES)
+    :return: None
+    """
+    if conn is None:
+        conn = db.get_connection()
+
+    curr = conn.cursor()
+    tables = {row[0] for row in curr.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    kinds = [kind for kind in kinds if PERIOD_TABLES[kind]['period_table'] in tables]
+    if not kinds or not station_periods:
+        return
+
+    curr.execute("DROP TABLE IF EXISTS temp.refresh_period")
+    curr.execute("CREATE TEMP TABLE refresh_period (station TEXT, period TEXT, PRIMARY KEY (station, period))")
+    curr.executemany("INSERT OR IGNORE INTO temp.refresh_period VALUES (?,?)", station_periods)
+    curr.execute("DROP TABLE IF EXISTS temp.refresh_year")
+    curr.execute('''
+        CREATE TEMP TABLE refresh_year AS
+        SELECT DISTINCT station, CAST(SUBSTR(period, 1, 4) AS INTEGER) AS year
+        FROM temp.refresh_period
+    ''')
+
+    for kind in kinds:
+        spec = PERIOD_TABLES[kind]
+        curr.execute('''
+            DELETE FROM %s
+            WHERE (station, period) IN (SELECT station, period FROM temp.refresh_period)
+        ''' % spec['period_table'])
+        where = '''
+            JOIN temp.refresh_period rp
+            ON rp.station = raw.station AND rp.period = raw.period
+        '''
+        curr.execute("INSERT INTO %s %s" % (spec['period_table'], period_select(kind, where)))
+
+        if spec['year_table'] in tables:
+            curr.execute('''
+                DELETE FROM %s
+                WHERE (station, year) IN (SELECT station, year FROM temp.refresh_year)
+            ''' % spec['year_table'])
+            where = '''
+                WHERE (station, CAST(SUBSTR(period, 1, 4) AS INTEGER)) IN (SELECT station, year FROM temp.refresh_year)
+            '''
+            curr.execute("INSERT INTO %s %s" % (spec['year_table'], year_select(kind, where)))
+
+    curr.execute("DROP TABLE temp.refresh_period")
+    curr.execute("DROP TABLE temp.refresh_year")
+    conn.commit()
@@ -0,0 +1,329 @@
+"""
+Download, decompress, parse and load the yearly archives as one overlapped stream
+
+Instead of downloading every archive, then extracting them, then loading the year files, the three stages run at
+once, joined by bounded queues:
+    download    a pool of FTP sessions (download/ftp_download.py) puts each archive on the files queue
+    parse       a thread hands the archives to a process pool that decompresses and parses them in memory
+                (archive_load.parse_archive), and puts the results on the parsed queue in order
+    load        the calling thread saves each parsed archive and commits it
+When a queue is full, the stage before it waits, so no more than about two queues' worth of archives (plus one per
+FTP session) are on disk or in memory ahead of the loader.  With keep_archives=False each archive is deleted once it is
+loaded, so the scratch space stays that small; with the default, the archives stay in orig_data_dir and later
+downloads skip them.
+
+Each stage counts its archives, bytes of archive, rows (lines parsed, or hourly and daily rows written), busy time
+and the time it spent waiting on its queues (a stage that waits to put is held back by the next one; one that waits
+to get is starved by the one before), so the report shows which of network, CPU or disk is the limit.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+from os.path import basename, getsize
+import queue
+import sqlite3
+import threading
+import time
+
+import main.config as config
+import download.ftp_download as ftp_download
+import load.archive_load as archive_load
+import load.db_load as db_load
+
+# Seconds between checks for a stop while waiting on a queue
+QUEUE_POLL_SEC = 0.5
+
+
+class StageCounter:
+    """
+    Counts for one stage of the stream (shared by the threads of the stage)
+    """
+
+    def __init__(self, name: str):
+        """
+        Init StageCounter.
+        :param name: Stage name
+        """
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.rows = 0
+        self.busy_sec = 0.0
+        self.wait_sec = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int = 0, nbytes: int = 0, rows: int = 0, busy_sec: float = 0.0, wait_sec: float = 0.0):
+        """
+        Add to the counts.
+        :param items: Archives done
+        :param nbytes: Bytes of archive done
+        :param rows: Lines parsed or rows written
+        :param busy_sec: Time spent working
+        :param wait_sec: Time spent waiting on a queue
+        :return: None
+        """
+        with self._lock:
+            self.items += items
+            self.bytes += nbytes
+            self.rows += rows
+            self.busy_sec += busy_sec
+            self.wait_sec += wait_sec
+
+    def report(self) -> str:
+        """
+        Summary of the stage.
+        :return: Text for printing
+        """
+        rate = self.bytes / 1e6 / self.busy_sec if self.busy_sec else 0.0
+        return ("%-8s %5d archives %9.1f MB %11d rows   busy %7.1f s (%6.2f MB/s)   waiting %7.1f s"
+                % (self.name, self.items, self.bytes / 1e6, self.rows, self.busy_sec, rate, self.wait_sec))
+
+
+class StreamStats:
+    """
+    Counts for a run of the stream
+    """
+
+    def __init__(self):
+        """
+        Init StreamStats.
+        """
+        self.download = StageCounter('download')
+        self.parse = StageCounter('parse')
+        self.load = StageCounter('load')
+        self.listed = 0
+        self.skipped = 0
+        self.failed = []
+        self.wall_sec = None
+        self._start = time.perf_counter()
+
+    def finish(self, download_stats: ftp_download.DownloadStats):
+        """
+        Stop the clock and take the failures from the downloader.
+        :param download_stats: Totals of the download stage
+        :return: None
+        """
+        self.failed = download_stats.failed
+        self.wall_sec = time.perf_counter() - self._start
+
+    def report(self) -> str:
+        """
+        Summary of the run, one line per stage.
+        :return: Text for printing
+        """
+        lines = ["Listed %d archives (%d loaded before), loaded %d, failed %d in %.1f seconds"
+                 % (self.listed + self.skipped, self.skipped, self.load.items, len(self.failed),
+                    self.wall_sec or 0.0)]
+        lines += [stage.report() for stage in (self.download, self.parse, self.load)]
+        return "\n".join(lines)
+
+
+def queue_put(q: queue.Queue, item, stop: threading.Event) -> float:
+    """
+    Put an item on a bounded queue, waiting while it is full (internal use only).
+    :param q: Queue
+    :param item: Item
+    :param stop: Event set when the stream is stopping
+    :return: Seconds spent waiting
+    """
+    start = time.perf_counter()
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=QUEUE_POLL_SEC)
+            break
+        except queue.Full:
+            pass
+    return time.perf_counter() - start
+
+
+def queue_get(q: queue.Queue, stop: threading.Event) -> tuple:
+    """
+    Get an item from a queue, waiting while it is empty (internal use only).
+    :param q: Queue
+    :param stop: Event set when the stream is stopping
+    :return: Tuple of the item (None if stopped) and the seconds spent waiting
+    """
+    start = time.perf_counter()
+    while not stop.is_set():
+        try:
+            return q.get(timeout=QUEUE_POLL_SEC), time.perf_counter() - start
+        except queue.Empty:
+            pass
+    return None, time.perf_counter() - start
+
+
+def parse_archive_timed(fname) -> tuple:
+    """
+    Parse a whole archive, timing the work (runs in the worker processes).
+    :param fname: Archive filename
+    :return: Tuple of the PrecipBatch and the seconds it took
+    """
+    start = time.perf_counter()
+    batch = archive_load.parse_archive(fname)
+    return batch, time.perf_counter() - start
+
+
+def download_stage(files: list, sessions: ftp_download.FtpSessions, pool: ThreadPoolExecutor, dest_dir: str,
+                   retries: int, files_q: queue.Queue, stop: threading.Event, stats: StreamStats,
+                   download_stats: ftp_download.DownloadStats):
+    """
+    Download the archives with the FTP pool and put each one on the files queue (runs in its own thread).
+    :param files: List of (remote path, size)
+    :param sessions: FTP sessions
+    :param pool: Thread pool, one thread per FTP session
+    :param dest_dir: Local directory
+    :param retries: Tries per file
+    :param files_q: Queue of downloaded archives
+    :param stop: Event set when the stream is stopping
+    :param stats: Stream counts
+    :param download_stats: Totals for the downloader
+    :return: None
+    """
+
+    def download_one(remote: str, size: int):
+        if stop.is_set():
+            return
+        start = time.perf_counter()
+        local = ftp_download.download_file(sessions, remote, size, dest_dir, retries, download_stats)
+        busy = time.perf_counter() - start
+        if local is None:
+            stats.download.add(busy_sec=busy)
+            return
+        wait = queue_put(files_q, local, stop)
+        stats.download.add(items=1, nbytes=getsize(local), busy_sec=busy, wait_sec=wait)
+
+    try:
+        list(pool.map(lambda file: download_one(*file), files))
+    finally:
+        queue_put(files_q, None, stop)
+
+
+def parse_stage(files_q: queue.Queue, parsed_q: queue.Queue, pool: ProcessPoolExecutor, stop: threading.Event,
+                stats: StreamStats):
+    """
+    Hand the downloaded archives to the parsing processes, in order (runs in its own thread).
+    Since the parsed queue is bounded, only a few archives are parsed ahead of the loader.
+    :param files_q: Queue of downloaded archives
+    :param parsed_q: Queue of (archive filename, future of parse_archive_timed)
+    :param pool: Process pool
+    :param stop: Event set when the stream is stopping
+    :param stats: Stream counts
+    :return: None
+    """
+    try:
+        while True:
+            fname, wait = queue_get(files_q, stop)
+            stats.parse.add(wait_sec=wait)
+            if fname is None:
+                break
+            stats.parse.add(wait_sec=queue_put(parsed_q, (fname, pool.submit(parse_archive_timed, fname)), stop))
+    finally:
+        queue_put(parsed_q, None, stop)
+
+
+def stream_load_archives(conn: sqlite3.Connection, first_year: int = None, last_year: int = None,
+                         dest_dir: str = None, keep_archives: bool = True, skip=(), mark_done=None,
+                         n_sessions: int = None, workers: int = None, queue_size: int = None, host: str = None,
+                         port: int = None, root: str = None, user: str = '', passwd: str = '',
+                         retries: int = None) -> StreamStats:
+    """
+    Download the yearly archives and load them as they arrive.
+    Each archive is saved and committed on its own, so a stopped run loses at most the archives in flight; pass the
+    archives already loaded in skip (with mark_done recording each one) to carry on where it stopped.  Archives that
+    could not be downloaded do not stop the others from loading, but the stream raises an error at the end, so that
+    a caller (such as the load_year step of main/pipeline.py) does not count the load as complete.
+    :param conn: DB connection (used only by the calling thread)
+    :param first_year: First year (default first_year in config.py)
+    :param last_year: Last year (default last_year in config.py; the yearly files end with 2011)
+    :param dest_dir: Directory for the downloaded archives (default orig_data_dir)
+    :param keep_archives: Keep the archives after they are loaded
+    :param skip: Names of archives to leave out (already loaded)
+    :param mark_done: Function (conn, archive name) called after each archive is saved, which must commit;
+        if omitted, each archive is committed
+    :param n_sessions: Number of FTP sessions (default ftp_sessions)
+    :param workers: Number of parsing processes (default load_workers, then all cores)
+    :param queue_size: Size of the queues between the stages (default stream_queue_size)
+    :param host: FTP host (default ftp_host)
+    :param port: FTP port (default ftp_port)
+    :param root: Archive directory (default ftp_dir)
+    :param user: User name (anonymous if empty)
+    :param passwd: Password
+    :param retries: Tries per file (default ftp_retries)
+    :return: StreamStats
+    :raises RuntimeError: If any archive could not be downloaded (after the others are loaded)
+    """
+    first_year = config.first_year if first_year is None else first_year
+    last_year = config.last_year if last_year is None else last_year
+    dest_dir = config.orig_data_dir if dest_dir is None else dest_dir
+    n_sessions = config.ftp_sessions if n_sessions is None else n_sessions
+    workers = (config.load_workers or os.cpu_count()) if workers is None else workers
+    queue_size = config.stream_queue_size if queue_size is None else queue_size
+    retries = config.ftp_retries if retries is None else retries
+    skip = set(skip)
+
+    stats = StreamStats()
+    download_stats = ftp_download.DownloadStats()
+    files_q = queue.Queue(maxsize=queue_size)
+    parsed_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    # Start the parsing processes before any FTP session is open, so that they do not hold copies of its sockets (a
+    # session closed here would stay open on the server).  With fork, the pool starts all of them at the first submit.
+    parse_pool = ProcessPoolExecutor(max_workers=workers)
+    parse_pool.submit(os.getpid).result()
+    sessions = ftp_download.FtpSessions(config.ftp_host if host is None else host,
+                                        config.ftp_port if port is None else port, user, passwd)
+    ftp_pool = ThreadPoolExecutor(max_workers=n_sessions)
+    threads = []
+    try:
+        files = ftp_download.list_archive(sessions, ftp_pool, config.ftp_dir if root is None else root, first_year,
+                                          last_year)
+        stats.listed = len([file for file in files if basename(file[0]) not in skip])
+        stats.skipped = len(files) - stats.listed
+        files = [file for file in files if basename(file[0]) not in skip]
+
+        threads = [
+            threading.Thread(target=download_stage, args=(files, sessions, ftp_pool, dest_dir, retries, files_q,
+                                                          stop, stats, download_stats)),
+            threading.Thread(target=parse_stage, args=(files_q, parsed_q, parse_pool, stop, stats)),
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Load stage
+        while True:
+            item, wait = queue_get(parsed_q, stop)
+            if item is None:
+                stats.load.add(wait_sec=wait)
+                break
+            fname, future = item
+            start = time.perf_counter()
+            batch, parse_sec = future.result()
+            # Time spent waiting for the parse to finish counts as waiting, not loading
+            wait += time.perf_counter() - start
+            nbytes = getsize(fname)
+            stats.parse.add(items=1, nbytes=nbytes, rows=batch.n_lines, busy_sec=parse_sec)
+
+            start = time.perf_counter()
+            db_load.save_precip_batch(batch, conn)
+            if mark_done is None:
+                conn.commit()
+            else:
+                mark_done(conn, basename(fname))
+            if not keep_archives:
+                os.remove(fname)
+            stats.load.add(items=1, nbytes=nbytes, rows=len(batch.h_line) + batch.n_lines,
+                           busy_sec=time.perf_counter() - start, wait_sec=wait)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        ftp_pool.shutdown(cancel_futures=True)
+        parse_pool.shutdown(cancel_futures=True)
+        sessions.close_all()
+
+    stats.finish(download_stats)
+    print(stats.report())
+    if stats.failed:
+        raise RuntimeError("%d archives could not be downloaded: %s"
+                           % (len(stats.failed), ", ".join(basename(remote) for remote, error in stats.failed)))
+    return stats
@@ -31,5 +31,81 @@ station_data_dir = join(work_base_dir, "mshr_enhanced")
 
 # Station history filename is likely to need adjustment to the date portion.
 station_hist_fname = join(station_data_dir, "MSHR_Enhanced_201911.txt")
+# Only load the history of stations in daily_raw (the file covers every station type, and the station master only
+# uses these).  This makes the import about 4 times faster, but the pipeline then has to import the station history
+# after the precipitation files instead of alongside them, so it is off by default.
+station_coop_filter = False
 # SQL DB Name (for sqlite)
 sqldbname = join(work_data_dir, "precip.sqlite")
+# Parquet export of the raw tables (one sub-directory per table)
+parquet_data_dir = join(work_data_dir, "parquet")
+
+# Performance
+
+# Settings for every connection from main/db.py.  WAL lets readers work while the loader writes.
+# The pipeline runs steps at the same time, and sqlite lets one of them write at a time, so busy_timeout below is
+# how long a writer waits for another.  The steps that hold the write lock for minutes (index builds, INSERT ... SELECT
+# over a raw table) are kept apart by conflicts in STEPS (main/pipeline.py), so the others only wait for short writes.
+# The long busy_timeout is still there for them to fall back on: a step that waits longer fails with "database is
+# locked".  Setting pipeline_workers to 1 avoids the waits altogether, at the cost of the overlap.
+db_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -200000,  # negative means KiB, so about 200 MB
+    "mmap_size": 1 << 30,
+    "temp_store": "MEMORY",
+    "busy_timeout": 600000,  # ms a writer waits for another (as when pipeline steps run at the same time)
+}
+# Number of prepared statements each connection keeps
+db_cached_statements = 256
+
+# Number of processes used to parse the raw files.  None uses all cores.
+load_workers = None
+# Number of processes for the coverage calculation (None uses all cores), and the approximate
+# memory each one may use for its share of the hourly data.
+coverage_workers = None
+coverage_worker_mb = 512
+
+# SQLite settings used while bulk loading the raw tables (see db_load.import_precip_files_bulk).
+# These trade durability for speed and are put back when the load finishes.
+bulk_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -1000000,  # negative means KiB, so about 1 GB
+    "temp_store": "MEMORY",
+}
+
+# Stage metrics from util/metrics.py: the JSON and CSV run logs go here.  tracemalloc gives the peak Python
+# memory of each stage, but slows down the pure Python steps, so it is off by default.
+metrics_dir = join(work_data_dir, "metrics")
+metrics_tracemalloc = False
+
+# SQL profiler from util/sql_profile.py, for the connections from main/db.py.  Statements slower than sql_slow_ms
+# and those that scan all of a table in sql_scan_tables are written to sql_profile_log.  It slows down row by row
+# inserts, so it is off by default.
+sql_profile = False
+sql_profile_log = join(work_data_dir, "sql_profile.jsonl")
+sql_slow_ms = 1000
+sql_scan_tables = ("hourly_raw",)
+# Number of SQLite virtual machine steps between progress callbacks
+sql_profile_steps = 10000
+
+# Pipeline runner (main/pipeline.py): the years of data to load and the number of steps run at once.
+first_year = 1999
+last_year = 2013
+pipeline_workers = 2
+
+# FTP downloader (download/ftp_download.py): the archive of yearly files by state, the number of sessions open at
+# once, and the tries per file.  The files are saved in orig_data_dir.
+ftp_host = "ftp.ncdc.noaa.gov"
+ftp_port = 21
+ftp_dir = "/pub/data/hourly_precip-3240"
+ftp_sessions = 4
+ftp_retries = 3
+
+# Streamed load (load/stream_load.py): download, parse and load the archives at once instead of one after the other.
+# The queues between the stages hold stream_queue_size archives each, which bounds the archives on disk and in memory
+# ahead of the load.  With stream_download set, the load_year step of the pipeline loads the archives from the FTP
+# archive this way instead of loading the extracted year files.
+stream_queue_size = 4
+stream_download = False
@@ -0,0 +1,93 @@
+"""
+Shared SQLite connections with consistent settings.
+Modules that used to open and close their own connection get a reused one from here.
+"""
+
+import os
+import sqlite3
+import threading
+
+import main.config as config
+from util.sql_profile import ProfiledConnection
+
+_local = threading.local()
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def connect(readonly: bool = False, dbname: str = None) -> sqlite3.Connection:
+    """
+    Open a new connection with the pragmas from config.
+    Read-only connections use a mode=ro URI, so they can never take the write lock.
+    With sql_profile set in config, the connection times its statements (see util/sql_profile.py).
+    :param readonly: Open for reading only
+    :param dbname: Database filename (defaults to sqldbname in config)
+    :return: DB connection
+    """
+    if dbname is None:
+        dbname = config.sqldbname
+
+    factory = ProfiledConnection if config.sql_profile else sqlite3.Connection
+    if readonly:
+        uri = "file:%s?mode=ro" % os.path.abspath(dbname).replace("\\", "/")
+        conn = sqlite3.connect(uri, uri=True, cached_statements=config.db_cached_statements,
+                               check_same_thread=False, factory=factory)
+    else:
+        conn = sqlite3.connect(dbname, cached_statements=config.db_cached_statements, check_same_thread=False,
+                               factory=factory)
+
+    cur = conn.cursor()
+    for name, value in config.db_pragmas.items():
+        # journal_mode is stored in the file, so only a writer may change it
+        if readonly and name == "journal_mode":
+            continue
+        cur.execute("PRAGMA %s = %s" % (name, value))
+    cur.close()
+
+    return conn
+
+
+def get_connection(readonly: bool = False, thread_local: bool = True) -> sqlite3.Connection:
+    """
+    Get a reused connection.  Callers should commit their work but must not close it.
+    With thread_local (the default) each thread has its own connections, which lets several
+    threads read at once.  Otherwise one connection per mode is shared by the whole process.
+    Connections are reopened after a fork, so pool workers never share one with the parent.
+    :param readonly: Get a read-only connection
+    :param thread_local: Keep the connection per thread rather than per process
+    :return: DB connection
+    """
+    key = (readonly, config.sqldbname)
+    if thread_local:
+        conns = getattr(_local, "conns", None)
+        if conns is None or _local.pid != os.getpid():
+            conns = _local.conns = {}
+            _local.pid = os.getpid()
+        if key not in conns:
+            conns[key] = connect(readonly)
+        return conns[key]
+
+    with _shared_lock:
+        if _shared.get("pid") != os.getpid():
+            _shared.clear()
+            _shared["pid"] = os.getpid()
+        if key not in _shared:
+            _shared[key] = connect(readonly)
+        return _shared[key]
+
+
+def close_all():
+    """
+    Close the pooled connections of this thread and the process-wide ones.
+    :return: None
+    """
+    for conn in getattr(_local, "conns", {}).values():
+        conn.close()
+    _local.conns = {}
+    _local.pid = os.getpid()
+
+    with _shared_lock:
+        for key, conn in _shared.items():
+            if key != "pid":
+                conn.close()
+        _shared.clear()
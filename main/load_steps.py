@@ -4,17 +4,25 @@ US Hourly Precipitation v1 (DSI 3240)
 Landing page: https://catalog.data.gov/dataset/u-s-hourly-precipitation-data
 """
 
+# To run all of these steps unattended, use the pipeline runner instead (python -m main.pipeline run).  It keeps the
+# state of each step in the database, so after a failure it can be run again to resume, and it runs independent steps
+# at the same time.
+
 # For interactive work uncomment the next line.  This will allow reloading the other libraries.
 # from importlib import reload
 from main.config import *
+import main.db as db
 import load.create_tables as create_tables
 import calc.record_count as record_count
 import load.db_load as db_load
+import load.flag_summary as flag_summary
+import load.indexes as indexes
 import load.station_period as station_period
 import calc.coverage as coverage
 import fix.error_flag_fix as error_flag_fix
+import readdb.spatial as spatial
+import util.metrics as metrics
 
-import time
 import glob
 import pandas as pd
 from datetime import date, datetime
@@ -23,25 +31,31 @@ import sqlite3
 
 print("Starting")
 print(datetime.now().strftime("%H:%M"))
-conn: sqlite3.Connection = sqlite3.connect(sqldbname)
+conn: sqlite3.Connection = db.get_connection()
+
+# Each stage below records its time, CPU, memory and row counts in the pipeline_metrics table and in the run logs in
+# metrics_dir (see util/metrics.py), so that a slow stage can be found by comparing runs.
+run = metrics.PipelineRun(conn)
 
 # Create the raw event tables
 create_tables.cr_tb_hr(conn)
 create_tables.cr_tb_dr(conn)
 
+# The loaders also count the flags of each station-day and station-period as they go (see load/flag_summary.py), so
+# that the station period tables can be built without reading the raw tables again.  For data loaded without these
+# tables, flag_summary.convert_raw_to_flag_summary(conn) fills them from the raw tables; until then the later steps
+# read the raw tables.
+flag_summary.cr_tb_flag_summary(conn)
+
 # Fill the raw event tables
 
-# Load the recent files (using the faster, traditional method)
+# Load the recent files (using the NumPy batch parser; import_precip_file is the older line by line method)
 
-print("Load files by month")
-print(datetime.now().strftime("%H:%M"))
-s1 = time.perf_counter()
-for fname in glob.iglob(join(raw_data_dir, '*.dat')):
-    db_load.import_precip_file(fname, conn)
-e1 = time.perf_counter()
-print(f"Load of files by month took {e1-s1:0.1f} seconds.")
+with run.stage("Load files by month", out_table='hourly_raw'):
+    for fname in glob.iglob(join(raw_data_dir, '*.dat')):
+        db_load.import_precip_file_np(fname, conn)
 
-# The code above took 5 min on my system.
+# The code above took 5 min on my system with import_precip_file.
 
 # This is the fastest way I found to unarchive the annual files by state (1999 - 2011).
 # It is many times faster than unarchiving to all the original
@@ -58,31 +72,87 @@ print(f"Load of files by month took {e1-s1:0.1f} seconds.")
 # Make sure that this command is not run twice for the same year, or it will double up the file, and the load program
 # will encounter duplicate keys.
 
-# Load the older files (using the faster, traditional method)
+# Instead of extracting the archives, the yearly files can also be loaded straight from the .tar.Z archives in
+# orig_data_dir.  The archives are decompressed and read in memory, so no year files or scratch space are needed.
+# The decoder is pure Python, so the parallel version (one archive per process) is the one to use for many years.
+
+# import load.archive_load as archive_load
+# for yearint in range(1999, 2012):
+#     archive_load.import_precip_archives_parallel(archive_load.archive_names(str(yearint)), conn)
+
+# Or the archives can be downloaded and loaded at once, each one loaded as soon as it arrives (instead of the
+# download in get_data.py and the load above).  Pass keep_archives=False to delete each archive once it is loaded.
+
+# import load.stream_load as stream_load
+# stream_load.stream_load_archives(conn, 1999, 2011)
+
+# Load the older files (using the NumPy batch parser)
 # These were originally stored as one file per station/year, but the command we used above extracted them to one file
 # per year with all stations in it.
 
-print("Load files by year")
-print(datetime.now().strftime("%H:%M"))
-s1 = time.perf_counter()
-for fname in glob.iglob(join(raw_data_dir, '*.txt')):
-    db_load.import_precip_file(fname, conn)
-e1 = time.perf_counter()
-print(f"Load of files by year took {e1-s1:0.1f} seconds.")
+with run.stage("Load files by year", out_table='hourly_raw'):
+    for fname in glob.iglob(join(raw_data_dir, '*.txt')):
+        db_load.import_precip_file_np(fname, conn)
 
-# The code above took about 14 minutes on my system.
+# The code above took about 14 minutes on my system with import_precip_file.
+
+# Alternatively, both sets of files can be parsed on all cores (set load_workers in config.py to limit this).  The
+# yearly files are split into shards, and this process remains the only writer.  When running this file as a script
+# on Windows, this call must be placed under "if __name__ == '__main__':".
+
+# import load.parallel_load as parallel_load
+# all_files = list(glob.iglob(join(raw_data_dir, '*.dat'))) + list(glob.iglob(join(raw_data_dir, '*.txt')))
+# with run.stage("Parallel load of all files", out_table='hourly_raw'):
+#     parallel_load.import_precip_files_parallel(all_files, conn)
+
+# For a full reload, bulk mode loads key-less staging tables with the pragmas in config.py, fills the keyed tables in
+# key order and builds the secondary indexes, so the "Adding indexes" step below must be skipped in that case.
+
+# db_load.import_precip_files_bulk(all_files, conn)
+
+# Incremental reloads: with the manifest tables in place, import_precip_file_incr skips files that have not changed
+# since they were loaded and replaces only the station-periods of files that have.  This makes it safe to rerun the
+# loops above after adding a new monthly file or re-extracting a year, without clearing the raw tables first.
+
+# create_tables.cr_tb_load_manifest(conn)
+# for fname in all_files:
+#     db_load.import_precip_file_incr(fname, conn)
 
 # # These are commands to clean up the raw tables if we need to retry.
 # cur = conn.cursor()
 # cur.execute("delete from hourly_raw")
 # cur.execute("delete from daily_raw")
+# cur.execute("delete from flag_summary_day")
+# cur.execute("delete from flag_summary_period")
 # conn.commit()
 
 # Add secondary indexes on tables (station period)
 
-print("Adding indexes")
-print(datetime.now().strftime("%H:%M"))
-create_tables.add_indexes_hr_dr(conn)
+with run.stage("Adding indexes", in_table='hourly_raw'):
+    create_tables.add_indexes_hr_dr(conn)
+    # Partial index on the flagged hours and covering indexes for get_hourly and get_daily (see load/indexes.py)
+    indexes.create_indexes(conn)
+    indexes.analyze(conn)
+
+# Check that the hot queries use these indexes (any that do not are printed with their plans).  To see every plan:
+# for name, index, uses_index, plan in indexes.check_plans(conn):
+#     print(name, index, uses_index, plan)
+indexes.report_plans(conn)
+
+# Optionally, convert the raw tables to the compact integer schema.  This makes the database about 40% smaller.
+# hourly_raw and daily_raw become views over the compact tables (with triggers for insert, update and delete), so the
+# later steps work unchanged, and indexes on the decoded station and period keep their range queries and deletes
+# off full scans.  New files can be loaded with compact_schema.import_precip_file_compact.
+# import load.compact_schema as compact_schema
+# compact_schema.convert_raw_to_compact(conn)
+# conn.execute("VACUUM")
+
+# Optionally, keep a wide copy with one row per station-day and the 24 hours packed into blobs.  This has about a tenth
+# of the rows of hourly_raw, and readdb/hourly.get_hourly_wide and iter_station_months return the hours as arrays.
+# New files can be loaded with station_day.import_precip_file_station_day.
+# import load.station_day as station_day
+# station_day.cr_tb_station_day(conn)
+# station_day.convert_raw_to_station_day(conn)
 
 # Check on totals
 
@@ -155,36 +225,42 @@ print(f"Sum: {df['COUNT(1)'].sum():d}")
 
 ## History table
 
-print("Import station history")
-print(datetime.now().strftime("%H:%M"))
-create_tables.cr_tb_station_hist(conn)
+# import_station_file_np parses the file in large blocks with NumPy.  With station_coop_filter set in config.py it
+# only keeps the history of the stations in daily_raw.  import_station_file is the older line by line method.
+
+with run.stage("Import station history", out_table='station_hist'):
+    create_tables.cr_tb_station_hist(conn)
 
-db_load.import_station_file(station_hist_fname, conn)
+    db_load.import_station_file_np(station_hist_fname, conn, station_coop_filter)
 
-create_tables.add_indexes_station_hist(conn)
+    create_tables.add_indexes_station_hist(conn)
 
 ## Table of most recent rows
 
-print("Create station master")
-# This creates the table from a SELECT, so we don't need to fill it separately.
-create_tables.cr_tb_station_mast(conn)
-create_tables.add_indexes_station_mast(conn)
+# This creates the table from a SELECT, so we don't need to fill it separately.  It keeps only the latest history row;
+# for a station's attributes as of a given read_date, use readdb/station_asof.StationIntervals.
+with run.stage("Create station master", in_table='station_hist', out_table='station'):
+    create_tables.cr_tb_station_mast(conn)
+    create_tables.add_indexes_station_mast(conn)
+
+# R*Tree over the station locations, for the searches by distance and box in readdb/spatial.py
+with run.stage("Create station spatial index", in_table='station', out_table='station_rtree'):
+    spatial.cr_tb_station_rtree(conn)
+    spatial.load_station_rtree(conn)
 
 # Dates
 
-print("Create table of dates")
-print(datetime.now().strftime("%H:%M"))
-create_tables.cr_tb_date(conn)
-db_load.load_dates(date(1960, 1, 1), date(1998, 12, 31), conn)
-create_tables.add_indexes_date(conn)
+with run.stage("Create table of dates", out_table='date'):
+    create_tables.cr_tb_date(conn)
+    db_load.load_dates(date(1960, 1, 1), date(1998, 12, 31), conn)
+    create_tables.add_indexes_date(conn)
 
 # States
 
-print("Create table of states")
-print(datetime.now().strftime("%H:%M"))
-create_tables.cr_tb_state(conn)
-db_load.fill_states(conn)
-create_tables.add_indexes_state(conn)
+with run.stage("Create table of states", out_table='state'):
+    create_tables.cr_tb_state(conn)
+    db_load.fill_states(conn)
+    create_tables.add_indexes_state(conn)
 
 
 # Data Cleaning
@@ -194,21 +270,23 @@ create_tables.add_indexes_state(conn)
 # This data has errors in 2007 Q1: some days are missing the error flags that they would normally have to reflect the
 # errors in the hourly data.
 
-print("Finding and Fixing Error Flags")
-print(datetime.now().strftime("%H:%M"))
-## Gather list of missing daily errors
-error_flag_fix.find_error_dates(conn)
-error_flag_fix.find_mismatches(conn)
-## Fix data
-error_flag_fix.update_from_mismatches(conn)
+with run.stage("Finding and Fixing Error Flags", in_table='hourly_raw') as stage:
+    ## Gather list of missing daily errors and fix data
+    stage.rows_out = len(error_flag_fix.fix_error_flags(conn))
 
 # Coverage by station period
 
-print("Coverage by station/period")
-print(datetime.now().strftime("%H:%M"))
 create_tables.cr_tb_period_coverage(conn)
-for i in range(1999, 2014):
-    coverage.calc_over_range('000000', '%d-01' % i, '999999', '%d-12' % i)
+with run.stage("Coverage by station/period", in_table='hourly_raw', out_table='station_period_coverage'):
+    for i in range(1999, 2014):
+        coverage.calc_over_range('000000', '%d-01' % i, '999999', '%d-12' % i)
+
+# Alternatively, run the whole range on all cores.  The range is split into shards that fit in coverage_worker_mb
+# (see config.py) and the results are written through one connection.  When running this file as a script on
+# Windows, this call must be placed under "if __name__ == '__main__':".
+
+# with run.stage("Coverage by station/period", in_table='hourly_raw', out_table='station_period_coverage'):
+#     coverage.calc_over_range_parallel('000000', '1999-01', '999999', '2013-12')
 
 
 # Building Derived Tables
@@ -217,18 +295,41 @@ for i in range(1999, 2014):
 #   This includes days which have an accumulated amount for more than one hour.
 #   It does not include accumulations that run across multiple days.
 
-print("Finding periods with complete days")
-print(datetime.now().strftime("%H:%M"))
 create_tables.cr_tb_s_period_d(conn)
-station_period.load_station_period_d()
+with run.stage("Finding periods with complete days", in_table='daily_raw', out_table='station_period_d'):
+    station_period.load_station_period_d()
 
 # Periods with complete hours
 #   This does not include any periods with accumulations.
 
-print("Finding periods with complete hours")
-print(datetime.now().strftime("%H:%M"))
 create_tables.cr_tb_s_period_h(conn)
-station_period.load_station_period_h()
+with run.stage("Finding periods with complete hours", in_table='hourly_raw', out_table='station_period_h'):
+    station_period.load_station_period_h()
+
+# Years with all 12 periods complete, rolled up from the tables above
+
+create_tables.cr_tb_s_year_d(conn)
+with run.stage("Finding years with complete days", in_table='station_period_d', out_table='station_year_d'):
+    station_period.load_station_year('d', conn)
+
+create_tables.cr_tb_s_year_h(conn)
+with run.stage("Finding years with complete hours", in_table='station_period_h', out_table='station_year_h'):
+    station_period.load_station_year('h', conn)
+
+# After a file is reloaded with db_load.import_precip_file_incr, the missing daily error flags of its station-periods
+# are fixed again and the rows of these four tables for them are recalculated, so none of this needs to be rerun.
+
+# Optional: export the raw tables to Parquet (requires pyarrow) for fast analytical reads with
+# hourly.get_hourly(..., backend='parquet').  Rerun after any change to the raw tables.
+
+# import load.parquet_export as parquet_export
+# parquet_export.export_raw_parquet(conn, 1999, 2013)
+
+# With sql_profile = True in config.py, the slowest statements of the run and their query plans can be listed here.
+# Slow statements and full scans of hourly_raw are also in sql_profile_log.
+
+# import util.sql_profile as sql_profile
+# sql_profile.print_summary()
 
 print("Ending")
 print(datetime.now().strftime("%H:%M"))
\ No newline at end of file
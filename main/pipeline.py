@@ -0,0 +1,560 @@
+"""
+Pipeline runner for the load steps in main/load_steps.py.
+
+Each step is declared with the steps it depends on.  The state of each step is kept in the database
+(pipeline_step), so a run that stops part way can be started again and goes on from the first step that
+did not finish.  A step that failed is cleaned up (its tables are dropped) before it runs again, and the
+file loads and coverage keep track of each finished file or year (pipeline_item), so they resume where
+they stopped.  Steps that do not depend on each other run at the same time in separate threads, each with
+its own connection; sqlite allows one writer at a time, so writers wait for each other (busy_timeout in
+config.py) but the parsing and the readers overlap.  Steps that hold the write lock for a long time list the steps
+they must not run beside (conflicts), so the others never wait that long for it.  Each step is timed with
+util/metrics.py, so its CPU time, peak memory and rows in and out go to pipeline_metrics and the run logs.
+
+Run from the top directory of the project:
+    python -m main.pipeline run
+    python -m main.pipeline status
+    python -m main.pipeline reset coverage
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import date, datetime
+import glob
+from os.path import join
+import sqlite3
+import traceback
+
+import main.config as config
+import main.db as db
+import load.create_tables as create_tables
+import load.db_load as db_load
+import load.flag_summary as flag_summary
+import load.indexes as indexes
+import load.station_period as station_period
+import load.stream_load as stream_load
+import calc.coverage as coverage
+import util.metrics as metrics
+import fix.error_flag_fix as error_flag_fix
+import readdb.spatial as spatial
+
+
+class Step:
+    """
+    One step of the pipeline
+    """
+
+    def __init__(self, name: str, func, deps: list = (), drops: list = (), description: str = '',
+                 reset_from: str = None, conflicts: list = (), in_table: str = None, out_table: str = None):
+        """
+        Init Step.
+        :param name: Step name
+        :param func: Function taking a DB connection and the step name
+        :param deps: Names of the steps that must finish first
+        :param drops: Tables and indexes the step creates, dropped before it runs again after a failure
+        :param description: Short description for the step list
+        :param reset_from: Step to reset instead of this one, for steps that add rows to another step's tables
+        :param conflicts: Names of the steps that must not run at the same time as this one (either way round)
+        :param in_table: Table the step reads, for rows_in in the metrics
+        :param out_table: Table the step fills, for rows_out in the metrics
+        """
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.drops = list(drops)
+        self.description = description
+        self.reset_from = reset_from
+        self.conflicts = list(conflicts)
+        self.in_table = in_table
+        self.out_table = out_table
+
+
+# Step functions (each takes the step's connection and the step name)
+
+def raw_tables(conn: sqlite3.Connection, step: str):
+    """
+    Create the raw event tables, and the flag summary filled with them
+    """
+    create_tables.cr_tb_hr(conn)
+    create_tables.cr_tb_dr(conn)
+    flag_summary.cr_tb_flag_summary(conn)
+
+
+def load_files(conn: sqlite3.Connection, step: str, pattern: str):
+    """
+    Load the raw files matching a pattern, skipping those already loaded by this step.
+    Each file is loaded and marked as done in one transaction, so a file is never half loaded.
+    :param conn: DB connection
+    :param step: Step name
+    :param pattern: File pattern in raw_data_dir
+    :return: None
+    """
+    done = items_done(conn, step)
+    for fname in sorted(glob.glob(join(config.raw_data_dir, pattern))):
+        if fname in done:
+            continue
+        db_load.import_precip_file_np(fname, conn, commit=False)
+        item_done(conn, step, fname)
+
+
+def load_month(conn: sqlite3.Connection, step: str):
+    """
+    Load the recent files by month
+    """
+    load_files(conn, step, '*.dat')
+
+
+def load_year(conn: sqlite3.Connection, step: str):
+    """
+    Load the older files by year (extracted from the state-year archives), or with stream_download set, download
+    and load the state-year archives as they arrive
+    """
+    if config.stream_download:
+        stream_load.stream_load_archives(conn, skip=items_done(conn, step),
+                                         mark_done=lambda conn, name: item_done(conn, step, name))
+    else:
+        load_files(conn, step, '*.txt')
+
+
+def raw_indexes(conn: sqlite3.Connection, step: str):
+    """
+    Add secondary indexes on the raw tables (station period, and the partial and covering indexes), and check that the
+    hot queries use them.  A query that does not is printed but does not fail the step, since it still gives the
+    same results.
+    """
+    create_tables.add_indexes_hr_dr(conn)
+    indexes.create_indexes(conn)
+    indexes.analyze(conn)
+    indexes.report_plans(conn)
+
+
+def station_hist(conn: sqlite3.Connection, step: str):
+    """
+    Import the station history file
+    """
+    create_tables.cr_tb_station_hist(conn)
+    db_load.import_station_file_np(config.station_hist_fname, conn, config.station_coop_filter)
+    create_tables.add_indexes_station_hist(conn)
+
+
+def station_mast(conn: sqlite3.Connection, step: str):
+    """
+    Create the station master from the latest history rows
+    """
+    create_tables.cr_tb_station_mast(conn)
+    create_tables.add_indexes_station_mast(conn)
+
+
+def station_rtree(conn: sqlite3.Connection, step: str):
+    """
+    Create the spatial index of the station locations
+    """
+    spatial.cr_tb_station_rtree(conn)
+    spatial.load_station_rtree(conn)
+
+
+def dates(conn: sqlite3.Connection, step: str):
+    """
+    Create the table of dates
+    """
+    create_tables.cr_tb_date(conn)
+    db_load.load_dates(date(1960, 1, 1), date(1998, 12, 31), conn)
+    create_tables.add_indexes_date(conn)
+
+
+def states(conn: sqlite3.Connection, step: str):
+    """
+    Create the table of states
+    """
+    create_tables.cr_tb_state(conn)
+    db_load.fill_states(conn)
+    create_tables.add_indexes_state(conn)
+
+
+def error_flags(conn: sqlite3.Connection, step: str):
+    """
+    Find and fix the days that are missing their daily error flags
+    """
+    error_flag_fix.fix_error_flags(conn)
+
+
+def period_coverage(conn: sqlite3.Connection, step: str):
+    """
+    Calculate coverage one year at a time, skipping the years already done by this step.
+    A year that was interrupted is cleared before it is calculated again.
+    :param conn: DB connection
+    :param step: Step name
+    :return: None
+    """
+    if not db_object_type(conn, 'station_period_coverage'):
+        create_tables.cr_tb_period_coverage(conn)
+    done = items_done(conn, step)
+    for year in range(config.first_year, config.last_year + 1):
+        if str(year) in done:
+            continue
+        conn.execute("DELETE FROM station_period_coverage WHERE period BETWEEN ? AND ?",
+                     ('%d-01' % year, '%d-12' % year))
+        conn.commit()
+        coverage.calc_over_range('000000', '%d-01' % year, '999999', '%d-12' % year)
+        item_done(conn, step, str(year))
+
+
+def period_d(conn: sqlite3.Connection, step: str):
+    """
+    Find the periods with complete days
+    """
+    create_tables.cr_tb_s_period_d(conn)
+    station_period.load_station_period_d(conn)
+
+
+def period_h(conn: sqlite3.Connection, step: str):
+    """
+    Find the periods with complete hours
+    """
+    create_tables.cr_tb_s_period_h(conn)
+    station_period.load_station_period_h(conn)
+
+
+def year_d(conn: sqlite3.Connection, step: str):
+    """
+    Find the years with complete days
+    """
+    create_tables.cr_tb_s_year_d(conn)
+    station_period.load_station_year('d', conn)
+
+
+def year_h(conn: sqlite3.Connection, step: str):
+    """
+    Find the years with complete hours
+    """
+    create_tables.cr_tb_s_year_h(conn)
+    station_period.load_station_year('h', conn)
+
+
+STEPS = [
+    Step('raw_tables', raw_tables,
+         drops=['hourly_raw', 'daily_raw', 'flag_summary_day', 'flag_summary_period', 'flag_summary_state'],
+         description='Create the raw event tables'),
+    Step('load_month', load_month, ['raw_tables'], reset_from='raw_tables', out_table='hourly_raw',
+         description='Load the recent files by month (*.dat)'),
+    Step('load_year', load_year, ['load_month'], reset_from='raw_tables', out_table='hourly_raw',
+         description='Load the older files by year (*.txt)'),
+    # Building the indexes holds the write lock for minutes
+    Step('raw_indexes', raw_indexes, ['load_month', 'load_year'],
+         drops=['hr_period', 'dr_period'] + indexes.index_names(),
+         conflicts=['station_hist', 'station_mast', 'station_rtree'], in_table='hourly_raw',
+         description='Add secondary indexes on the raw tables'),
+    Step('station_hist', station_hist, ['load_month', 'load_year'] if config.station_coop_filter else [],
+         drops=['station_hist'], out_table='station_hist',
+         description='Import station history'),
+    Step('station_mast', station_mast, ['station_hist', 'load_month', 'load_year'], drops=['station'],
+         in_table='station_hist', out_table='station',
+         description='Create station master'),
+    Step('station_rtree', station_rtree, ['station_mast'], drops=['station_rtree'],
+         in_table='station', out_table='station_rtree',
+         description='Create spatial index of station locations'),
+    Step('dates', dates, drops=['date'], out_table='date',
+         description='Create table of dates'),
+    Step('states', states, drops=['state'], out_table='state',
+         description='Create table of states'),
+    Step('error_flags', error_flags, ['raw_indexes'], in_table='hourly_raw',
+         description='Find and fix missing daily error flags'),
+    Step('coverage', period_coverage, ['raw_indexes'], in_table='hourly_raw', out_table='station_period_coverage',
+         description='Coverage by station/period'),
+    # The two station period steps fill their tables in one INSERT ... SELECT over a raw table, holding the write
+    # lock until it finishes, so they run on their own beside the other steps that write
+    Step('station_period_d', period_d, ['error_flags'], drops=['station_period_d'],
+         conflicts=['coverage', 'station_period_h'], in_table='daily_raw', out_table='station_period_d',
+         description='Find periods with complete days'),
+    Step('station_period_h', period_h, ['raw_indexes'], drops=['station_period_h'],
+         conflicts=['error_flags', 'coverage'], in_table='hourly_raw', out_table='station_period_h',
+         description='Find periods with complete hours'),
+    Step('station_year_d', year_d, ['station_period_d'], drops=['station_year_d'],
+         in_table='station_period_d', out_table='station_year_d',
+         description='Find years with complete days'),
+    Step('station_year_h', year_h, ['station_period_h'], drops=['station_year_h'],
+         in_table='station_period_h', out_table='station_year_h',
+         description='Find years with complete hours'),
+]
+
+
+# State
+
+def init_state(conn: sqlite3.Connection):
+    """
+    Create the state tables if needed.
+    :param conn: DB connection
+    :return: None
+    """
+    if not db_object_type(conn, 'pipeline_step'):
+        create_tables.cr_tb_pipeline_state(conn)
+
+
+def step_status(conn: sqlite3.Connection) -> dict:
+    """
+    Get the status of each step that has run.
+    :param conn: DB connection
+    :return: Dictionary of step name to status
+    """
+    return dict(conn.execute("SELECT step, status FROM pipeline_step").fetchall())
+
+
+def set_status(conn: sqlite3.Connection, step: str, status: str, wall_sec: float = None, error: str = None):
+    """
+    Record the status of a step.
+    :param conn: DB connection
+    :param step: Step name
+    :param status: running, done or failed
+    :param wall_sec: Run time (when finished)
+    :param error: Error text (when failed)
+    :return: None
+    """
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if status == 'running':
+        conn.execute(
+            "INSERT OR REPLACE INTO pipeline_step (step, status, start_time) VALUES (?,?,?)",
+            (step, status, now)
+        )
+    else:
+        conn.execute(
+            "UPDATE pipeline_step SET status = ?, end_time = ?, wall_sec = ?, error = ? WHERE step = ?",
+            (status, now, wall_sec, error, step)
+        )
+    conn.commit()
+
+
+def items_done(conn: sqlite3.Connection, step: str) -> set:
+    """
+    Get the finished items of a step.
+    :param conn: DB connection
+    :param step: Step name
+    :return: Set of items
+    """
+    return {row[0] for row in conn.execute("SELECT item FROM pipeline_item WHERE step = ?", (step,))}
+
+
+def item_done(conn: sqlite3.Connection, step: str, item: str):
+    """
+    Mark an item of a step as finished, committing it with the work of the item.
+    :param conn: DB connection
+    :param step: Step name
+    :param item: Item (file name or year)
+    :return: None
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO pipeline_item (step, item, end_time) VALUES (?,?,?)",
+        (step, item, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+    conn.commit()
+
+
+def db_object_type(conn: sqlite3.Connection, name: str):
+    """
+    Get the type of a table or index.
+    :param conn: DB connection
+    :param name: Table or index name
+    :return: 'table', 'index', 'view' or None if it does not exist
+    """
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def clean_step(conn: sqlite3.Connection, step: Step):
+    """
+    Drop what an unfinished run of a step left behind.
+    :param conn: DB connection
+    :param step: Step
+    :return: None
+    """
+    for name in step.drops:
+        obj_type = db_object_type(conn, name)
+        if obj_type is not None:
+            conn.execute('DROP %s "%s"' % (obj_type.upper(), name))
+    conn.commit()
+
+
+def dependents(names: list) -> list:
+    """
+    Get steps with all the steps that depend on them, directly or not.
+    :param names: Step names
+    :return: Step names in pipeline order
+    """
+    found = set(names)
+    for step in STEPS:
+        if found & set(step.deps):
+            found.add(step.name)
+    return [step.name for step in STEPS if step.name in found]
+
+
+def reset_steps(conn: sqlite3.Connection, names: list):
+    """
+    Mark steps (and the steps that depend on them) to run again.  Their tables are dropped when they run.
+    The file loads can't take their rows back out, so resetting one of them starts again from the raw tables.
+    :param conn: DB connection
+    :param names: Step names
+    :return: List of the steps reset
+    """
+    init_state(conn)
+    steps = {step.name: step for step in STEPS}
+    reset = dependents([steps[name].reset_from or name for name in names])
+    for name in reset:
+        conn.execute("UPDATE pipeline_step SET status = 'failed', error = 'reset' WHERE step = ?", (name,))
+        conn.execute("DELETE FROM pipeline_item WHERE step = ?", (name,))
+    conn.commit()
+    return reset
+
+
+# Running
+
+def conflicting(step: Step, running: list) -> bool:
+    """
+    Check whether a step must wait for a running step it conflicts with.
+    :param step: Step
+    :param running: Steps running now
+    :return: True if it conflicts with one of them
+    """
+    return any(other.name in step.conflicts or step.name in other.conflicts for other in running)
+
+
+def run_step(step: Step, run: metrics.PipelineRun) -> float:
+    """
+    Run one step in the current thread with its own connection (runs in the worker threads).
+    :param step: Step
+    :param run: Metrics of the pipeline run
+    :return: Run time in seconds
+    """
+    conn = db.get_connection()
+    with run.stage(step.name, step.in_table, step.out_table, conn=conn) as stage:
+        try:
+            step.func(conn, step.name)
+        except BaseException:
+            # Before the stage saves its metrics with the same connection
+            conn.rollback()
+            raise
+    return stage.wall_sec
+
+
+def run_pipeline(workers: int = None, until: list = None):
+    """
+    Run the steps that have not finished, starting each one when its dependencies are done.
+    :param workers: Number of steps run at once (defaults to pipeline_workers in config)
+    :param until: Only run these steps and what they depend on (default all)
+    :return: True if all the steps finished
+    """
+    if workers is None:
+        workers = config.pipeline_workers
+
+    steps = {step.name: step for step in STEPS}
+    wanted = set(steps)
+    if until:
+        unknown = set(until) - wanted
+        if unknown:
+            raise ValueError("Unknown steps: %s" % ", ".join(sorted(unknown)))
+        wanted = set()
+        todo = list(until)
+        while todo:
+            name = todo.pop()
+            if name not in wanted:
+                wanted.add(name)
+                todo += steps[name].deps
+
+    conn = db.get_connection()
+    init_state(conn)
+    status = step_status(conn)
+    done = {name for name in wanted if status.get(name) == 'done'}
+    pending = [name for name in steps if name in wanted and name not in done]
+    if not pending:
+        print("All steps are done")
+        return True
+
+    run = metrics.PipelineRun(conn)
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            # Steps that depend on a failed step never become ready, but the others go on
+            for name in list(pending):
+                if len(running) >= workers:
+                    break
+                if (all(dep in done for dep in steps[name].deps)
+                        and not conflicting(steps[name], [steps[other] for other in running.values()])):
+                    if status.get(name) is not None:
+                        print("Cleaning up %s" % name)
+                        clean_step(conn, steps[name])
+                    print("%s  Starting %s" % (datetime.now().strftime("%H:%M"), name))
+                    set_status(conn, name, 'running')
+                    running[pool.submit(run_step, steps[name], run)] = name
+                    pending.remove(name)
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    wall_sec = future.result()
+                except Exception:
+                    error = traceback.format_exc()
+                    set_status(conn, name, 'failed', error=error)
+                    print("%s  Failed %s\n%s" % (datetime.now().strftime("%H:%M"), name, error))
+                    failed.append(name)
+                else:
+                    set_status(conn, name, 'done', wall_sec=round(wall_sec, 3))
+                    done.add(name)
+                    print("%s  Finished %s in %0.1f seconds" % (datetime.now().strftime("%H:%M"), name, wall_sec))
+
+    if failed:
+        print("Failed: %s.  Steps that depend on them did not run.  Run again to resume." % ", ".join(failed))
+    return not failed
+
+
+def print_status(conn: sqlite3.Connection):
+    """
+    Print each step with its dependencies and state.
+    :param conn: DB connection
+    :return: None
+    """
+    init_state(conn)
+    rows = {row[0]: row for row in conn.execute(
+        "SELECT step, status, start_time, end_time, wall_sec FROM pipeline_step"
+    )}
+    for step in STEPS:
+        row = rows.get(step.name)
+        state = row[1] if row else 'pending'
+        when = ("%s  %8.1f s" % (row[3], row[4])) if row and row[4] is not None else ''
+        deps = ", ".join(step.deps) or '-'
+        print("%-18s %-8s %-32s %-40s %s" % (step.name, state, when, deps, step.description))
+
+
+def main(argv=None):
+    """
+    Command line for the pipeline.
+    :param argv: Arguments (defaults to sys.argv)
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(description="Run the precipitation load pipeline")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the steps that have not finished")
+    run_parser.add_argument("--workers", type=int, help="steps run at once (default pipeline_workers in config)")
+    run_parser.add_argument("--until", nargs="+", metavar="STEP", help="run only these steps and their dependencies")
+    commands.add_parser("status", help="show the state of each step")
+    reset_parser = commands.add_parser("reset", help="run steps (and the steps after them) again on the next run")
+    reset_parser.add_argument("steps", nargs="+", metavar="STEP")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        return 0 if run_pipeline(args.workers, args.until) else 1
+
+    conn = db.get_connection()
+    if args.command == "status":
+        print_status(conn)
+    elif args.command == "reset":
+        unknown = set(args.steps) - {step.name for step in STEPS}
+        if unknown:
+            parser.error("unknown steps: %s" % ", ".join(sorted(unknown)))
+        print("Reset: %s" % ", ".join(reset_steps(conn, args.steps)))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
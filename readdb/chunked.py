@@ -0,0 +1,68 @@
+"""
+Read query results in bounded chunks cut on key boundaries
+"""
+
+
+import pandas as pd
+import sqlite3
+
+
+def iter_query(querystr: str, params: list, columns: list, conn: sqlite3.Connection,
+               chunk_rows: int = 500000, key_cols: list = None):
+    """
+    Run a query and yield its results as DataFrames of about chunk_rows rows.
+    If key_cols is given, the query must be ordered by those columns, and a chunk never splits
+    a key: rows for the last key are held back for the next chunk (so a chunk can run over
+    chunk_rows when one key has more rows than that).
+    :param querystr: SQL query
+    :param params: Query parameters
+    :param columns: Names of the result columns
+    :param conn: DB connection
+    :param chunk_rows: Target number of rows per chunk
+    :param key_cols: Columns that a chunk must not split (None for no limit)
+    :return: Generator of DataFrames
+    """
+    key_idx = [columns.index(col) for col in key_cols] if key_cols else []
+
+    def key(row):
+        return tuple(row[i] for i in key_idx)
+
+    cur = conn.cursor()
+    cur.execute(querystr, params)
+    carry = []
+    while True:
+        rows = cur.fetchmany(chunk_rows)
+        if not rows:
+            break
+        rows = carry + rows
+        cut = len(rows)
+        if key_idx:
+            # Hold back the rows for the last key, which may continue in the next fetch
+            last_key = key(rows[-1])
+            while cut > 0 and key(rows[cut - 1]) == last_key:
+                cut -= 1
+        if cut == 0:
+            carry = rows
+            continue
+        yield pd.DataFrame.from_records(rows[:cut], columns=columns)
+        carry = rows[cut:]
+
+    if carry:
+        yield pd.DataFrame.from_records(carry, columns=columns)
+    cur.close()
+
+
+def key_columns(by: str) -> list:
+    """
+    Get the key columns for a chunk boundary setting.
+    :param by: 'station_period', 'station' or None
+    :return: List of columns or None
+    """
+    if by is None:
+        return None
+    elif by == 'station_period':
+        return ['station', 'period']
+    elif by == 'station':
+        return ['station']
+    else:
+        raise ValueError("Unknown chunk boundary: %s" % by)
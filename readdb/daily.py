@@ -0,0 +1,80 @@
+"""
+Routines to pull daily data
+"""
+
+
+from main.config import *
+import main.db as db
+from readdb.chunked import iter_query, key_columns
+import pandas as pd
+import sqlite3
+
+
+def get_daily(start_station: str, start_period: str, end_station: str = None, end_period: str = None) -> pd.DataFrame:
+    """
+    Get daily precipitation data for range of stations and periods.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :return:
+    """
+
+    # Set defaults for end ranges
+    if end_station is None:
+        end_station = start_station
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, state_code, units, read_date,
+            amount, flag1, flag2, period
+        FROM daily_raw
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date
+    """
+
+    conn: sqlite3.Connection = db.get_connection(readonly=True)
+
+    df = pd.read_sql_query(querystr, conn, params=[start_station, end_station, start_period, end_period])
+
+    return df
+
+
+def iter_daily(start_station: str, start_period: str, end_station: str = None, end_period: str = None,
+               chunk_rows: int = 500000, by: str = 'station_period', conn: sqlite3.Connection = None):
+    """
+    Get daily precipitation data for range of stations and periods as a stream of DataFrames.
+    Each chunk has the same columns and order as get_daily and holds about chunk_rows rows,
+    cut so that a station-period (or station) is never split between chunks.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :param chunk_rows: Target number of rows per chunk
+    :param by: Chunk boundary: 'station_period', 'station' or None
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Generator of DataFrames
+    """
+
+    # Set defaults for end ranges
+    if end_station is None:
+        end_station = start_station
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, state_code, units, read_date,
+            amount, flag1, flag2, period
+        FROM daily_raw
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date
+    """
+    columns = ['station', 'state_code', 'units', 'read_date', 'amount', 'flag1', 'flag2', 'period']
+
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+    yield from iter_query(querystr, [start_station, end_station, start_period, end_period], columns, conn,
+                          chunk_rows, key_columns(by))
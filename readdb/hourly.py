@@ -4,17 +4,27 @@ Routines to pull hourly data
 
 
 from main.config import *
+from datetime import date
+import json
+import main.db as db
+from readdb.chunked import iter_query, key_columns
+import readdb.spatial as spatial
+from load.station_day import unpack_hours
+import numpy as np
 import pandas as pd
 import sqlite3
 
 
-def get_hourly(start_station: str, start_period: str, end_station: str = None, end_period: str = None) -> pd.DataFrame:
+def get_hourly(start_station: str, start_period: str, end_station: str = None, end_period: str = None,
+               backend: str = 'sqlite') -> pd.DataFrame:
     """
     Get hourly precipitation data for range of stations and periods.
     :param start_station: Start of station range
     :param start_period: Start of period range
     :param end_station: End of station range
     :param end_period: End of period range
+    :param backend: 'sqlite' (default), 'parquet' to read the export from load/parquet_export.py,
+        or 'compact' to read the integer tables from load/compact_schema.py directly
     :return:
     """
 
@@ -24,6 +34,13 @@ def get_hourly(start_station: str, start_period: str, end_station: str = None, e
     if end_period is None:
         end_period = start_period
 
+    if backend == 'parquet':
+        return get_hourly_parquet(start_station, start_period, end_station, end_period)
+    elif backend == 'compact':
+        return get_hourly_compact(start_station, start_period, end_station, end_period)
+    elif backend != 'sqlite':
+        raise ValueError("Unknown backend: %s" % backend)
+
     querystr = """
         SELECT station, state_code, units, read_date, read_hour,
             amount, flag1, flag2, period
@@ -33,9 +50,300 @@ def get_hourly(start_station: str, start_period: str, end_station: str = None, e
         ORDER BY station, period, read_date, read_hour
     """
 
-    conn: sqlite3.Connection = sqlite3.connect(sqldbname)
+    conn: sqlite3.Connection = db.get_connection(readonly=True)
 
     df = pd.read_sql_query(querystr, conn, params=[start_station, end_station, start_period, end_period])
-    conn.close()
 
     return df
+
+
+def iter_hourly(start_station: str, start_period: str, end_station: str = None, end_period: str = None,
+                chunk_rows: int = 500000, by: str = 'station_period', conn: sqlite3.Connection = None):
+    """
+    Get hourly precipitation data for range of stations and periods as a stream of DataFrames.
+    Each chunk has the same columns and order as get_hourly and holds about chunk_rows rows,
+    cut so that a station-period (or station) is never split between chunks.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :param chunk_rows: Target number of rows per chunk
+    :param by: Chunk boundary: 'station_period', 'station' or None
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Generator of DataFrames
+    """
+
+    # Set defaults for end ranges
+    if end_station is None:
+        end_station = start_station
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, state_code, units, read_date, read_hour,
+            amount, flag1, flag2, period
+        FROM hourly_raw
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date, read_hour
+    """
+    columns = ['station', 'state_code', 'units', 'read_date', 'read_hour', 'amount', 'flag1', 'flag2', 'period']
+
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+    yield from iter_query(querystr, [start_station, end_station, start_period, end_period], columns, conn,
+                          chunk_rows, key_columns(by))
+
+
+def get_hourly_compact(start_station: str, start_period: str, end_station: str, end_period: str) -> pd.DataFrame:
+    """
+    Get hourly precipitation data for range of stations and periods from the compact tables.
+    The range filters are integer comparisons on the primary key (the periods give the epoch_hour range),
+    and the text columns are decoded in pandas rather than per row in SQL.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :return: Same columns and order as get_hourly
+    """
+    querystr = """
+        SELECT h.station_id, u.units, h.epoch_hour, h.amount, h.flag1, h.flag2, h.period
+        FROM hourly_compact h
+        JOIN units_code u ON u.code = h.units
+        WHERE h.station_id BETWEEN ? AND ?
+        AND h.epoch_hour BETWEEN ? AND ?
+        AND h.period BETWEEN ? AND ?
+        ORDER BY h.station_id, h.epoch_hour
+    """
+
+    conn: sqlite3.Connection = db.get_connection(readonly=True)
+
+    # From the first hour of start_period to the last hour of end_period
+    end_year, end_month = int(end_period[:4]), int(end_period[5:7])
+    next_month = date(end_year + end_month // 12, end_month % 12 + 1, 1)
+    params = [int(start_station), int(end_station),
+              date.fromisoformat(start_period + '-01').toordinal() * 24, next_month.toordinal() * 24 - 1,
+              int(start_period.replace('-', '')), int(end_period.replace('-', ''))]
+    dfc = pd.read_sql_query(querystr, conn, params=params)
+
+    df = pd.DataFrame({
+        'station': dfc['station_id'].map('{:06d}'.format),
+        'state_code': (dfc['station_id'] // 10000).map('{:02d}'.format),
+        'units': dfc['units'],
+        'read_date': dfc['epoch_hour'] // 24,
+        'read_hour': (dfc['epoch_hour'] % 24 + 1) * 100,
+        'amount': dfc['amount'].astype(float),
+        'flag1': dfc['flag1'].map(chr),
+        'flag2': dfc['flag2'].map(chr),
+        'period': (dfc['period'] // 100).map('{:04d}'.format) + '-' + (dfc['period'] % 100).map('{:02d}'.format)
+    })
+
+    return df
+
+
+def get_hourly_wide(start_station: str, start_period: str, end_station: str = None, end_period: str = None) -> tuple:
+    """
+    Get hourly precipitation data for range of stations and periods from the station_day table,
+    as one row per station-day with the hours unpacked into (days, 24) arrays.
+    Column i of the arrays is the hour ending at i + 1 (read_hour (i + 1) * 100).
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :return: Tuple of days (DataFrame ordered by station, period and read_date), amount (float, NaN
+        where there is no reading), flag1 and flag2 ('S1', b'' where there is no reading)
+    """
+
+    # Set defaults for end ranges
+    if end_station is None:
+        end_station = start_station
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, state_code, units, read_date, period, hour_cnt,
+            daily_amount, daily_flag1, daily_flag2, amounts, flag1, flag2
+        FROM station_day
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date
+    """
+
+    conn: sqlite3.Connection = db.get_connection(readonly=True)
+
+    rows = conn.execute(querystr, [start_station, end_station, start_period, end_period]).fetchall()
+    columns = ['station', 'state_code', 'units', 'read_date', 'period', 'hour_cnt',
+               'daily_amount', 'daily_flag1', 'daily_flag2']
+    if rows:
+        cols = list(zip(*rows))
+    else:
+        cols = [()] * 12
+    days = pd.DataFrame(dict(zip(columns, cols[:9])), columns=columns)
+    amount, flag1, flag2 = unpack_hours(cols[9], cols[10], cols[11])
+
+    return days, amount, flag1, flag2
+
+
+def iter_station_months(start_station: str, start_period: str, end_station: str = None, end_period: str = None,
+                        chunk_days: int = 20000, conn: sqlite3.Connection = None):
+    """
+    Get hourly precipitation data one station-month at a time, as arrays from the station_day table.
+    The station-days are read in chunks of about chunk_days rows (24 hours each) cut on station-period
+    boundaries, so memory use does not grow with the range.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :param chunk_days: Target number of station-days per chunk
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Generator of tuples of station, period, read_date array, amount, flag1 and flag2 arrays
+        (see get_hourly_wide)
+    """
+
+    # Set defaults for end ranges
+    if end_station is None:
+        end_station = start_station
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, period, read_date, amounts, flag1, flag2
+        FROM station_day
+        WHERE station BETWEEN ? AND ?
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date
+    """
+    columns = ['station', 'period', 'read_date', 'amounts', 'flag1', 'flag2']
+
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+    for chunk in iter_query(querystr, [start_station, end_station, start_period, end_period], columns, conn,
+                            chunk_days, key_columns('station_period')):
+        amount, flag1, flag2 = unpack_hours(chunk['amounts'].tolist(), chunk['flag1'].tolist(),
+                                            chunk['flag2'].tolist())
+        station = chunk['station'].to_numpy()
+        period = chunk['period'].to_numpy()
+        read_date = chunk['read_date'].to_numpy()
+        bounds = np.flatnonzero((station[1:] != station[:-1]) | (period[1:] != period[:-1])) + 1
+        starts = np.concatenate(([0], bounds)).tolist()
+        ends = np.concatenate((bounds, [len(chunk)])).tolist()
+        for start, end in zip(starts, ends):
+            yield station[start], period[start], read_date[start:end], amount[start:end], flag1[start:end], \
+                flag2[start:end]
+
+
+def wide_to_hourly(days: pd.DataFrame, amount: np.ndarray, flag1: np.ndarray, flag2: np.ndarray) -> pd.DataFrame:
+    """
+    Convert the result of get_hourly_wide back to one row per reading.
+    :param days: Station-days from get_hourly_wide
+    :param amount: Amount array from get_hourly_wide
+    :param flag1: Flag 1 array from get_hourly_wide
+    :param flag2: Flag 2 array from get_hourly_wide
+    :return: Same columns and order as get_hourly
+    """
+    day_idx, slot = np.nonzero(~np.isnan(amount))
+
+    df = pd.DataFrame({
+        'station': days['station'].to_numpy()[day_idx],
+        'state_code': days['state_code'].to_numpy()[day_idx],
+        'units': days['units'].to_numpy()[day_idx],
+        'read_date': days['read_date'].to_numpy()[day_idx],
+        'read_hour': (slot + 1) * 100,
+        'amount': amount[day_idx, slot],
+        'flag1': flag1[day_idx, slot].astype('U1'),
+        'flag2': flag2[day_idx, slot].astype('U1'),
+        'period': days['period'].to_numpy()[day_idx]
+    })
+
+    return df
+
+
+def get_hourly_parquet(start_station: str, start_period: str, end_station: str, end_period: str) -> pd.DataFrame:
+    """
+    Get hourly precipitation data for range of stations and periods from the Parquet export.
+    Only the period partitions in range are opened, and row groups outside the station range
+    are skipped using their statistics.  Requires pyarrow.
+    :param start_station: Start of station range
+    :param start_period: Start of period range
+    :param end_station: End of station range
+    :param end_period: End of period range
+    :return: Same columns and order as get_hourly
+    """
+    import pyarrow.dataset as ds
+
+    columns = ['station', 'state_code', 'units', 'read_date', 'read_hour', 'amount', 'flag1', 'flag2', 'period']
+    dataset = ds.dataset(join(parquet_data_dir, 'hourly_raw'), format='parquet', partitioning='hive')
+    filter1 = (
+        (ds.field('period') >= start_period) & (ds.field('period') <= end_period)
+        & (ds.field('station') >= start_station) & (ds.field('station') <= end_station)
+    )
+    df = dataset.to_table(columns=columns, filter=filter1).to_pandas()
+    df = df.sort_values(['station', 'period', 'read_date', 'read_hour'], ignore_index=True)
+
+    return df
+
+
+def get_hourly_stations(stations, start_period: str, end_period: str = None,
+                        conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Get hourly precipitation data for a list of stations and a range of periods.
+    The list is passed to SQLite as one JSON array, so any number of stations are read with one query.
+    :param stations: Sequence of station ids
+    :param start_period: Start of period range
+    :param end_period: End of period range
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Same columns and order as get_hourly
+    """
+
+    # Set defaults for end ranges
+    if end_period is None:
+        end_period = start_period
+
+    querystr = """
+        SELECT station, state_code, units, read_date, read_hour,
+            amount, flag1, flag2, period
+        FROM hourly_raw
+        WHERE station IN (SELECT value FROM json_each(?))
+        AND period BETWEEN ? AND ?
+        ORDER BY station, period, read_date, read_hour
+    """
+
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+
+    df = pd.read_sql_query(querystr, conn, params=[json.dumps([str(s) for s in stations]), start_period, end_period])
+
+    return df
+
+
+def get_hourly_near(lat: float, lon: float, radius_km: float, start_period: str, end_period: str = None,
+                    conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Get hourly precipitation data for every station within a distance of a point (see readdb/spatial.py).
+    :param lat: Latitude of the point
+    :param lon: Longitude of the point
+    :param radius_km: Distance in km
+    :param start_period: Start of period range
+    :param end_period: End of period range
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Same columns and order as get_hourly
+    """
+    stations = spatial.stations_within(lat, lon, radius_km, conn)['station']
+    return get_hourly_stations(stations, start_period, end_period, conn)
+
+
+def get_hourly_box(min_lat: float, max_lat: float, min_lon: float, max_lon: float, start_period: str,
+                   end_period: str = None, conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Get hourly precipitation data for every station in a box (see readdb/spatial.stations_in_box).
+    :param min_lat: South edge
+    :param max_lat: North edge
+    :param min_lon: West edge
+    :param max_lon: East edge
+    :param start_period: Start of period range
+    :param end_period: End of period range
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: Same columns and order as get_hourly
+    """
+    stations = spatial.stations_in_box(min_lat, max_lat, min_lon, max_lon, conn)['station']
+    return get_hourly_stations(stations, start_period, end_period, conn)
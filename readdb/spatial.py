@@ -0,0 +1,276 @@
+"""
+Spatial index and proximity queries over the station locations
+
+station_rtree is an SQLite R*Tree over the lat and lon of the station master (load it after the station table is
+created).  An R*Tree holds 32-bit floats rounded outward, so the exact lat and lon are kept with it as auxiliary
+columns, and the searches use them for the final test.
+
+Each search takes arrays of query points (a single point also works) and looks all of them up in one statement: the
+points' search boxes are passed to SQLite as one JSON array, joined to the R*Tree, and the distances are checked in
+numpy.  Distances are great circle distances in km.
+"""
+
+import json
+
+import main.db as db
+import numpy as np
+import pandas as pd
+import sqlite3
+
+EARTH_RADIUS_KM = 6371.0
+
+# Radius of the first search for the nearest stations.  Points with too few stations within it search again with
+# twice the radius, up to NEAREST_MAX_KM.  Past that, the boxes hold most of the stations, so the points that are left
+# are compared with all of the stations instead.
+NEAREST_START_KM = 50.0
+NEAREST_MAX_KM = 1600.0
+
+# Distances worked out at once when comparing points with all of the stations
+SCAN_CHUNK = 2000000
+
+
+def cr_tb_station_rtree(conn: sqlite3.Connection):
+    """
+    Create the station_rtree table
+    :param conn: DB Connection
+    :return: None
+    """
+    cmd = '''
+        CREATE VIRTUAL TABLE station_rtree
+        USING rtree(
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon,
+            +station,
+            +lat,
+            +lon
+        )
+    '''
+    cur = conn.cursor()
+    cur.execute(cmd)
+    conn.commit()
+
+
+def load_station_rtree(conn: sqlite3.Connection):
+    """
+    Load station_rtree from the station table.  Stations without a location are left out.
+    :param conn: DB Connection
+    :return: None
+    """
+    cur = conn.cursor()
+    cur.execute("DELETE FROM station_rtree")
+
+    cmd = '''
+        INSERT INTO station_rtree
+            (min_lat, max_lat, min_lon, max_lon, station, lat, lon)
+        SELECT DISTINCT lat, lat, lon, lon, station, lat, lon
+        FROM station
+        WHERE lat IS NOT NULL
+        AND lon IS NOT NULL
+    '''
+    cur.execute(cmd)
+    conn.commit()
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Great circle distance between points.
+    :param lat1: Latitude of the first points (degrees)
+    :param lon1: Longitude of the first points (degrees)
+    :param lat2: Latitude of the second points (degrees)
+    :param lon2: Longitude of the second points (degrees)
+    :return: Array of distances in km
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def radius_boxes(lats, lons, radius_km) -> list:
+    """
+    Get the boxes that hold the circles around points (internal use only).
+    A circle that crosses the 180th meridian gets a box on each side of it, and one that reaches a pole gets all
+    longitudes.
+    :param lats: Latitudes of the centers
+    :param lons: Longitudes of the centers
+    :param radius_km: Radius of each circle
+    :return: List of [point, min_lat, max_lat, min_lon, max_lon]
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    angle = np.broadcast_to(np.asarray(radius_km, dtype=float) / EARTH_RADIUS_KM, lats.shape)
+    d_lat = np.degrees(angle)
+    min_lat = lats - d_lat
+    max_lat = lats + d_lat
+
+    # Half the width of the circle in longitude (the circle touches the meridians of asin(sin(r) / cos(lat)))
+    ratio = np.sin(np.minimum(angle, np.pi / 2)) / np.maximum(np.cos(np.radians(lats)), 1e-12)
+    full = (min_lat <= -90) | (max_lat >= 90) | (ratio >= 1)
+    d_lon = np.degrees(np.arcsin(np.minimum(ratio, 1.0)))
+    min_lon = lons - d_lon
+    max_lon = lons + d_lon
+
+    boxes = []
+    for point in range(len(lats)):
+        lat_range = [max(min_lat[point], -90.0), min(max_lat[point], 90.0)]
+        if full[point] or max_lon[point] - min_lon[point] >= 360:
+            boxes.append([point] + lat_range + [-180.0, 180.0])
+        elif min_lon[point] < -180:
+            boxes.append([point] + lat_range + [-180.0, max_lon[point]])
+            boxes.append([point] + lat_range + [min_lon[point] + 360, 180.0])
+        elif max_lon[point] > 180:
+            boxes.append([point] + lat_range + [min_lon[point], 180.0])
+            boxes.append([point] + lat_range + [-180.0, max_lon[point] - 360])
+        else:
+            boxes.append([point] + lat_range + [min_lon[point], max_lon[point]])
+    return boxes
+
+
+def search_boxes(boxes: list, conn: sqlite3.Connection) -> pd.DataFrame:
+    """
+    Find the stations in a list of boxes with one query (internal use only).
+    :param boxes: List of [point, min_lat, max_lat, min_lon, max_lon]
+    :param conn: DB connection
+    :return: DataFrame with point, station, lat and lon
+    """
+    # CROSS JOIN keeps the boxes as the outer loop, so the R*Tree is searched once for each box
+    querystr = '''
+        WITH q AS MATERIALIZED (
+            SELECT json_extract(value, '$[0]') AS point,
+                json_extract(value, '$[1]') AS min_lat,
+                json_extract(value, '$[2]') AS max_lat,
+                json_extract(value, '$[3]') AS min_lon,
+                json_extract(value, '$[4]') AS max_lon
+            FROM json_each(?)
+        )
+        SELECT DISTINCT q.point,
+            r.station,
+            r.lat,
+            r.lon
+        FROM q
+        CROSS JOIN station_rtree r
+        WHERE r.max_lat >= q.min_lat
+        AND r.min_lat <= q.max_lat
+        AND r.max_lon >= q.min_lon
+        AND r.min_lon <= q.max_lon
+        AND r.lat BETWEEN q.min_lat AND q.max_lat
+        AND r.lon BETWEEN q.min_lon AND q.max_lon
+    '''
+    boxes = [[int(box[0])] + [float(x) for x in box[1:]] for box in boxes]
+    rows = conn.execute(querystr, [json.dumps(boxes)]).fetchall()
+    df = pd.DataFrame(rows, columns=['point', 'station', 'lat', 'lon'])
+    df['point'] = df['point'].astype(np.int64)
+    return df
+
+
+def stations_in_box(min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+                    conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Find the stations in a box.  A box that crosses the 180th meridian has min_lon greater than max_lon.
+    :param min_lat: South edge
+    :param max_lat: North edge
+    :param min_lon: West edge
+    :param max_lon: East edge
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: DataFrame with station, lat and lon, sorted by station
+    """
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+
+    if min_lon <= max_lon:
+        boxes = [[0, min_lat, max_lat, min_lon, max_lon]]
+    else:
+        boxes = [[0, min_lat, max_lat, min_lon, 180.0], [0, min_lat, max_lat, -180.0, max_lon]]
+    df = search_boxes(boxes, conn)
+    return df.drop(columns='point').drop_duplicates('station').sort_values('station').reset_index(drop=True)
+
+
+def stations_within(lats, lons, radius_km, conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Find the stations within a distance of each point.
+    :param lats: Latitudes of the points (or one latitude)
+    :param lons: Longitudes of the points (or one longitude)
+    :param radius_km: Distance (for all points, or one per point)
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :return: DataFrame with point (position in lats and lons), station, lat, lon and distance_km, sorted by point
+        and distance
+    """
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    radius_km = np.broadcast_to(np.asarray(radius_km, dtype=float), lats.shape)
+
+    df = search_boxes(radius_boxes(lats, lons, radius_km), conn).drop_duplicates(['point', 'station'])
+    points = df['point'].to_numpy()
+    df['distance_km'] = haversine_km(lats[points], lons[points], df['lat'], df['lon'])
+    df = df[df['distance_km'].to_numpy() <= radius_km[points]]
+    return df.sort_values(['point', 'distance_km', 'station']).reset_index(drop=True)
+
+
+def nearest_scan(lats, lons, k: int, conn: sqlite3.Connection) -> pd.DataFrame:
+    """
+    Find the k nearest stations to each point by comparing it with all of the stations (internal use only).
+    :param lats: Latitudes of the points
+    :param lons: Longitudes of the points
+    :param k: Number of stations per point
+    :param conn: DB connection
+    :return: DataFrame with point, station, lat, lon and distance_km (k rows per point, not sorted)
+    """
+    stations = pd.read_sql_query("SELECT DISTINCT station, lat, lon FROM station_rtree", conn)
+    st_lat = stations['lat'].to_numpy(dtype=float)
+    st_lon = stations['lon'].to_numpy(dtype=float)
+    k = min(k, len(stations))
+    chunk = max(1, SCAN_CHUNK // max(len(stations), 1))
+
+    found = []
+    for start in range(0, len(lats), chunk):
+        dist = haversine_km(lats[start:start + chunk, None], lons[start:start + chunk, None], st_lat, st_lon)
+        nearest = np.argpartition(dist, k - 1, axis=1)[:, :k] if k > 0 else np.zeros((len(dist), 0), dtype=int)
+        df = stations.iloc[nearest.ravel()].reset_index(drop=True)
+        df.insert(0, 'point', np.repeat(np.arange(start, start + len(dist)), k))
+        df['distance_km'] = np.take_along_axis(dist, nearest, axis=1).ravel()
+        found.append(df)
+    return pd.concat(found, ignore_index=True)
+
+
+def nearest_stations(lats, lons, k: int = 1, conn: sqlite3.Connection = None,
+                     start_km: float = NEAREST_START_KM) -> pd.DataFrame:
+    """
+    Find the k nearest stations to each point.
+    Each point is searched within start_km, and the points with fewer than k stations in range are searched again
+    with twice the radius.  The stations found within the radius are the nearest ones, since any others are farther
+    away.  Points that are still short at NEAREST_MAX_KM are compared with all of the stations.
+    :param lats: Latitudes of the points (or one latitude)
+    :param lons: Longitudes of the points (or one longitude)
+    :param k: Number of stations per point
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :param start_km: Radius of the first search
+    :return: DataFrame with point, rank (1 for the nearest), station, lat, lon and distance_km
+    """
+    if conn is None:
+        conn = db.get_connection(readonly=True)
+
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    radius = float(start_km)
+    todo = np.arange(len(lats))
+    found = []
+    while len(todo) > 0 and radius <= NEAREST_MAX_KM:
+        df = stations_within(lats[todo], lons[todo], radius, conn)
+        df['point'] = todo[df['point'].to_numpy()]
+        counts = df.groupby('point').size().reindex(todo, fill_value=0).to_numpy()
+        done = counts >= k
+        found.append(df[np.isin(df['point'].to_numpy(), todo[done])])
+        todo = todo[~done]
+        radius *= 2
+
+    if len(todo) > 0:
+        df = nearest_scan(lats[todo], lons[todo], k, conn)
+        df['point'] = todo[df['point'].to_numpy()]
+        found.append(df)
+
+    df = pd.concat(found, ignore_index=True).sort_values(['point', 'distance_km', 'station'])
+    df.insert(1, 'rank', df.groupby('point').cumcount() + 1)
+    return df[df['rank'] <= k].reset_index(drop=True)
@@ -0,0 +1,110 @@
+"""
+Station attributes as of a date, from the station history
+"""
+
+
+import main.db as db
+import numpy as np
+import pandas as pd
+import sqlite3
+
+# Attributes kept by default (the same ones as the station master)
+STATION_ATTRS = ['state', 'nws_st_code', 'fips_country_code', 'elev_ground', 'lat', 'lon', 'utc_offset',
+                 'county_fips_code']
+
+# Dates are ordinals (below 2**22 up to the year 9999), so a station code and a date fit in one sortable integer
+DATE_BITS = 22
+
+
+class StationIntervals:
+    """
+    Interval index over the station history, for looking up station attributes as of a date.
+    The history rows are read once and sorted by (coop_id, begin_date).  A lookup finds, for each station and date,
+    the row with the latest begin_date on or before the date, if the date is also on or before its end_date.  This is
+    the row the station master would have used if the history had stopped on that date.  Lookups are vectorized, so
+    millions of station-days can be looked up at once.
+    """
+
+    def __init__(self, conn: sqlite3.Connection = None, columns: list = None):
+        """
+        Init StationIntervals.
+        :param conn: DB connection (if omitted, the shared read-only connection is used)
+        :param columns: station_hist columns to return (default STATION_ATTRS)
+        """
+        if conn is None:
+            conn = db.get_connection(readonly=True)
+        self.columns = list(STATION_ATTRS if columns is None else columns)
+
+        querystr = """
+            SELECT coop_id, begin_date, end_date, %s
+            FROM station_hist
+            WHERE coop_id IS NOT NULL
+            ORDER BY coop_id, begin_date, rowid
+        """ % ', '.join(self.columns)
+        hist = pd.read_sql_query(querystr, conn)
+
+        # Number the stations, and build one sorted key per history row
+        codes, self.stations = pd.factorize(hist['coop_id'], sort=True)
+        begin = hist['begin_date'].to_numpy(dtype=np.int64)
+        self._keys = (codes.astype(np.int64) << DATE_BITS) + begin
+        order = np.argsort(self._keys, kind='stable')
+        self._keys = self._keys[order]
+        self._end = hist['end_date'].to_numpy(dtype=np.int64)[order]
+        # A row of nulls at the end stands in for the lookups that match no interval
+        self._attrs = hist[self.columns].iloc[order].reset_index(drop=True).reindex(range(len(hist) + 1))
+        self.n_rows = len(hist)
+
+    def lookup_rows(self, stations, read_dates) -> np.ndarray:
+        """
+        Find the history row in effect for each station and date.
+        :param stations: Sequence of COOP ids
+        :param read_dates: Sequence of dates as ordinals (as read_date in the raw tables)
+        :return: Array of positions in the sorted history, with n_rows where there is no match
+        """
+        codes = self.stations.get_indexer(pd.Index(stations)).astype(np.int64)
+        dates = np.asarray(read_dates, dtype=np.int64)
+        pos = np.searchsorted(self._keys, (codes << DATE_BITS) + dates, side='right') - 1
+
+        safe = np.clip(pos, 0, max(self.n_rows - 1, 0))
+        found = (codes >= 0) & (pos >= 0) & (self.n_rows > 0)
+        if self.n_rows > 0:
+            found &= ((self._keys[safe] >> DATE_BITS) == codes) & (dates <= self._end[safe])
+        return np.where(found, safe, self.n_rows)
+
+    def lookup(self, stations, read_dates) -> pd.DataFrame:
+        """
+        Get the station attributes as of each date.
+        :param stations: Sequence of COOP ids
+        :param read_dates: Sequence of dates as ordinals
+        :return: DataFrame with station, read_date and the attribute columns (null where no history row applies)
+        """
+        rows = self.lookup_rows(stations, read_dates)
+        df = self._attrs.iloc[rows].reset_index(drop=True)
+        df.insert(0, 'station', np.asarray(stations, dtype=object))
+        df.insert(1, 'read_date', np.asarray(read_dates, dtype=np.int64))
+        return df
+
+    def join(self, df: pd.DataFrame, station_col: str = 'station', date_col: str = 'read_date') -> pd.DataFrame:
+        """
+        Add the station attributes as of each row's date to a DataFrame (such as the result of get_daily).
+        :param df: DataFrame with station and date columns
+        :param station_col: Name of the station column
+        :param date_col: Name of the date column (ordinals)
+        :return: New DataFrame with the attribute columns added
+        """
+        rows = self.lookup_rows(df[station_col].to_numpy(), df[date_col].to_numpy())
+        attrs = self._attrs.iloc[rows].set_axis(df.index)
+        return pd.concat([df, attrs], axis=1)
+
+
+def get_station_attrs(stations, read_dates, conn: sqlite3.Connection = None, columns: list = None) -> pd.DataFrame:
+    """
+    Get the station attributes as of each date.  This builds the interval index each time; to look up several
+    batches, create a StationIntervals once and call its lookup method.
+    :param stations: Sequence of COOP ids
+    :param read_dates: Sequence of dates as ordinals
+    :param conn: DB connection (if omitted, the shared read-only connection is used)
+    :param columns: station_hist columns to return (default STATION_ATTRS)
+    :return: DataFrame with station, read_date and the attribute columns
+    """
+    return StationIntervals(conn, columns).lookup(stations, read_dates)
@@ -0,0 +1,334 @@
+"""
+Timings and resource use for the stages of the load pipeline.
+
+Wrap each stage in PipelineRun.stage.  Every stage records wall time, CPU time (including finished child
+processes, such as the parsing pool), peak memory and rows in and out.  The results go to the
+pipeline_metrics table and to JSON and CSV run logs in metrics_dir, so runs can be compared stage by stage.
+
+peak_rss_mb is the peak resident memory of the process during the stage, not since the process started.  On
+Linux the kernel's high-water mark is reset at the start of each stage (/proc/self/clear_refs), and the RSS is also
+sampled every RSS_SAMPLE_SEC, which covers stages that run at the same time (each reset cuts into the other
+stage's high-water mark).  The memory and CPU time are the whole process's, so stages that run at the same time
+(main/pipeline.py) each include the other's.  Where the RSS can only be sampled (Windows), short peaks between
+samples are missed, and where it cannot be read at all (macOS) it is left empty.
+"""
+
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import json
+import os
+from os.path import join
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+
+import main.config as config
+import load.create_tables as create_tables
+
+# Seconds between RSS samples during a stage
+RSS_SAMPLE_SEC = 0.05
+
+FIELDS = ['run_id', 'seq', 'stage', 'start_time', 'status', 'wall_sec', 'cpu_sec', 'peak_rss_mb', 'peak_traced_mb',
+          'rows_in', 'rows_out', 'rows_per_sec']
+
+
+class StageMetrics:
+    """
+    Metrics for one stage.  The code in the stage may set rows_in and rows_out.
+    The rate is based on rows_in, or on rows_out for stages that only write (such as the file loads).
+    """
+
+    def __init__(self, stage: str):
+        """
+        Init StageMetrics.
+        :param stage: Stage name
+        """
+        self.stage = stage
+        self.start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.status = 'ok'
+        self.wall_sec = None
+        self.cpu_sec = None
+        self.peak_rss_mb = None
+        self.peak_traced_mb = None
+        self.rows_in = None
+        self.rows_out = None
+
+    @property
+    def rows_per_sec(self):
+        rows = self.rows_in if self.rows_in is not None else self.rows_out
+        if rows is None or not self.wall_sec:
+            return None
+        return round(rows / self.wall_sec, 1)
+
+
+class PipelineRun:
+    """
+    One run of the pipeline, with a list of stage metrics
+    """
+
+    def __init__(self, conn: sqlite3.Connection = None, log_dir: str = None, trace_memory: bool = None):
+        """
+        Init PipelineRun.
+        :param conn: DB connection for the pipeline_metrics table (if omitted, only the run logs are written)
+        :param log_dir: Directory for the run logs (defaults to metrics_dir in config; '' for none)
+        :param trace_memory: Use tracemalloc for the peak Python memory of each stage
+            (defaults to metrics_tracemalloc in config)
+        """
+        self.run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.conn = conn
+        self.log_dir = config.metrics_dir if log_dir is None else log_dir
+        self.trace_memory = config.metrics_tracemalloc if trace_memory is None else trace_memory
+        self.stages = []
+        self._lock = threading.Lock()
+
+        if conn is not None and not table_exists(conn, 'pipeline_metrics'):
+            create_tables.cr_tb_pipeline_metrics(conn)
+        if self.log_dir:
+            os.makedirs(self.log_dir, exist_ok=True)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, in_table: str = None, out_table: str = None, conn: sqlite3.Connection = None):
+        """
+        Time a stage of the pipeline.
+        With in_table, rows_in is the row count of that table at the start.  With out_table, rows_out is the
+        number of rows the stage added to that table.  The counts are taken outside the timed part.
+        :param name: Stage name (also printed with the time, as the progress messages were)
+        :param in_table: Table read by the stage
+        :param out_table: Table filled by the stage
+        :param conn: DB connection for the counts and the metrics row (defaults to the run's); stages that run in
+            other threads pass their own, since a connection can only be used by the thread that opened it
+        :return: StageMetrics, for the stage to set rows_in or rows_out itself
+        """
+        print(name)
+        print(datetime.now().strftime("%H:%M"))
+
+        metrics = StageMetrics(name)
+        conn = self.conn if conn is None else conn
+        if in_table is not None and conn is not None:
+            metrics.rows_in = table_count(conn, in_table)
+        out_before = table_count(conn, out_table) if out_table is not None and conn is not None else None
+        if self.trace_memory and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        peak_reset = reset_peak_rss()
+        sampler = RssSampler()
+
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        try:
+            yield metrics
+        except BaseException:
+            metrics.status = 'error'
+            raise
+        finally:
+            metrics.wall_sec = round(time.perf_counter() - wall_start, 3)
+            metrics.cpu_sec = round(cpu_time() - cpu_start, 3)
+            peaks = [sampler.stop(), peak_rss_mb() if peak_reset else None]
+            peaks = [peak for peak in peaks if peak is not None]
+            metrics.peak_rss_mb = max(peaks) if peaks else None
+            if self.trace_memory and tracemalloc.is_tracing():
+                metrics.peak_traced_mb = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 1)
+            if out_before is not None and metrics.status == 'ok':
+                metrics.rows_out = table_count(conn, out_table) - out_before
+            with self._lock:
+                self.stages.append(metrics)
+                self.save(metrics, conn)
+            print(f"{name} took {metrics.wall_sec:0.1f} seconds.")
+
+    def records(self) -> list:
+        """
+        Get the stage metrics as a list of dictionaries.
+        :return: List of dict with the keys in FIELDS
+        """
+        records = []
+        for seq, metrics in enumerate(self.stages, 1):
+            records.append({
+                'run_id': self.run_id,
+                'seq': seq,
+                'stage': metrics.stage,
+                'start_time': metrics.start_time,
+                'status': metrics.status,
+                'wall_sec': metrics.wall_sec,
+                'cpu_sec': metrics.cpu_sec,
+                'peak_rss_mb': metrics.peak_rss_mb,
+                'peak_traced_mb': metrics.peak_traced_mb,
+                'rows_in': metrics.rows_in,
+                'rows_out': metrics.rows_out,
+                'rows_per_sec': metrics.rows_per_sec,
+            })
+        return records
+
+    def save(self, metrics: StageMetrics, conn: sqlite3.Connection = None):
+        """
+        Save the latest stage to the metrics table and rewrite the run logs (internal use only).
+        The logs are rewritten after every stage so that a failed run still leaves them behind.
+        :param metrics: The stage just finished
+        :param conn: DB connection for the metrics row (defaults to the run's)
+        :return: None
+        """
+        records = self.records()
+        conn = self.conn if conn is None else conn
+
+        if conn is not None:
+            record = records[-1]
+            insert_sql = '''
+                INSERT INTO pipeline_metrics (%s)
+                VALUES (%s)
+            ''' % (', '.join(FIELDS), ','.join('?' * len(FIELDS)))
+            try:
+                conn.execute(insert_sql, [record[field] for field in FIELDS])
+                conn.commit()
+            except sqlite3.Error as err:
+                # A failed stage may have left the connection unusable; the logs below still get written
+                print("Could not save metrics for %s: %s" % (metrics.stage, err))
+
+        if self.log_dir:
+            fname = join(self.log_dir, "run_%s" % self.run_id)
+            with open(fname + ".json", "w") as outfile:
+                json.dump({'run_id': self.run_id, 'stages': records}, outfile, indent=2)
+            with open(fname + ".csv", "w", newline="") as outfile:
+                writer = csv.DictWriter(outfile, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+
+
+def table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    """
+    Check whether a table or view exists.
+    :param conn: DB connection
+    :param table: Table name
+    :return: True if it exists
+    """
+    querystr = "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?"
+    return conn.execute(querystr, (table,)).fetchone() is not None
+
+
+def table_count(conn: sqlite3.Connection, table: str) -> int:
+    """
+    Count the rows in a table (0 if it does not exist yet).
+    :param conn: DB connection
+    :param table: Table name
+    :return: Number of rows
+    """
+    if not table_exists(conn, table):
+        return 0
+    return conn.execute('SELECT COUNT(1) FROM "%s"' % table).fetchone()[0]
+
+
+def cpu_time() -> float:
+    """
+    Get the CPU time used by this process and its finished child processes.
+    :return: Seconds
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class RssSampler:
+    """
+    Thread that samples the resident memory of the process and keeps the highest value (internal use only)
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_SEC):
+        """
+        Init RssSampler and start sampling (nothing is started where the RSS cannot be read).
+        :param interval: Seconds between samples
+        """
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """
+        Sample until stopped (runs in the thread).
+        """
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def stop(self):
+        """
+        Stop sampling.
+        :return: Highest RSS in MB, or None where it cannot be read
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss_mb())
+        return self.peak
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the kernel's peak RSS (VmHWM) of this process to its current RSS (Linux only).
+    :return: True if it was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outfile:
+            outfile.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident memory of this process since the last reset_peak_rss (Linux only).
+    :return: MB, or None where it is not available
+    """
+    try:
+        with open('/proc/self/status') as infile:
+            match = re.search(r'^VmHWM:\s+(\d+) kB', infile.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return round(int(match.group(1)) / (1 << 10), 1) if match else None
+
+
+def current_rss_mb():
+    """
+    Get the resident memory of this process now.
+    :return: MB, or None where it is not available
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            pages = int(infile.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1 << 20), 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD),
+                ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        get_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_process.restype = wintypes.HANDLE
+        get_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+        if get_info(get_process(), ctypes.byref(counters), counters.cb):
+            return round(counters.WorkingSetSize / (1 << 20), 1)
+
+    return None
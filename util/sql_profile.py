@@ -0,0 +1,330 @@
+"""
+Opt-in profiler for the SQL statements run through main/db.py.
+
+Set sql_profile = True in config.py (before the first connection is opened) to use it.  Each statement
+run through a cursor or Connection.execute is timed, and its EXPLAIN QUERY PLAN is taken the first time
+the statement is seen.  Statements are grouped by normalized text (literals replaced by ?).  Statements
+slower than sql_slow_ms, and any that scan a whole table listed in sql_scan_tables, are written to the
+JSON lines log in sql_profile_log.
+
+A trace callback tracks which statement is running and a progress handler counts the virtual machine
+steps it takes.  For a SELECT, execute only returns the first row, so vm_steps (which keeps counting while
+rows are fetched) is the better measure of its work.  The callbacks slow down row by row inserts, so leave
+the profiler off for full loads.
+"""
+
+from datetime import datetime
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+
+import main.config as config
+
+# Statements that have no query plan worth taking
+NO_PLAN = ('PRAGMA', 'BEGIN', 'COMMIT', 'END', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'DROP', 'VACUUM', 'ANALYZE',
+           'ATTACH', 'DETACH', 'REINDEX', 'EXPLAIN')
+
+_stats = {}
+_lock = threading.Lock()
+
+_comment_re = re.compile(r"--[^\n]*")
+_string_re = re.compile(r"'(?:[^']|'')*'")
+_number_re = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_space_re = re.compile(r"\s+")
+_table_re = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+_ctas_re = re.compile(r"^CREATE (?:TEMP |TEMPORARY )?TABLE (?:IF NOT EXISTS )?(\w+) AS ", re.IGNORECASE)
+_scan_re = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$")
+_keywords = {'WHERE', 'JOIN', 'ON', 'GROUP', 'ORDER', 'LEFT', 'INNER', 'CROSS', 'OUTER', 'NATURAL', 'USING',
+             'LIMIT', 'SELECT', 'SET', 'VALUES', 'UNION', 'EXCEPT', 'INTERSECT', 'HAVING', 'WINDOW', 'DEFAULT'}
+
+
+class StatementStats:
+    """
+    Totals for one normalized statement
+    """
+
+    def __init__(self, sql: str):
+        """
+        Init StatementStats.
+        :param sql: Normalized statement text
+        """
+        self.sql = sql
+        self.calls = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+        self.rows = 0
+        self.vm_steps = 0
+        self.plan = None
+        self.full_scans = []
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Cursor that times its statements
+    """
+
+    def execute(self, sql, parameters=()):
+        return self.connection.profile(self, sqlite3.Cursor.execute, sql, parameters, False)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.connection.profile(self, sqlite3.Cursor.executemany, sql, seq_of_parameters, True)
+
+    def executescript(self, sql_script):
+        return self.connection.profile(self, sqlite3.Cursor.executescript, sql_script, None, False)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Connection that profiles its statements.  main/db.py opens connections with this class when
+    sql_profile is set in config.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.db_name = args[0] if args else kwargs.get('database')
+        self._current_raw = None
+        self._last_raw = None
+        self._current_key = None
+        self.set_trace_callback(self._trace)
+        self.set_progress_handler(self._progress, config.sql_profile_steps)
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def _trace(self, statement: str):
+        """
+        Note the statement that has started (trace callback).
+        Only the raw text is kept here, since this runs for every row of an executemany.
+        :param statement: Statement text with the parameters filled in
+        :return: None
+        """
+        if not statement.startswith('EXPLAIN'):
+            self._current_raw = statement
+
+    def _progress(self) -> int:
+        """
+        Count virtual machine steps for the running statement (progress handler).
+        :return: 0 to let the statement continue
+        """
+        raw = self._current_raw
+        if raw is not None:
+            if raw is not self._last_raw:
+                self._current_key = normalize(raw)
+                self._last_raw = raw
+            stats = get_stats(self._current_key)
+            stats.vm_steps += config.sql_profile_steps
+        return 0
+
+    def profile(self, cursor: sqlite3.Cursor, method, sql: str, parameters, many: bool):
+        """
+        Run a statement, timing it and recording the results (internal use only).
+        :param cursor: Cursor running the statement
+        :param method: Unbound sqlite3.Cursor method to call
+        :param sql: Statement text
+        :param parameters: Parameters (a sequence of them when many is True, None for a script)
+        :param many: The statement is run with executemany
+        :return: The cursor
+        """
+        key = normalize(sql)
+        stats = get_stats(key)
+
+        # Take the plan before running, since a CREATE TABLE can't be explained once the table exists
+        if stats.plan is None and parameters is not None and not key.upper().startswith(NO_PLAN):
+            first = parameters
+            if many:
+                parameters = iter(parameters)
+                first = next(parameters, None)
+                if first is not None:
+                    parameters = itertools.chain([first], parameters)
+            if first is not None:
+                stats.plan = explain(self, sql, first)
+                stats.full_scans = full_scans(sql, stats.plan, config.sql_scan_tables)
+
+        changes = self.total_changes
+        start = time.perf_counter()
+        try:
+            if parameters is None:
+                method(cursor, sql)
+            else:
+                method(cursor, sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - start
+            rows = cursor.rowcount
+            if rows < 0 and not key.upper().startswith('SELECT'):
+                rows = self.total_changes - changes
+                # CREATE TABLE ... AS is not counted in total_changes
+                match = _ctas_re.match(key)
+                if match is not None and rows == 0:
+                    querystr = 'SELECT COUNT(1) FROM "%s"' % match.group(1)
+                    try:
+                        rows = sqlite3.Cursor(self).execute(querystr).fetchone()[0]
+                    except sqlite3.Error:
+                        pass
+            record(self, stats, elapsed, rows if rows >= 0 else None)
+
+        return cursor
+
+
+def normalize(sql: str) -> str:
+    """
+    Normalize statement text, so the same statement with different literals or spacing groups together.
+    :param sql: Statement text
+    :return: Normalized text
+    """
+    sql = _comment_re.sub(" ", sql)
+    sql = _string_re.sub("?", sql)
+    sql = _number_re.sub("?", sql)
+    return _space_re.sub(" ", sql).strip()
+
+
+def get_stats(key: str) -> StatementStats:
+    """
+    Get the totals for a normalized statement (internal use only).
+    :param key: Normalized statement text
+    :return: StatementStats
+    """
+    stats = _stats.get(key)
+    if stats is None:
+        with _lock:
+            stats = _stats.setdefault(key, StatementStats(key))
+    return stats
+
+
+def explain(conn: sqlite3.Connection, sql: str, parameters) -> list:
+    """
+    Get the query plan for a statement.
+    :param conn: DB connection
+    :param sql: Statement text
+    :param parameters: Parameters for one run of the statement
+    :return: List of plan lines (indented by depth), or an empty list if there is no plan
+    """
+    try:
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return []
+
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, notused, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append("  " * depth[node_id] + detail)
+    return plan
+
+
+def full_scans(sql: str, plan: list, tables) -> list:
+    """
+    Find the plan lines that scan all of one of the given tables (or all of an index on it).
+    Newer versions of SQLite show the alias rather than the table name, so aliases are found in the SQL.
+    :param sql: Statement text
+    :param plan: Plan lines from explain
+    :param tables: Table names to look for
+    :return: List of "table: plan line"
+    """
+    names = {}
+    for table, alias in _table_re.findall(sql):
+        if table.lower() in tables:
+            names[table.lower()] = table.lower()
+            if alias and alias.upper() not in _keywords:
+                names[alias.lower()] = table.lower()
+
+    scans = []
+    for line in plan:
+        match = _scan_re.match(line.strip())
+        if match is None:
+            continue
+        name = (match.group(2) or match.group(1)).lower()
+        if name in names or match.group(1).lower() in names:
+            scans.append("%s: %s" % (names.get(name, match.group(1).lower()), line.strip()))
+    return scans
+
+
+def record(conn: ProfiledConnection, stats: StatementStats, elapsed: float, rows):
+    """
+    Add a run of a statement to its totals, and log it if it was slow or scanned a watched table
+    (internal use only).
+    :param conn: DB connection
+    :param stats: Totals for the statement
+    :param elapsed: Seconds
+    :param rows: Rows changed (None for a SELECT)
+    :return: None
+    """
+    with _lock:
+        stats.calls += 1
+        stats.total_sec += elapsed
+        stats.max_sec = max(stats.max_sec, elapsed)
+        if rows:
+            stats.rows += rows
+
+    slow = elapsed * 1000 >= config.sql_slow_ms
+    if (slow or stats.full_scans) and config.sql_profile_log:
+        entry = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'db': conn.db_name,
+            'sql': stats.sql,
+            'duration_ms': round(elapsed * 1000, 3),
+            'rows': rows,
+            'slow': slow,
+            'full_scans': stats.full_scans,
+            'plan': stats.plan,
+        }
+        with _lock:
+            with open(config.sql_profile_log, "a") as outfile:
+                outfile.write(json.dumps(entry) + "\n")
+
+
+def summary(top: int = None) -> list:
+    """
+    Get the statement totals so far, slowest first.
+    :param top: Number of statements to return (default all)
+    :return: List of dict
+    """
+    with _lock:
+        rows = [{
+            'sql': stats.sql,
+            'calls': stats.calls,
+            'total_sec': round(stats.total_sec, 3),
+            'max_sec': round(stats.max_sec, 3),
+            'rows': stats.rows,
+            'vm_steps': stats.vm_steps,
+            'full_scans': stats.full_scans,
+            'plan': stats.plan,
+        } for stats in _stats.values() if stats.calls]
+    rows.sort(key=lambda row: row['total_sec'], reverse=True)
+    return rows[:top] if top else rows
+
+
+def print_summary(top: int = 20):
+    """
+    Print the slowest statements so far, with their plans.
+    :param top: Number of statements to print
+    :return: None
+    """
+    for row in summary(top):
+        print("%9.3f s  %6d calls  %10d rows  %12d steps" % (row['total_sec'], row['calls'], row['rows'],
+                                                            row['vm_steps']))
+        print("    " + row['sql'][:200])
+        for line in row['plan'] or []:
+            print("      " + line)
+        for scan in row['full_scans']:
+            print("    FULL SCAN " + scan)
+
+
+def reset():
+    """
+    Clear the statement totals.
+    :return: None
+    """
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,158 @@
+"""Streaming decoder for Unix compress (.Z) files"""
+
+import io
+
+LZW_MAGIC = b"\x1f\x9d"
+# Flags byte: low 5 bits hold the maximum code size, the high bit marks block mode (code 256 clears the table)
+BIT_MASK = 0x1f
+BLOCK_MODE = 0x80
+CLEAR = 256
+INIT_BITS = 9
+
+
+def iter_unlzw(infile, block_size: int = 1 << 16):
+    """
+    Decompress a .Z stream, yielding blocks of decompressed bytes.
+    This follows the layout written by compress/ncompress: codes are packed least significant bit first
+    in groups of n_bits bytes (8 codes), and when the code size changes or the table is cleared the
+    rest of the current group is padding.
+    To check it, compress test data with ncompress (in requirements-dev.txt) and compare the output.
+    :param infile: Binary file object positioned at the start of the .Z data
+    :param block_size: Number of bytes to read at a time
+    :return: Generator of bytes
+    """
+    header = infile.read(3)
+    if len(header) < 3 or header[:2] != LZW_MAGIC:
+        raise ValueError("Not a .Z (LZW) file")
+    maxbits = header[2] & BIT_MASK
+    block_mode = header[2] & BLOCK_MODE
+    if maxbits < INIT_BITS or maxbits > 16:
+        raise ValueError("Unsupported .Z code size %d" % maxbits)
+    maxmaxcode = 1 << maxbits
+
+    table = [bytes([i]) for i in range(256)] + [b""] * (maxmaxcode - 256)
+    n_bits = INIT_BITS
+    maxcode = (1 << n_bits) - 1
+    mask = maxcode
+    free_ent = CLEAR + 1 if block_mode else CLEAR
+    prev = None
+
+    buf = b""
+    pos = 0
+    group = 0
+    n_codes = 0
+    i = 0
+    out = []
+    out_size = 0
+
+    while True:
+        if free_ent > maxcode and n_bits < maxbits:
+            # Widen the codes; the rest of the current group is padding
+            i = n_codes
+            n_bits += 1
+            maxcode = maxmaxcode if n_bits == maxbits else (1 << n_bits) - 1
+            mask = (1 << n_bits) - 1
+
+        if i >= n_codes:
+            # Load the next group of (up to) 8 codes
+            if len(buf) - pos < n_bits:
+                buf = buf[pos:] + infile.read(block_size)
+                pos = 0
+            chunk = buf[pos:pos + n_bits]
+            pos += len(chunk)
+            n_codes = len(chunk) * 8 // n_bits
+            if n_codes == 0:
+                break
+            group = int.from_bytes(chunk, "little")
+            i = 0
+
+        code = (group >> (i * n_bits)) & mask
+        i += 1
+
+        if prev is None:
+            if code >= 256:
+                raise ValueError("Corrupt .Z data: bad first code")
+            prev = table[code]
+            out.append(prev)
+            out_size += 1
+            continue
+
+        if code == CLEAR and block_mode:
+            table[256:free_ent] = [b""] * (free_ent - 256)
+            free_ent = CLEAR
+            n_bits = INIT_BITS
+            maxcode = (1 << n_bits) - 1
+            mask = maxcode
+            # The rest of the current group is padding
+            i = n_codes
+            continue
+
+        if code < free_ent:
+            entry = table[code]
+        elif code == free_ent:
+            entry = prev + prev[:1]
+        else:
+            raise ValueError("Corrupt .Z data: code %d out of range" % code)
+
+        out.append(entry)
+        out_size += len(entry)
+        if free_ent < maxmaxcode:
+            table[free_ent] = prev + entry[:1]
+            free_ent += 1
+        prev = entry
+
+        if out_size >= block_size:
+            yield b"".join(out)
+            out = []
+            out_size = 0
+
+    if out:
+        yield b"".join(out)
+
+
+class LZWFile(io.RawIOBase):
+    """
+    Read-only file object over a .Z stream, so it can be handed to tarfile in stream mode.
+    """
+
+    def __init__(self, infile):
+        """
+        Init LZWFile.
+        :param infile: Binary file object with the .Z data
+        """
+        super().__init__()
+        self._infile = infile
+        self._blocks = iter_unlzw(infile)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self):
+        self._infile.close()
+        super().close()
+
+    def readinto(self, b) -> int:
+        """
+        Fill a buffer with decompressed bytes.
+        :param b: Writable buffer
+        :return: Number of bytes filled (0 at end of data)
+        """
+        while not self._pending:
+            self._pending = next(self._blocks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def open_z(fname):
+    """
+    Open a .Z file for buffered reading of its decompressed contents.
+    :param fname: Filename
+    :return: Binary file object
+    """
+    return io.BufferedReader(LZWFile(open(fname, "rb")), buffer_size=1 << 16)